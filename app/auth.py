@@ -6,43 +6,121 @@ from typing import Optional, Dict, List
 from pathlib import Path
 import logging
 
+from .config import settings
+from .database import database
+from .executor import run_io
+
 logger = logging.getLogger(__name__)
 
 class APIKeyManager:
-    """Менеджер для управления API ключами"""
+    """Менеджер для управления API ключами.
+    
+    Ключи хранятся в таблице api_keys базы данных, общей для всех процессов
+    сервиса. Каждый процесс держит копию в памяти: проверка ключа не
+    обращается к базе, а изменения, сделанные другими процессами,
+    подхватываются по поколению "api_keys" (refresh). Статистика
+    использования накапливается в памяти и добавляется к счетчикам базы
+    периодически (flush).
+    """
+    
+    def __init__(self, keys_file: str = None):
+        # Файл ключей прежних версий, импортируется в базу при первом запуске
+        self.keys_file = Path(keys_file or settings.API_KEYS_FILE)
+        self.keys: Dict[str, Dict] = {}
+        
+        # Предразобранные сроки действия ключей: хеш -> datetime
+        self._expiry: Dict[str, datetime] = {}
+        # Накопленная, еще не сохраненная статистика: хеш -> число проверок / время
+        self._usage: Dict[str, int] = {}
+        self._last_used: Dict[str, datetime] = {}
+        # Поколение ключей в базе, соответствующее копии в памяти
+        self._generation: Optional[int] = None
     
-    def __init__(self, keys_file: str = "api_keys.json"):
-        self.keys_file = Path(keys_file)
-        self.keys_data = self._load_keys()
+    def _index_expiry(self) -> None:
+        """Разобрать сроки действия ключей один раз, а не при каждой проверке"""
+        self._expiry = {}
+        for key_hash, key_data in self.keys.items():
+            expires_at = key_data.get("expires_at")
+            if expires_at:
+                try:
+                    self._expiry[key_hash] = datetime.fromisoformat(expires_at)
+                except ValueError:
+                    logger.error(f"Некорректный срок действия ключа {key_data.get('name', 'unknown')}")
     
-    def _load_keys(self) -> Dict:
-        """Загрузить ключи из файла"""
+    def _load_keys_file(self) -> Dict:
+        """Прочитать ключи из api_keys.json"""
         if not self.keys_file.exists():
-            return {"keys": {}, "created_at": datetime.now().isoformat()}
+            return {}
         
         try:
             with open(self.keys_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
+                return json.load(f).get("keys", {})
         except Exception as e:
             logger.error(f"Ошибка загрузки ключей: {e}")
-            return {"keys": {}, "created_at": datetime.now().isoformat()}
+            return {}
     
-    def _save_keys(self) -> bool:
-        """Сохранить ключи в файл"""
+    async def load(self) -> None:
+        """Загрузить ключи из базы (при пустой таблице - импортировать api_keys.json)"""
+        if not await database.get_api_keys():
+            keys = await run_io(self._load_keys_file)
+            if keys:
+                imported = await database.import_api_keys(keys)
+                logger.info(f"Импортировано API ключей из {self.keys_file}: {imported}")
+        await self.refresh(force=True)
+    
+    async def refresh(self, force: bool = False) -> bool:
+        """Перечитать ключи, если их изменил этот или другой процесс"""
         try:
-            with open(self.keys_file, 'w', encoding='utf-8') as f:
-                json.dump(self.keys_data, f, indent=2, ensure_ascii=False)
+            generation = await database.get_generation("api_keys")
+            if not force and generation == self._generation:
+                return False
+            self.keys = await database.get_api_keys()
+            self._generation = generation
+            self._index_expiry()
             return True
         except Exception as e:
-            logger.error(f"Ошибка сохранения ключей: {e}")
+            logger.error(f"Ошибка загрузки ключей из базы: {e}")
             return False
     
+    async def flush(self) -> bool:
+        """Сохранить накопленную статистику использования ключей в базу"""
+        if not self._usage:
+            return True
+        usage, self._usage = self._usage, {}
+        last_used, self._last_used = self._last_used, {}
+        
+        try:
+            await database.add_api_key_usage([
+                (key_hash, count, last_used[key_hash].isoformat())
+                for key_hash, count in usage.items()
+            ])
+        except Exception as e:
+            logger.error(f"Ошибка сохранения статистики ключей: {e}")
+            # Возвращаем статистику, накопленную до ошибки
+            for key_hash, count in usage.items():
+                self._usage[key_hash] = self._usage.get(key_hash, 0) + count
+                self._last_used.setdefault(key_hash, last_used[key_hash])
+            return False
+        
+        # Копия в памяти отражает сохраненные значения до следующего refresh
+        for key_hash, count in usage.items():
+            key_data = self.keys.get(key_hash)
+            if key_data is not None:
+                key_data["usage_count"] = key_data.get("usage_count", 0) + count
+                key_data["last_used"] = last_used[key_hash].isoformat()
+        return True
+    
     def _hash_key(self, key: str) -> str:
         """Хешировать ключ для безопасного хранения"""
         return hashlib.sha256(key.encode()).hexdigest()
     
-    def generate_key(self, name: str = "default", expires_days: Optional[int] = None) -> str:
-        """Сгенерировать новый API ключ"""
+    async def generate_key(self, name: str = "default", expires_days: Optional[int] = None,
+                           only_first: bool = False) -> Optional[str]:
+        """Сгенерировать новый API ключ.
+        
+        При only_first=True ключ создается, только если активных ключей
+        нет ни у одного процесса; иначе возвращается None.
+        """
         # Генерируем случайный ключ
         key = secrets.token_urlsafe(32)
         key_hash = self._hash_key(key)
@@ -53,28 +131,33 @@ class APIKeyManager:
             "created_at": datetime.now().isoformat(),
             "last_used": None,
             "usage_count": 0,
-            "is_active": True
+            "is_active": True,
+            "expires_at": None
         }
         
         # Добавляем срок действия если указан
         if expires_days:
-            expiry_date = datetime.now() + timedelta(days=expires_days)
-            key_data["expires_at"] = expiry_date.isoformat()
+            key_data["expires_at"] = (datetime.now() + timedelta(days=expires_days)).isoformat()
         
         # Сохраняем ключ
-        self.keys_data["keys"][key_hash] = key_data
-        self._save_keys()
+        if not await database.create_api_key(key_hash, key_data, only_first=only_first):
+            return None
+        await self.refresh()
         
         logger.info(f"Создан новый API ключ: {name}")
         return key
     
     def verify_key(self, key: str) -> bool:
-        """Проверить валидность API ключа"""
+        """Проверить валидность API ключа.
+        
+        Проверка выполняется только в памяти. Статистика использования
+        накапливается и сохраняется в базу периодически (flush).
+        """
         if not key:
             return False
         
         key_hash = self._hash_key(key)
-        key_data = self.keys_data["keys"].get(key_hash)
+        key_data = self.keys.get(key_hash)
         
         if not key_data:
             return False
@@ -84,127 +167,121 @@ class APIKeyManager:
             return False
         
         # Проверяем срок действия
-        expires_at = key_data.get("expires_at")
-        if expires_at:
-            expiry_date = datetime.fromisoformat(expires_at)
-            if datetime.now() > expiry_date:
-                logger.warning(f"API ключ истек: {key_data.get('name', 'unknown')}")
-                return False
+        now = datetime.now()
+        expiry_date = self._expiry.get(key_hash)
+        if expiry_date and now > expiry_date:
+            logger.warning(f"API ключ истек: {key_data.get('name', 'unknown')}")
+            return False
         
-        # Обновляем статистику использования
-        key_data["last_used"] = datetime.now().isoformat()
-        key_data["usage_count"] = key_data.get("usage_count", 0) + 1
-        self._save_keys()
+        # Обновляем статистику использования в памяти
+        self._usage[key_hash] = self._usage.get(key_hash, 0) + 1
+        self._last_used[key_hash] = now
         
         return True
     
-    def revoke_key(self, key: str) -> bool:
+    async def revoke_key(self, key: str) -> bool:
         """Отозвать API ключ"""
         key_hash = self._hash_key(key)
-        key_data = self.keys_data["keys"].get(key_hash)
+        key_data = self.keys.get(key_hash)
         
-        if not key_data:
+        if not key_data or not await database.revoke_api_key(key_hash):
             return False
-        
-        key_data["is_active"] = False
-        key_data["revoked_at"] = datetime.now().isoformat()
-        self._save_keys()
+        await self.refresh()
         
         logger.info(f"API ключ отозван: {key_data.get('name', 'unknown')}")
         return True
     
+    def _key_summary(self, key_hash: str, key_data: Dict) -> Dict:
+        """Данные ключа с учетом еще не сохраненной статистики"""
+        last_used = self._last_used.get(key_hash)
+        return {
+            "name": key_data.get("name", "unknown"),
+            "created_at": key_data.get("created_at"),
+            "last_used": last_used.isoformat() if last_used else key_data.get("last_used"),
+            "usage_count": key_data.get("usage_count", 0) + self._usage.get(key_hash, 0),
+            "is_active": key_data.get("is_active", True),
+            "expires_at": key_data.get("expires_at")
+        }
+    
     def list_keys(self) -> List[Dict]:
         """Получить список всех ключей (без самих ключей)"""
-        result = []
-        for key_hash, key_data in self.keys_data["keys"].items():
-            result.append({
-                "hash": key_hash[:16] + "...",  # Показываем только часть хеша
-                "name": key_data.get("name", "unknown"),
-                "created_at": key_data.get("created_at"),
-                "last_used": key_data.get("last_used"),
-                "usage_count": key_data.get("usage_count", 0),
-                "is_active": key_data.get("is_active", True),
-                "expires_at": key_data.get("expires_at")
-            })
-        return result
-    
-    def cleanup_expired_keys(self) -> int:
+        return [
+            {"hash": key_hash[:16] + "...", **self._key_summary(key_hash, key_data)}  # Показываем только часть хеша
+            for key_hash, key_data in self.keys.items()
+        ]
+    
+    async def cleanup_expired_keys(self) -> int:
         """Удалить истекшие ключи"""
         current_time = datetime.now()
-        expired_keys = []
-        
-        for key_hash, key_data in self.keys_data["keys"].items():
-            expires_at = key_data.get("expires_at")
-            if expires_at:
-                expiry_date = datetime.fromisoformat(expires_at)
-                if current_time > expiry_date:
-                    expired_keys.append(key_hash)
+        expired_keys = [
+            key_hash for key_hash, expiry_date in self._expiry.items()
+            if current_time > expiry_date
+        ]
+        if not expired_keys:
+            return 0
         
         # Удаляем истекшие ключи
+        await database.delete_api_keys(expired_keys)
         for key_hash in expired_keys:
-            del self.keys_data["keys"][key_hash]
-        
-        if expired_keys:
-            self._save_keys()
-            logger.info(f"Удалено {len(expired_keys)} истекших ключей")
+            self._usage.pop(key_hash, None)
+            self._last_used.pop(key_hash, None)
+        await self.refresh()
+        logger.info(f"Удалено {len(expired_keys)} истекших ключей")
         
         return len(expired_keys)
     
     def get_key_info(self, key: str) -> Optional[Dict]:
         """Получить информацию о ключе"""
         key_hash = self._hash_key(key)
-        key_data = self.keys_data["keys"].get(key_hash)
+        key_data = self.keys.get(key_hash)
         
         if not key_data:
             return None
         
-        return {
-            "name": key_data.get("name", "unknown"),
-            "created_at": key_data.get("created_at"),
-            "last_used": key_data.get("last_used"),
-            "usage_count": key_data.get("usage_count", 0),
-            "is_active": key_data.get("is_active", True),
-            "expires_at": key_data.get("expires_at")
-        }
+        return self._key_summary(key_hash, key_data)
 
 # Глобальный экземпляр менеджера ключей
 api_key_manager = APIKeyManager()
 
-def generate_initial_key() -> str:
-    """Генерировать начальный API ключ при первом запуске"""
-    # Проверяем, есть ли уже активные ключи
-    active_keys = [
-        key_data for key_data in api_key_manager.keys_data["keys"].values()
-        if key_data.get("is_active", True)
-    ]
-    
-    if not active_keys:
-        # Генерируем первый ключ
-        key = api_key_manager.generate_key("initial_key")
-        logger.info("Сгенерирован начальный API ключ")
-        return key
+async def generate_initial_key() -> Optional[str]:
+    """Генерировать начальный API ключ при первом запуске.
     
-    return None
+    Проверка отсутствия активных ключей и создание выполняются одной
+    транзакцией, поэтому при запуске нескольких процессов ключ создаст
+    только один из них.
+    """
+    key = await api_key_manager.generate_key("initial_key", only_first=True)
+    if key:
+        logger.info("Сгенерирован начальный API ключ")
+    return key
 
 def verify_api_key(key: str) -> bool:
     """Проверить API ключ"""
     return api_key_manager.verify_key(key)
 
-def create_api_key(name: str = "user_key", expires_days: Optional[int] = None) -> str:
+async def create_api_key(name: str = "user_key", expires_days: Optional[int] = None) -> str:
     """Создать новый API ключ"""
-    return api_key_manager.generate_key(name, expires_days)
+    return await api_key_manager.generate_key(name, expires_days)
 
-def revoke_api_key(key: str) -> bool:
+async def revoke_api_key(key: str) -> bool:
     """Отозвать API ключ"""
-    return api_key_manager.revoke_key(key)
+    return await api_key_manager.revoke_key(key)
 
 def list_api_keys() -> List[Dict]:
     """Получить список API ключей"""
     return api_key_manager.list_keys()
 
-def cleanup_expired_keys() -> int:
+async def cleanup_expired_keys() -> int:
     """Очистить истекшие ключи"""
-    return api_key_manager.cleanup_expired_keys()
+    return await api_key_manager.cleanup_expired_keys()
+
+async def flush_api_key_usage() -> None:
+    """Сохранить накопленную статистику использования ключей (для фоновой задачи)"""
+    await api_key_manager.flush()
+
+async def refresh_api_keys() -> None:
+    """Подхватить ключи, измененные другими процессами (для фоновой задачи)"""
+    await api_key_manager.refresh()
 
 # Middleware для логирования запросов с API ключами
 class APIKeyLoggingMiddleware:
@@ -0,0 +1,74 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicTask:
+    """Фоновая задача, выполняющая корутину с заданным интервалом"""
+    
+    def __init__(self, name: str, interval: float, func: Callable[[], Awaitable[None]],
+                 run_immediately: bool = False):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.run_immediately = run_immediately
+        self._task: Optional[asyncio.Task] = None
+    
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+    
+    async def _loop(self) -> None:
+        if not self.run_immediately:
+            await asyncio.sleep(self.interval)
+        while True:
+            try:
+                await self.func()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка фоновой задачи {self.name}: {e}")
+            await asyncio.sleep(self.interval)
+    
+    def start(self) -> None:
+        """Запустить задачу (повторный запуск игнорируется)"""
+        if self.running:
+            return
+        self._task = asyncio.create_task(self._loop(), name=self.name)
+        logger.info(f"Запущена фоновая задача {self.name} (интервал {self.interval} с)")
+    
+    async def stop(self) -> None:
+        """Остановить задачу и дождаться ее завершения"""
+        if not self.running:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+
+class BackgroundTasks:
+    """Реестр фоновых задач приложения"""
+    
+    def __init__(self):
+        self.tasks: Dict[str, PeriodicTask] = {}
+    
+    def add(self, task: PeriodicTask) -> PeriodicTask:
+        self.tasks[task.name] = task
+        return task
+    
+    def start_all(self) -> None:
+        for task in self.tasks.values():
+            task.start()
+    
+    async def stop_all(self) -> None:
+        for task in self.tasks.values():
+            await task.stop()
+
+
+# Глобальный реестр фоновых задач
+background_tasks = BackgroundTasks()
@@ -0,0 +1,262 @@
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Hashable, Iterable, Optional, Set, Tuple
+
+from .config import settings
+
+try:
+    import fcntl
+except ImportError:  # не POSIX - счетчики сбросов обновляются без блокировки
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Виды кэшируемых ответов
+CACHE_USER = "user"
+CACHE_TRAFFIC = "traffic"
+CACHE_SUB = "sub"
+CACHE_KINDS = (CACHE_USER, CACHE_TRAFFIC, CACHE_SUB)
+
+# Общие счетчики сбросов: по uint64 на вид ответов
+SHARED_COUNTERS = struct.Struct("<" + "Q" * len(CACHE_KINDS))
+
+
+class CachedResponse:
+    """Сериализованное тело ответа и его ETag"""
+    
+    __slots__ = ("body", "etag", "expires_at", "owner")
+    
+    def __init__(self, body: bytes, expires_at: float, owner: Optional[str] = None):
+        self.body = body
+        self.owner = owner
+        self.etag = '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+        self.expires_at = expires_at
+    
+    def matches(self, if_none_match: Optional[str]) -> bool:
+        """Совпадает ли ETag с заголовком If-None-Match"""
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            if tag == self.etag:
+                return True
+        return False
+
+
+class ResponseCache:
+    """LRU кэш сериализованных ответов с ограничением размера и временем жизни.
+    
+    Ключ - (вид ответа, uuid пользователя, ...). Все записи пользователя
+    сбрасываются одним вызовом invalidate(uuid) при любом его изменении;
+    kinds ограничивает сброс видами ответов, которые изменение затрагивает
+    (новый трафик меняет только ответы traffic). Если ключ строится не по
+    uuid (например, по токену подписки), uuid владельца передается в put явно.
+    
+    Чтобы ответ, прочитанный из базы до изменения, не попал в кэш после
+    сброса, put принимает эпоху его вида, полученную через epoch(kind)
+    до чтения: если с тех пор был сброс этого вида, запись не сохраняется.
+    
+    Если задан shared_path (несколько процессов uvicorn), сброс увеличивает
+    счетчик своего вида ответов в общем файле, отображенном в память
+    (по счетчику на вид). Процесс, увидевший чужое значение счетчика,
+    очищает записи этого вида: изменения, сделанные другими процессами,
+    не отдаются из кэша устаревшими, а частые сбросы трафика не очищают
+    ответы с пользователями и подписками. Счетчики только растут и
+    увеличиваются под блокировкой файла, поэтому одновременные сбросы
+    разных процессов не скрывают друг друга.
+    """
+    
+    def __init__(self, max_size: int = None, ttl: float = None, shared_path: Optional[Path] = None):
+        self.max_size = max_size if max_size is not None else settings.RESPONSE_CACHE_SIZE
+        self.ttl = ttl if ttl is not None else settings.RESPONSE_CACHE_TTL
+        self._entries: "OrderedDict[Tuple, CachedResponse]" = OrderedDict()
+        # uuid -> ключи его записей
+        self._keys_by_uuid: Dict[str, Set[Tuple]] = {}
+        self._epochs: Dict[str, int] = {}
+        
+        # Общие для процессов счетчики сбросов, их файл и последние увиденные значения
+        self._shared: Optional[mmap.mmap] = None
+        self._shared_fd: Optional[int] = None
+        self._seen: Tuple[int, ...] = ()
+        if shared_path is not None:
+            self._open_shared(Path(shared_path))
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+    
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0 and self.ttl > 0
+    
+    def _open_shared(self, path: Path) -> None:
+        """Отобразить в память файл счетчиков сбросов"""
+        size = SHARED_COUNTERS.size
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size < size:
+                    os.ftruncate(fd, size)
+                self._shared = mmap.mmap(fd, size)
+            except OSError:
+                os.close(fd)
+                raise
+            self._shared_fd = fd
+            self._seen = SHARED_COUNTERS.unpack(self._shared[:size])
+        except OSError as e:
+            logger.error(f"Общий маркер кэша {path} недоступен, кэш отключен: {e}")
+            self.max_size = 0
+    
+    def _changed_kinds(self, counters: Tuple[int, ...]) -> list:
+        return [kind for kind, seen, value in zip(CACHE_KINDS, self._seen, counters) if seen != value]
+    
+    def _publish(self, kinds: Iterable[str]) -> None:
+        """Сообщить другим процессам о сбросе ответов указанных видов.
+        
+        Чужие сбросы, сделанные с прошлой проверки, применяются здесь же,
+        под той же блокировкой, что и увеличение счетчиков.
+        """
+        if self._shared is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self._shared_fd, fcntl.LOCK_EX)
+        try:
+            counters = list(SHARED_COUNTERS.unpack(self._shared[:SHARED_COUNTERS.size]))
+            changed = self._changed_kinds(counters)
+            for kind in kinds:
+                index = CACHE_KINDS.index(kind)
+                counters[index] = (counters[index] + 1) & 0xFFFFFFFFFFFFFFFF
+            self._shared[:SHARED_COUNTERS.size] = SHARED_COUNTERS.pack(*counters)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self._shared_fd, fcntl.LOCK_UN)
+        self._seen = tuple(counters)
+        self._drop_kinds(changed)
+    
+    def _sync(self) -> None:
+        """Сбросить записи видов, которые сбросил другой процесс"""
+        if self._shared is None:
+            return
+        counters = SHARED_COUNTERS.unpack(self._shared[:SHARED_COUNTERS.size])
+        if counters == self._seen:
+            return
+        changed = self._changed_kinds(counters)
+        self._seen = counters
+        self._drop_kinds(changed)
+    
+    def _drop_kinds(self, kinds: Iterable[str]) -> None:
+        kinds = set(kinds)
+        for kind in kinds:
+            self._epochs[kind] = self._epochs.get(kind, 0) + 1
+        for key in [key for key in self._entries if key[0] in kinds]:
+            self._remove(key)
+            self.invalidations += 1
+    
+    def epoch(self, kind: str) -> int:
+        """Текущая эпоха сбросов вида ответов (передается в put)"""
+        self._sync()
+        return self._epochs.get(kind, 0)
+    
+    def get(self, key: Tuple[Hashable, ...]) -> Optional[CachedResponse]:
+        """Получить запись, если она есть и не устарела"""
+        self._sync()
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry.expires_at <= time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+    
+    def put(self, key: Tuple[Hashable, ...], body: bytes, epoch: Optional[int] = None,
+            owner: Optional[str] = None) -> CachedResponse:
+        """Сохранить тело ответа и вернуть запись с ETag"""
+        entry = CachedResponse(body, time.monotonic() + self.ttl, owner or key[1])
+        self._sync()
+        if not self.enabled or (epoch is not None and epoch != self._epochs.get(key[0], 0)):
+            return entry
+        
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = entry
+        self._keys_by_uuid.setdefault(entry.owner, set()).add(key)
+        
+        while len(self._entries) > self.max_size:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+        return entry
+    
+    def _remove(self, key: Tuple) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        keys = self._keys_by_uuid.get(entry.owner)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_uuid[entry.owner]
+    
+    def invalidate(self, *uuids: str, kinds: Tuple[str, ...] = CACHE_KINDS) -> None:
+        """Сбросить записи указанных пользователей (по умолчанию всех видов)"""
+        self._publish(kinds)
+        for kind in kinds:
+            self._epochs[kind] = self._epochs.get(kind, 0) + 1
+        for uuid in uuids:
+            keys = self._keys_by_uuid.get(uuid)
+            if not keys:
+                continue
+            for key in [key for key in keys if key[0] in kinds]:
+                self._remove(key)
+                self.invalidations += 1
+    
+    def invalidate_kind(self, kind: str) -> None:
+        """Сбросить все записи одного вида (например, при смене конфигурации)"""
+        self._publish((kind,))
+        self._drop_kinds((kind,))
+    
+    def clear(self) -> None:
+        """Сбросить весь кэш"""
+        self._publish(CACHE_KINDS)
+        for kind in CACHE_KINDS:
+            self._epochs[kind] = self._epochs.get(kind, 0) + 1
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+        self._keys_by_uuid.clear()
+    
+    def stats(self) -> Dict:
+        """Статистика кэша"""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "shared": self._shared is not None
+        }
+
+
+# Глобальный экземпляр кэша ответов
+response_cache = ResponseCache(
+    shared_path=settings.DATA_DIR / "cache.epoch" if settings.WORKERS > 1 else None
+)
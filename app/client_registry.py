@@ -0,0 +1,113 @@
+from typing import Dict, List, Optional, Tuple
+
+
+class InboundIndex:
+    """Индекс клиентов одного inbound: uuid -> позиция в списке clients"""
+    
+    def __init__(self, inbound: Dict):
+        self.inbound = inbound
+        self.clients: List[Dict] = inbound.setdefault("settings", {}).setdefault("clients", [])
+        self.positions: Dict[str, int] = {
+            client.get("id"): position for position, client in enumerate(self.clients)
+        }
+    
+    @property
+    def tag(self) -> Optional[str]:
+        return self.inbound.get("tag")
+    
+    def __contains__(self, client_id: str) -> bool:
+        return client_id in self.positions
+    
+    def append(self, client: Dict) -> None:
+        """Добавить клиента в конец списка"""
+        self.positions[client["id"]] = len(self.clients)
+        self.clients.append(client)
+    
+    def pop(self, client_id: str) -> Optional[Dict]:
+        """Удалить клиента за O(1): на его место переносится последний клиент.
+        
+        Порядок клиентов в конфигурации при этом меняется, для Xray он не важен.
+        """
+        position = self.positions.pop(client_id, None)
+        if position is None:
+            return None
+        
+        client = self.clients[position]
+        last = self.clients.pop()
+        if last is not client:
+            self.clients[position] = last
+            self.positions[last.get("id")] = position
+        return client
+
+
+class ClientRegistry:
+    """Разобранная и проиндексированная конфигурация Xray.
+    
+    Хранит индексы uuid -> клиент, email -> клиент и протокол -> inbound,
+    чтобы поиск и изменение клиентов не требовали перебора всей конфигурации.
+    Изменения вносятся прямо в объект config, который затем сохраняется в файл.
+    Email индексируется без учета регистра, как его сравнивает Xray.
+    """
+    
+    def __init__(self, config: Dict, signature: Optional[Tuple] = None):
+        self.config = config
+        self.signature = signature
+        self.inbounds_by_protocol: Dict[str, List[Dict]] = {}
+        self.vless_inbounds: List[InboundIndex] = []
+        self.clients_by_id: Dict[str, Dict] = {}
+        self.clients_by_email: Dict[str, Dict] = {}
+        
+        for inbound in config.get("inbounds", []):
+            protocol = inbound.get("protocol")
+            self.inbounds_by_protocol.setdefault(protocol, []).append(inbound)
+            if protocol != "vless":
+                continue
+            
+            index = InboundIndex(inbound)
+            self.vless_inbounds.append(index)
+            for client in index.clients:
+                self.clients_by_id.setdefault(client.get("id"), client)
+                if client.get("email"):
+                    self.clients_by_email.setdefault(client["email"].lower(), client)
+    
+    def inbounds(self, protocol: str) -> List[Dict]:
+        """Inbound с указанным протоколом"""
+        return self.inbounds_by_protocol.get(protocol, [])
+    
+    def primary_inbound(self) -> Optional[InboundIndex]:
+        """Первый VLESS inbound - в него добавляются новые клиенты"""
+        return self.vless_inbounds[0] if self.vless_inbounds else None
+    
+    def get(self, client_id: str) -> Optional[Dict]:
+        """Найти клиента по uuid"""
+        return self.clients_by_id.get(client_id)
+    
+    def get_by_email(self, email: str) -> Optional[Dict]:
+        """Найти клиента по email"""
+        return self.clients_by_email.get(email.lower())
+    
+    def add(self, index: InboundIndex, client: Dict) -> None:
+        """Добавить клиента в inbound и индексы"""
+        index.append(client)
+        self.clients_by_id.setdefault(client["id"], client)
+        if client.get("email"):
+            self.clients_by_email.setdefault(client["email"].lower(), client)
+    
+    def remove(self, client_id: str) -> List[Tuple[Optional[str], Dict]]:
+        """Удалить клиента из всех VLESS inbound.
+        
+        Возвращает список (тег inbound, удаленный клиент).
+        """
+        removed = []
+        for index in self.vless_inbounds:
+            client = index.pop(client_id)
+            if client is not None:
+                removed.append((index.tag, client))
+        
+        if removed:
+            self.clients_by_id.pop(client_id, None)
+            for _, client in removed:
+                email = (client.get("email") or "").lower()
+                if email and self.clients_by_email.get(email) is client:
+                    del self.clients_by_email[email]
+        return removed
@@ -14,17 +14,113 @@ class Settings:
     # Безопасность
     SECRET_KEY: str = os.getenv("SECRET_KEY", secrets.token_urlsafe(32))
     API_KEY_FILE: str = os.getenv("API_KEY_FILE", "/app/data/api_key.txt")
+    API_KEYS_FILE: str = os.getenv("API_KEYS_FILE", "api_keys.json")
+    # Интервал сохранения статистики использования API ключей (секунды)
+    API_KEYS_FLUSH_INTERVAL: float = float(os.getenv("API_KEYS_FLUSH_INTERVAL", "30"))
     
     # База данных
     DATABASE_URL: str = os.getenv("DATABASE_URL", "sqlite:///./data/xray_manager.db")
+    DB_POOL_SIZE: int = int(os.getenv("DB_POOL_SIZE", "4"))
+    DB_STATEMENT_CACHE_SIZE: int = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "128"))
+    DB_BUSY_TIMEOUT_MS: int = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+    # Интервал сверки счетчиков пользователей с таблицей users (секунды)
+    USER_COUNTERS_RECONCILE_INTERVAL: float = float(os.getenv("USER_COUNTERS_RECONCILE_INTERVAL", "3600"))
     
     # Xray настройки
     XRAY_CONFIG_PATH: str = os.getenv("XRAY_CONFIG_PATH", "/etc/xray/config.json")
     XRAY_SERVICE_NAME: str = os.getenv("XRAY_SERVICE_NAME", "xray")
+    XRAY_INBOUND_TAG: str = os.getenv("XRAY_INBOUND_TAG", "vless-in")
+    # Писать config.json без отступов (быстрее и компактнее для больших списков клиентов)
+    XRAY_CONFIG_COMPACT: bool = os.getenv("XRAY_CONFIG_COMPACT", "false").lower() in ("1", "true", "yes")
+    # Политика fsync при записи config.json: always, batched, never
+    XRAY_FSYNC_POLICY: str = os.getenv("XRAY_FSYNC_POLICY", "always")
+    XRAY_FSYNC_INTERVAL: float = float(os.getenv("XRAY_FSYNC_INTERVAL", "1.0"))
+    # Кольцо резервных копий: количество поколений и сжатие (none, gzip, zstd)
+    XRAY_BACKUP_COUNT: int = int(os.getenv("XRAY_BACKUP_COUNT", "10"))
+    XRAY_BACKUP_COMPRESSION: str = os.getenv("XRAY_BACKUP_COMPRESSION", "gzip")
+    # Изменения только клиентов попадают в кольцо не чаще раза в интервал (секунды,
+    # 0 - каждое); промежуточные версии внутри интервала не сохраняются
+    XRAY_BACKUP_INTERVAL: float = float(os.getenv("XRAY_BACKUP_INTERVAL", "0"))
+    
+    # Управление сервисом Xray: auto (D-Bus, если установлен dbus-next и есть
+    # системная шина, иначе systemctl), dbus, systemctl
+    XRAY_SERVICE_CONTROL: str = os.getenv("XRAY_SERVICE_CONTROL", "auto")
+    # Применение новой конфигурации без перезапуска Xray: сигнал основному процессу
+    # (например, SIGHUP, если сборка или обертка Xray перечитывает конфигурацию по
+    # сигналу; пусто - не использовать) и systemctl reload, если у юнита есть ExecReload
+    XRAY_RELOAD_SIGNAL: str = os.getenv("XRAY_RELOAD_SIGNAL", "")
+    XRAY_SYSTEMD_RELOAD: bool = os.getenv("XRAY_SYSTEMD_RELOAD", "true").lower() in ("1", "true", "yes")
+    # Ожидание готовности Xray после reload/перезапуска: опрос порта API или inbound
+    # с паузой от XRAY_READY_INITIAL_DELAY, удваивающейся до XRAY_READY_MAX_DELAY (секунды)
+    XRAY_READY_TIMEOUT: float = float(os.getenv("XRAY_READY_TIMEOUT", "10"))
+    XRAY_READY_INITIAL_DELAY: float = float(os.getenv("XRAY_READY_INITIAL_DELAY", "0.05"))
+    XRAY_READY_MAX_DELAY: float = float(os.getenv("XRAY_READY_MAX_DELAY", "1"))
+    # Дочерние процессы (xray -test, systemctl): таймаут (секунды) и число одновременно запущенных
+    PROCESS_TIMEOUT: float = float(os.getenv("PROCESS_TIMEOUT", "30"))
+    PROCESS_MAX_CONCURRENCY: int = int(os.getenv("PROCESS_MAX_CONCURRENCY", "4"))
+    
+    # Xray API (горячее добавление/удаление клиентов без перезапуска)
+    XRAY_API_ENABLED: bool = os.getenv("XRAY_API_ENABLED", "true").lower() in ("1", "true", "yes")
+    XRAY_API_HOST: str = os.getenv("XRAY_API_HOST", "127.0.0.1")
+    XRAY_API_PORT: int = int(os.getenv("XRAY_API_PORT", "10085"))
+    XRAY_API_TIMEOUT: float = float(os.getenv("XRAY_API_TIMEOUT", "5"))
+    
+    # Наблюдение за состоянием Xray для /readyz (секунды); pid файл - если API выключен
+    XRAY_WATCH_INTERVAL: float = float(os.getenv("XRAY_WATCH_INTERVAL", "5"))
+    XRAY_PID_FILE: str = os.getenv("XRAY_PID_FILE", "")
+    # Интервал сбора статистики трафика из Xray (секунды)
+    TRAFFIC_COLLECT_INTERVAL: float = float(os.getenv("TRAFFIC_COLLECT_INTERVAL", "60"))
+    # Сроки хранения истории трафика (дни): сырые отсчеты и агрегаты за минуту/час/сутки
+    TRAFFIC_SAMPLES_RETENTION_DAYS: int = int(os.getenv("TRAFFIC_SAMPLES_RETENTION_DAYS", "2"))
+    TRAFFIC_1M_RETENTION_DAYS: int = int(os.getenv("TRAFFIC_1M_RETENTION_DAYS", "7"))
+    TRAFFIC_1H_RETENTION_DAYS: int = int(os.getenv("TRAFFIC_1H_RETENTION_DAYS", "90"))
+    TRAFFIC_1D_RETENTION_DAYS: int = int(os.getenv("TRAFFIC_1D_RETENTION_DAYS", "730"))
+    TRAFFIC_RETENTION_INTERVAL: float = float(os.getenv("TRAFFIC_RETENTION_INTERVAL", "3600"))
+    
+    # Очередь изменений пользователей: окно накопления и максимальный размер пачки
+    XRAY_BATCH_WINDOW_MS: int = int(os.getenv("XRAY_BATCH_WINDOW_MS", "50"))
+    XRAY_BATCH_MAX_SIZE: int = int(os.getenv("XRAY_BATCH_MAX_SIZE", "1000"))
+    
+    # Максимальное количество элементов в одном пакетном запросе
+    BATCH_MAX_SIZE: int = int(os.getenv("BATCH_MAX_SIZE", "10000"))
+    
+    # Кэш ответов GET /users/{uuid} и /traffic/{uuid}: число записей и время жизни (секунды)
+    RESPONSE_CACHE_SIZE: int = int(os.getenv("RESPONSE_CACHE_SIZE", "10000"))
+    RESPONSE_CACHE_TTL: float = float(os.getenv("RESPONSE_CACHE_TTL", "60"))
+    
+    # Сверка пользователей базы с клиентами Xray (секунды)
+    RECONCILE_INTERVAL: float = float(os.getenv("RECONCILE_INTERVAL", "60"))
+    
+    # Проверка сроков действия, обнуление и применение квот трафика (секунды)
+    QUOTA_CHECK_INTERVAL: float = float(os.getenv("QUOTA_CHECK_INTERVAL", "60"))
+    
+    # Удаленные узлы: число одновременных запросов к узлам, таймаут запроса (секунды),
+    # повторы с экспоненциальной задержкой и интервал цикла сходимости (секунды)
+    NODE_FANOUT_CONCURRENCY: int = int(os.getenv("NODE_FANOUT_CONCURRENCY", "8"))
+    NODE_TIMEOUT: float = float(os.getenv("NODE_TIMEOUT", "10"))
+    NODE_RETRIES: int = int(os.getenv("NODE_RETRIES", "2"))
+    NODE_RETRY_BACKOFF: float = float(os.getenv("NODE_RETRY_BACKOFF", "0.5"))
+    NODE_CONVERGE_INTERVAL: float = float(os.getenv("NODE_CONVERGE_INTERVAL", "300"))
+    # Роль экземпляра: controller (главный сервер) или agent (удаленный узел:
+    # клиентов Xray задает главный сервер через /agent/*, сверка с локальной
+    # базой, квоты, сбор трафика и сходимость узлов не запускаются)
+    NODE_ROLE: str = os.getenv("NODE_ROLE", "controller").lower()
+    
+    # Пул потоков для файловых операций (config.json, ключи, резервные копии)
+    IO_EXECUTOR_WORKERS: int = int(os.getenv("IO_EXECUTOR_WORKERS", "4"))
+    # Детектор блокировок цикла событий: порог (мс, 0 - выключен) и период пульса (секунды)
+    LOOP_BLOCK_THRESHOLD_MS: float = float(os.getenv("LOOP_BLOCK_THRESHOLD_MS", "100"))
+    LOOP_MONITOR_INTERVAL: float = float(os.getenv("LOOP_MONITOR_INTERVAL", "0.05"))
     
     # Сервер настройки
     SERVER_HOST: str = os.getenv("SERVER_HOST", "0.0.0.0")
     SERVER_PORT: int = int(os.getenv("SERVER_PORT", "8000"))
+    # Количество процессов uvicorn; фоновые задачи выполняет только ведущий процесс
+    WORKERS: int = int(os.getenv("WORKERS", "1"))
+    # Как часто процессы проверяют изменения ключей и узлов, сделанные другими
+    # процессами, и пытаются стать ведущим (секунды)
+    SHARED_STATE_REFRESH_INTERVAL: float = float(os.getenv("SHARED_STATE_REFRESH_INTERVAL", "5"))
+    LEADER_RETRY_INTERVAL: float = float(os.getenv("LEADER_RETRY_INTERVAL", "5"))
     
     # VLESS настройки по умолчанию
     DEFAULT_PORT: int = int(os.getenv("DEFAULT_PORT", "443"))
@@ -33,6 +129,12 @@ class Settings:
     DEFAULT_SNI: str = os.getenv("DEFAULT_SNI", "www.google.com")
     DEFAULT_FP: str = os.getenv("DEFAULT_FP", "chrome")
     
+    # Ссылки и подписки: адрес сервера для клиентов, название подключения,
+    # публичный ключ Reality (если не задан - вычисляется из privateKey конфигурации)
+    PUBLIC_HOST: str = os.getenv("PUBLIC_HOST", "")
+    LINK_REMARK: str = os.getenv("LINK_REMARK", "DeltaVPN")
+    REALITY_PUBLIC_KEY: str = os.getenv("REALITY_PUBLIC_KEY", "")
+    
     # Директории
     DATA_DIR: Path = Path(os.getenv("DATA_DIR", "./data"))
     LOGS_DIR: Path = Path(os.getenv("LOGS_DIR", "./logs"))
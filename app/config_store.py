@@ -0,0 +1,224 @@
+import gzip
+import logging
+import os
+import re
+import tempfile
+import time
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+try:
+    import zstandard
+except ImportError:  # zstandard не установлен - доступно только gzip сжатие
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# Политики fsync при записи конфигурации
+FSYNC_ALWAYS = "always"
+FSYNC_BATCHED = "batched"
+FSYNC_NEVER = "never"
+
+# Расширения файлов резервных копий по типу сжатия
+COMPRESSION_SUFFIXES = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+
+def _fsync_path(path: Path) -> None:
+    """Зафиксировать на диске файл или каталог (для каталога - переименования в нем)"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path: Path, data: bytes, fsync: bool = True) -> None:
+    """Атомарно записать файл: временный файл рядом + os.replace.
+    
+    При сбое посередине записи на месте остается старая версия файла.
+    Права доступа существующего файла сохраняются.
+    """
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        
+        try:
+            os.chmod(tmp_path, path.stat().st_mode & 0o7777)
+        except FileNotFoundError:
+            os.chmod(tmp_path, 0o644)
+        
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    
+    if fsync:
+        _fsync_path(path.parent)
+
+
+class FsyncPolicy:
+    """Решает, нужен ли fsync для очередной записи.
+    
+    always  - fsync при каждой записи (максимальная надежность);
+    batched - не чаще раза в interval секунд, пропущенная запись
+              синхронизируется отложенно (flush_pending);
+    never   - только os.replace, без fsync (минимальная задержка).
+    """
+    
+    def __init__(self, policy: str = FSYNC_ALWAYS, interval: float = 1.0):
+        if policy not in (FSYNC_ALWAYS, FSYNC_BATCHED, FSYNC_NEVER):
+            logger.warning(f"Неизвестная политика fsync '{policy}', используется '{FSYNC_ALWAYS}'")
+            policy = FSYNC_ALWAYS
+        self.policy = policy
+        self.interval = interval
+        self._last_sync = 0.0
+        self._pending: Optional[Path] = None
+    
+    def should_sync(self) -> bool:
+        """Нужно ли выполнить fsync для текущей записи"""
+        if self.policy == FSYNC_ALWAYS:
+            return True
+        if self.policy == FSYNC_NEVER:
+            return False
+        return time.monotonic() - self._last_sync >= self.interval
+    
+    def record(self, path: Path, synced: bool) -> None:
+        """Отметить выполненную запись"""
+        if synced:
+            self._last_sync = time.monotonic()
+            self._pending = None
+        elif self.policy == FSYNC_BATCHED:
+            self._pending = Path(path)
+    
+    @property
+    def has_pending(self) -> bool:
+        return self._pending is not None
+    
+    def flush_pending(self) -> None:
+        """Синхронизировать последнюю запись, для которой fsync был пропущен"""
+        path, self._pending = self._pending, None
+        if path is None:
+            return
+        try:
+            _fsync_path(path)
+            _fsync_path(path.parent)
+            self._last_sync = time.monotonic()
+        except OSError as e:
+            logger.error(f"Ошибка отложенного fsync {path}: {e}")
+
+
+class BackupRing:
+    """Кольцо из N пронумерованных резервных копий конфигурации.
+    
+    Каждая сохраненная версия получает номер поколения и пишется в файл
+    <config>.bak.<поколение>[.gz|.zst]. Хранятся последние N поколений,
+    откат к любому из них - чтение одного файла по известному пути.
+    
+    При shared=True (копии пишут несколько процессов) список поколений
+    перечитывается с диска перед каждой операцией.
+    """
+    
+    def __init__(self, config_path: str, size: int = 10, compression: str = "gzip", shared: bool = False):
+        if compression == "zstd" and zstandard is None:
+            logger.warning("zstandard не установлен, резервные копии сжимаются gzip")
+            compression = "gzip"
+        if compression not in COMPRESSION_SUFFIXES:
+            logger.warning(f"Неизвестный тип сжатия '{compression}', резервные копии не сжимаются")
+            compression = "none"
+        
+        self.config_path = Path(config_path)
+        self.size = max(size, 1)
+        self.compression = compression
+        self.shared = shared
+        # поколение -> путь к файлу, в порядке возрастания поколений
+        self._generations: "OrderedDict[int, Path]" = OrderedDict()
+        self._scan()
+    
+    def _scan(self) -> None:
+        """Найти существующие резервные копии на диске"""
+        pattern = re.compile(re.escape(self.config_path.name) + r"\.bak\.(\d+)(\.gz|\.zst)?$")
+        found = {}
+        if self.config_path.parent.exists():
+            for path in self.config_path.parent.iterdir():
+                match = pattern.match(path.name)
+                if match:
+                    found[int(match.group(1))] = path
+        self._generations = OrderedDict(sorted(found.items()))
+    
+    @property
+    def latest(self) -> Optional[int]:
+        """Номер последнего поколения"""
+        return next(reversed(self._generations), None)
+    
+    def _compress(self, data: bytes) -> bytes:
+        if self.compression == "gzip":
+            return gzip.compress(data, compresslevel=6)
+        if self.compression == "zstd":
+            return zstandard.ZstdCompressor().compress(data)
+        return data
+    
+    @staticmethod
+    def _decompress(path: Path, data: bytes) -> bytes:
+        if path.suffix == ".gz":
+            return gzip.decompress(data)
+        if path.suffix == ".zst":
+            return zstandard.ZstdDecompressor().decompress(data)
+        return data
+    
+    def add(self, data: bytes) -> int:
+        """Сохранить новую версию конфигурации, вернуть номер поколения"""
+        if self.shared:
+            self._scan()
+        generation = (self.latest or 0) + 1
+        suffix = COMPRESSION_SUFFIXES[self.compression]
+        path = self.config_path.with_name(f"{self.config_path.name}.bak.{generation}{suffix}")
+        
+        atomic_write(path, self._compress(data), fsync=False)
+        self._generations[generation] = path
+        
+        # Удаляем самые старые поколения сверх размера кольца
+        while len(self._generations) > self.size:
+            _, old_path = self._generations.popitem(last=False)
+            try:
+                old_path.unlink()
+            except OSError as e:
+                logger.warning(f"Не удалось удалить старую резервную копию {old_path}: {e}")
+        
+        return generation
+    
+    def read(self, generation: int) -> Optional[bytes]:
+        """Прочитать версию конфигурации указанного поколения"""
+        if self.shared:
+            self._scan()
+        path = self._generations.get(generation)
+        if path is None:
+            return None
+        return self._decompress(path, path.read_bytes())
+    
+    def list(self) -> List[Dict]:
+        """Список доступных поколений (от новых к старым)"""
+        if self.shared:
+            self._scan()
+        result = []
+        for generation, path in reversed(self._generations.items()):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            result.append({
+                "generation": generation,
+                "file": path.name,
+                "size": stat.st_size,
+                "created_at": datetime.fromtimestamp(stat.st_mtime).isoformat()
+            })
+        return result
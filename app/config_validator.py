@@ -0,0 +1,122 @@
+import hashlib
+import json
+import uuid
+from typing import Dict, List
+
+# Допустимые значения flow клиентов VLESS
+VLESS_FLOWS = ("", "xtls-rprx-vision", "xtls-rprx-vision-udp443")
+
+# Максимальная длина id клиента, не являющегося UUID (Xray преобразует его в UUIDv5)
+MAX_CUSTOM_ID_BYTES = 30
+
+# Сколько ошибок возвращать (остальные не нужны, чтобы отклонить конфигурацию)
+MAX_ERRORS = 20
+
+
+def _is_valid_id(value) -> bool:
+    if not isinstance(value, str) or not value:
+        return False
+    try:
+        uuid.UUID(value)
+        return True
+    except ValueError:
+        return len(value.encode("utf-8")) <= MAX_CUSTOM_ID_BYTES
+
+
+def _check_port(port, where: str, errors: List[str]) -> None:
+    # Строковые порты (диапазоны, env:) проверяет сам Xray
+    if isinstance(port, bool) or not isinstance(port, (int, str)):
+        errors.append(f"{where}: порт должен быть числом или строкой")
+    elif isinstance(port, int) and not 0 < port < 65536:
+        errors.append(f"{where}: порт {port} вне диапазона 1-65535")
+
+
+def _check_clients(clients, where: str, errors: List[str]) -> None:
+    if not isinstance(clients, list):
+        errors.append(f"{where}: clients должен быть списком")
+        return
+    emails = set()
+    for index, client in enumerate(clients):
+        if len(errors) >= MAX_ERRORS:
+            return
+        if not isinstance(client, dict):
+            errors.append(f"{where}: клиент {index} должен быть объектом")
+            continue
+        if not _is_valid_id(client.get("id")):
+            errors.append(f"{where}: клиент {index}: неверный id {client.get('id')!r}")
+        if client.get("flow", "") not in VLESS_FLOWS:
+            errors.append(f"{where}: клиент {index}: неизвестный flow {client.get('flow')!r}")
+        email = client.get("email")
+        if email is not None and not isinstance(email, str):
+            errors.append(f"{where}: клиент {index}: email должен быть строкой")
+        elif email:
+            # Xray не запускается с двумя клиентами inbound с одинаковым email
+            key = email.lower()
+            if key in emails:
+                errors.append(f"{where}: повторяющийся email клиента {email}")
+            emails.add(key)
+
+
+def _check_handlers(handlers, section: str, errors: List[str]) -> None:
+    if not isinstance(handlers, list):
+        errors.append(f"{section} должен быть списком")
+        return
+    tags = set()
+    for index, handler in enumerate(handlers):
+        where = f"{section}[{index}]"
+        if not isinstance(handler, dict):
+            errors.append(f"{where} должен быть объектом")
+            continue
+        if not isinstance(handler.get("protocol"), str) or not handler["protocol"]:
+            errors.append(f"{where}: не указан protocol")
+        tag = handler.get("tag")
+        if tag:
+            if tag in tags:
+                errors.append(f"{where}: повторяющийся тег {tag}")
+            tags.add(tag)
+        if section != "inbounds":
+            continue
+        if "port" in handler:
+            _check_port(handler["port"], where, errors)
+        settings = handler.get("settings")
+        if settings is not None and not isinstance(settings, dict):
+            errors.append(f"{where}: settings должен быть объектом")
+        elif handler.get("protocol") == "vless" and settings:
+            _check_clients(settings.get("clients", []), where, errors)
+
+
+def validate_config(config) -> List[str]:
+    """Проверить конфигурацию Xray на частые ошибки схемы без запуска xray -test.
+    
+    Проверяются типы разделов, протоколы и уникальность тегов inbound и
+    outbound, порты и клиенты VLESS (id, flow, уникальность email) - то,
+    что меняют операции сервиса. Пустой список - ошибок не найдено;
+    полную проверку по-прежнему выполняет xray -test.
+    """
+    if not isinstance(config, dict):
+        return ["конфигурация должна быть объектом"]
+    errors: List[str] = []
+    for section in ("inbounds", "outbounds"):
+        if section in config:
+            _check_handlers(config[section], section, errors)
+    for section in ("log", "api", "routing", "policy", "stats"):
+        if section in config and not isinstance(config[section], dict):
+            errors.append(f"{section} должен быть объектом")
+    return errors[:MAX_ERRORS]
+
+
+def structure_signature(config: Dict) -> str:
+    """Хеш конфигурации без списков клиентов VLESS inbound.
+    
+    Совпадение подписи означает, что изменились только клиенты: их
+    проверяет validate_config, и повторный xray -test не нужен.
+    """
+    inbounds = []
+    for inbound in config.get("inbounds", []):
+        settings = inbound.get("settings") if isinstance(inbound, dict) else None
+        if inbound.get("protocol") == "vless" and isinstance(settings, dict) and "clients" in settings:
+            inbound = {**inbound, "settings": {**settings, "clients": None}}
+        inbounds.append(inbound)
+    structure = {**config, "inbounds": inbounds}
+    data = json.dumps(structure, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
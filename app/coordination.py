@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator, Awaitable, Callable, List, Optional
+
+from .config import settings
+from .executor import run_io
+
+try:
+    import fcntl
+except ImportError:  # не POSIX - блокировки между процессами недоступны
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class FileLock:
+    """Эксклюзивная блокировка файла (flock), общая для всех процессов сервиса.
+    
+    Защищает config.json, когда приложение запущено в нескольких процессах
+    (uvicorn --workers): внутри процесса запись упорядочивает asyncio.Lock,
+    между процессами - эта блокировка. Ожидание блокировки выполняется в
+    пуле потоков, чтобы не останавливать цикл событий.
+    """
+    
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self._fd: Optional[int] = None
+    
+    def _open(self) -> int:
+        if self._fd is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        return self._fd
+    
+    async def acquire(self) -> None:
+        if fcntl is None:
+            return
+        await run_io(fcntl.flock, self._open(), fcntl.LOCK_EX)
+    
+    def release(self) -> None:
+        if fcntl is None or self._fd is None:
+            return
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+    
+    async def __aenter__(self) -> "FileLock":
+        await self.acquire()
+        return self
+    
+    async def __aexit__(self, *exc) -> None:
+        self.release()
+
+
+class SharedFileLock:
+    """Блокировка чтения-записи (flock LOCK_SH/LOCK_EX) между процессами.
+    
+    Каждый захват открывает свой дескриптор файла, поэтому блокировки
+    разных корутин одного процесса не сливаются в одну (flock действует
+    на открытый файл, а не на процесс) и работают так же, как между
+    процессами. Занятая блокировка ожидается неблокирующими попытками с
+    нарастающей паузой в цикле событий, а не в пуле потоков: держатель
+    эксклюзивной блокировки сам использует пул (чтение и запись
+    конфигурации), и ожидающие не должны занимать его потоки.
+    
+    Пока в процессе ждет эксклюзивная блокировка, новые общие блокировки
+    этого процесса ее пропускают, чтобы поток операций не откладывал
+    сверку бесконечно.
+    """
+    
+    # Пауза между попытками захвата (секунды): начальная и наибольшая
+    RETRY_MIN = 0.005
+    RETRY_MAX = 0.1
+    
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self._exclusive_waiters = 0
+    
+    def _open(self) -> int:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        return os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+    
+    @asynccontextmanager
+    async def _hold(self, operation: int) -> AsyncIterator[None]:
+        if fcntl is None:
+            yield
+            return
+        exclusive = operation == fcntl.LOCK_EX
+        fd = self._open()
+        try:
+            if exclusive:
+                self._exclusive_waiters += 1
+            try:
+                delay = self.RETRY_MIN
+                while True:
+                    if exclusive or not self._exclusive_waiters:
+                        try:
+                            fcntl.flock(fd, operation | fcntl.LOCK_NB)
+                            break
+                        except BlockingIOError:
+                            pass
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.RETRY_MAX)
+            finally:
+                if exclusive:
+                    self._exclusive_waiters -= 1
+            yield
+        finally:
+            # Закрытие дескриптора снимает блокировку (в том числе при отмене ожидания)
+            os.close(fd)
+    
+    def shared(self):
+        """Общая блокировка: совместима с другими общими, исключает эксклюзивную"""
+        return self._hold(fcntl.LOCK_SH if fcntl else 0)
+    
+    def exclusive(self):
+        """Эксклюзивная блокировка: ждет освобождения всех общих"""
+        return self._hold(fcntl.LOCK_EX if fcntl else 0)
+
+
+class LeaderElection:
+    """Выбор ведущего процесса через неблокирующий flock.
+    
+    Ведущим становится процесс, первым захвативший блокировку файла; он
+    держит ее до завершения. Только ведущий выполняет фоновые задачи,
+    которые нельзя запускать параллельно (сбор трафика со сбросом
+    счетчиков Xray, сверки, очистка истории). Остальные процессы
+    периодически вызывают try_acquire и займут место ведущего, если
+    он завершится - блокировку flock ядро снимает вместе с процессом.
+    """
+    
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.is_leader = False
+        self._fd: Optional[int] = None
+        self._callbacks: List[Callable[[], Awaitable[None]]] = []
+    
+    def on_elected(self, callback: Callable[[], Awaitable[None]]) -> None:
+        """Зарегистрировать корутину, вызываемую при получении роли ведущего"""
+        self._callbacks.append(callback)
+    
+    def _try_lock(self) -> bool:
+        if fcntl is None:
+            return True
+        if self._fd is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        os.ftruncate(self._fd, 0)
+        os.write(self._fd, str(os.getpid()).encode())
+        return True
+    
+    async def try_acquire(self) -> bool:
+        """Попробовать стать ведущим, вернуть True, если процесс ведущий"""
+        if self.is_leader:
+            return True
+        try:
+            acquired = self._try_lock()
+        except OSError as e:
+            logger.error(f"Ошибка блокировки {self.path}: {e}")
+            return False
+        if not acquired:
+            return False
+        
+        self.is_leader = True
+        logger.info(f"Процесс {os.getpid()} стал ведущим")
+        for callback in self._callbacks:
+            try:
+                await callback()
+            except Exception as e:
+                logger.error(f"Ошибка запуска задач ведущего процесса: {e}")
+        return True
+    
+    async def run(self) -> None:
+        """Повторная попытка стать ведущим (для фоновой задачи)"""
+        await self.try_acquire()
+    
+    def release(self) -> None:
+        """Отказаться от роли ведущего (при остановке процесса)"""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self.is_leader = False
+
+
+# Выбор ведущего среди процессов сервиса
+leader = LeaderElection(settings.DATA_DIR / "leader.lock")
+
+# Согласованность состояния пользователей в Xray и в базе: изменения,
+# затрагивающие и Xray, и базу, держат общую блокировку, сверка - эксклюзивную
+users_lock = SharedFileLock(settings.DATA_DIR / "users.lock")
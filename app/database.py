@@ -1,26 +1,179 @@
 import aiosqlite
+import asyncio
 import json
+import logging
+import time
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import List, Optional
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
 from pathlib import Path
 
-from .models import User, UserStatus
+from .cache import CACHE_TRAFFIC, response_cache
+from .metrics import db_query_duration, db_query_errors, timed_methods
+from .migrations import MIGRATIONS
+from .models import ResetPeriod, SuspendReason, User, UserStatus
 from .config import settings
 
+logger = logging.getLogger(__name__)
+
+# Уровни агрегации истории трафика (секунды): минута, час, сутки
+TRAFFIC_ROLLUP_RESOLUTIONS = (60, 3600, 86400)
+
+# Максимум параметров в одном IN (...) - ограничение старых версий SQLite
+SQLITE_MAX_IN_PARAMS = 500
+
+# Сколько строк читать из курсора за раз при потоковой выдаче
+USERS_FETCH_CHUNK = 500
+
+def _chunks(items: List[str], size: int = SQLITE_MAX_IN_PARAMS) -> Iterable[List[str]]:
+    """Разбить список на части для запросов с IN (...)"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _iso(value: Optional[datetime]) -> Optional[str]:
+    """Дата для хранения в базе (None - не задана)"""
+    return value.isoformat() if value else None
+
+def _from_iso(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+def _row_to_user(row) -> User:
+    """Построить пользователя из строки таблицы users"""
+    return User(
+        uuid=row['uuid'],
+        name=row['name'],
+        email=row['email'],
+        status=UserStatus(row['status']),
+        created_at=datetime.fromisoformat(row['created_at']),
+        updated_at=datetime.fromisoformat(row['updated_at']),
+        sub_token=row['sub_token'],
+        traffic_limit=row['traffic_limit'],
+        expires_at=_from_iso(row['expires_at']),
+        reset_period=ResetPeriod(row['reset_period']) if row['reset_period'] else None,
+        next_reset_at=_from_iso(row['next_reset_at']),
+        suspend_reason=SuspendReason(row['suspend_reason']) if row['suspend_reason'] else None,
+        reset_anchor=_from_iso(row['reset_anchor'])
+    )
+
+def _user_params(user: User) -> tuple:
+    """Значения столбцов для INSERT INTO users"""
+    return (
+        user.uuid, user.name, user.email, user.status.value,
+        user.created_at.isoformat(), user.updated_at.isoformat(), user.sub_token,
+        user.traffic_limit, _iso(user.expires_at),
+        user.reset_period.value if user.reset_period else None, _iso(user.next_reset_at),
+        _iso(user.reset_anchor)
+    )
+
+# Столбцы, которые заполняет _user_params
+USER_INSERT = """
+    INSERT INTO users (uuid, name, email, status, created_at, updated_at, sub_token,
+                       traffic_limit, expires_at, reset_period, next_reset_at, reset_anchor)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
 class Database:
     """Класс для работы с SQLite базой данных"""
     
-    def __init__(self, db_path: str = None):
+    def __init__(self, db_path: str = None, pool_size: int = None):
         if db_path is None:
             db_path = str(settings.DATA_DIR / "xray_manager.db")
         self.db_path = db_path
+        self.pool_size = pool_size or settings.DB_POOL_SIZE
+        
+        # Единственное соединение для записи (SQLite допускает одного писателя)
+        # и пул соединений для чтения, которые в режиме WAL не ждут писателя
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._readers: Optional[asyncio.Queue] = None
+        self._reader_connections: List[aiosqlite.Connection] = []
+        self._pool_lock = asyncio.Lock()
+    
+    async def _connect(self) -> aiosqlite.Connection:
+        """Открыть соединение с настройками производительности"""
+        # cached_statements - размер кэша подготовленных выражений соединения
+        conn = await aiosqlite.connect(
+            self.db_path, cached_statements=settings.DB_STATEMENT_CACHE_SIZE
+        )
+        conn.row_factory = aiosqlite.Row
+        await conn.execute("PRAGMA journal_mode=WAL")
+        await conn.execute("PRAGMA synchronous=NORMAL")
+        await conn.execute(f"PRAGMA busy_timeout={settings.DB_BUSY_TIMEOUT_MS}")
+        return conn
+    
+    @property
+    def is_open(self) -> bool:
+        """Открыт ли пул соединений"""
+        return self._writer is not None
+    
+    async def _open_pool(self) -> None:
+        """Открыть пул соединений (если еще не открыт)"""
+        if self._writer is not None:
+            return
         
+        async with self._pool_lock:
+            if self._writer is not None:
+                return
+            
+            # Создаем директорию если не существует
+            Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+            
+            # Писатель открывается первым и переводит базу в режим WAL
+            writer = await self._connect()
+            readers = asyncio.Queue()
+            connections = []
+            for _ in range(self.pool_size):
+                conn = await self._connect()
+                connections.append(conn)
+                readers.put_nowait(conn)
+            
+            self._readers = readers
+            self._reader_connections = connections
+            self._writer = writer
+            logger.info(f"Открыт пул SQLite: 1 писатель, {self.pool_size} читателей")
+    
+    async def close(self) -> None:
+        """Закрыть все соединения пула"""
+        async with self._pool_lock:
+            if self._writer is None:
+                return
+            
+            async with self._write_lock:
+                await self._writer.close()
+            for conn in self._reader_connections:
+                await conn.close()
+            
+            self._writer = None
+            self._readers = None
+            self._reader_connections = []
+    
+    @asynccontextmanager
+    async def _read(self):
+        """Взять соединение для чтения из пула"""
+        await self._open_pool()
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+    
+    @asynccontextmanager
+    async def _write(self):
+        """Получить соединение писателя; транзакция фиксируется при выходе"""
+        await self._open_pool()
+        async with self._write_lock:
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except BaseException:
+                await self._writer.rollback()
+                raise
+    
     async def init_db(self):
         """Инициализация базы данных"""
-        # Создаем директорию если не существует
-        Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+        await self._open_pool()
         
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute("""
                 CREATE TABLE IF NOT EXISTS users (
                     uuid TEXT PRIMARY KEY,
@@ -50,76 +203,253 @@ class Database:
                 )
             """)
             
-            await db.commit()
+            # Сырые отсчеты трафика (append-only), по одному на пользователя за сбор
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS traffic_samples (
+                    uuid TEXT NOT NULL,
+                    ts INTEGER NOT NULL,
+                    upload INTEGER NOT NULL DEFAULT 0,
+                    download INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (uuid, ts)
+                ) WITHOUT ROWID
+            """)
+            await db.execute("""
+                CREATE INDEX IF NOT EXISTS idx_traffic_samples_ts ON traffic_samples (ts)
+            """)
+            
+            # Агрегаты трафика по корзинам времени: 1 минута, 1 час, 1 сутки.
+            # Ключ (uuid, resolution, bucket) хранит историю пользователя рядом на диске
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS traffic_rollup (
+                    uuid TEXT NOT NULL,
+                    resolution INTEGER NOT NULL,
+                    bucket INTEGER NOT NULL,
+                    upload INTEGER NOT NULL DEFAULT 0,
+                    download INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (uuid, resolution, bucket)
+                ) WITHOUT ROWID
+            """)
+            await db.execute("""
+                CREATE INDEX IF NOT EXISTS idx_traffic_rollup_bucket ON traffic_rollup (resolution, bucket)
+            """)
+            
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TEXT NOT NULL
+                )
+            """)
+        
+        await self.migrate()
+    
+    async def get_schema_version(self) -> int:
+        """Номер последней примененной миграции"""
+        async with self._read() as db:
+            cursor = await db.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+            row = await cursor.fetchone()
+            return row[0]
+    
+    async def migrate(self) -> int:
+        """Применить недостающие миграции схемы, вернуть итоговую версию"""
+        version = await self.get_schema_version()
+        for migration in MIGRATIONS:
+            if migration.version <= version:
+                continue
+            
+            # Каждый шаг и запись о нем - одна транзакция. BEGIN IMMEDIATE и
+            # повторная проверка версии: несколько процессов могут запускать
+            # миграции одновременно, шаг применит только первый
+            async with self._write() as db:
+                await db.execute("BEGIN IMMEDIATE")
+                cursor = await db.execute(
+                    "SELECT 1 FROM schema_version WHERE version = ?", (migration.version,)
+                )
+                if await cursor.fetchone():
+                    version = migration.version
+                    continue
+                await migration.apply(db)
+                await db.execute("""
+                    INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)
+                """, (migration.version, migration.name, datetime.utcnow().isoformat()))
+            
+            version = migration.version
+            logger.info(f"Применена миграция схемы {version}: {migration.name}")
+        return version
     
     async def create_user(self, user: User) -> User:
         """Создать нового пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("""
-                INSERT INTO users (uuid, name, email, status, created_at, updated_at)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (
-                user.uuid, user.name, user.email, user.status.value,
-                user.created_at.isoformat(), user.updated_at.isoformat()
-            ))
+        async with self._write() as db:
+            await db.execute(USER_INSERT, _user_params(user))
             
             # Инициализируем трафик
             await db.execute("""
                 INSERT INTO traffic (uuid, upload, download, last_updated)
                 VALUES (?, 0, 0, ?)
             """, (user.uuid, datetime.utcnow().isoformat()))
+        
+        response_cache.invalidate(user.uuid)
+        return user
+    
+    async def create_users(self, users: List[User]) -> List[User]:
+        """Создать пачку пользователей одной транзакцией"""
+        now = datetime.utcnow().isoformat()
+        async with self._write() as db:
+            await db.executemany(USER_INSERT, [_user_params(user) for user in users])
             
-            await db.commit()
-            return user
+            # Инициализируем трафик
+            await db.executemany("""
+                INSERT INTO traffic (uuid, upload, download, last_updated)
+                VALUES (?, 0, 0, ?)
+            """, [(user.uuid, now) for user in users])
+        
+        response_cache.invalidate(*(user.uuid for user in users))
+        return users
+    
+    async def get_users(self, uuids: List[str]) -> Dict[str, User]:
+        """Получить пользователей по списку UUID"""
+        result = {}
+        async with self._read() as db:
+            for chunk in _chunks(uuids):
+                placeholders = ",".join("?" * len(chunk))
+                cursor = await db.execute(
+                    f"SELECT * FROM users WHERE uuid IN ({placeholders})", chunk
+                )
+                for row in await cursor.fetchall():
+                    result[row['uuid']] = _row_to_user(row)
+        return result
+    
+    async def find_emails(self, emails: List[str]) -> set:
+        """Какие из указанных email уже заняты"""
+        result = set()
+        async with self._read() as db:
+            for chunk in _chunks(emails):
+                placeholders = ",".join("?" * len(chunk))
+                cursor = await db.execute(
+                    f"SELECT email FROM users WHERE email IN ({placeholders})", chunk
+                )
+                result.update(row['email'] for row in await cursor.fetchall())
+        return result
+    
+    async def get_uuids_by_client_emails(self, emails: List[str]) -> Dict[str, str]:
+        """UUID пользователей по email их клиентов Xray.
+        
+        Клиент пользователя без email называется user_<первые 8 символов uuid>
+        (XrayManager._client_email), такие ищутся по префиксу uuid среди
+        пользователей без email; неоднозначный префикс не сопоставляется.
+        """
+        result = {}
+        generated = [email for email in emails if email.startswith("user_") and len(email) == 13]
+        async with self._read() as db:
+            for chunk in _chunks(emails):
+                placeholders = ",".join("?" * len(chunk))
+                cursor = await db.execute(
+                    f"SELECT email, uuid FROM users WHERE email IN ({placeholders})", chunk
+                )
+                result.update((row['email'], row['uuid']) for row in await cursor.fetchall())
+            for email in generated:
+                if email in result:
+                    continue
+                cursor = await db.execute(
+                    "SELECT uuid FROM users WHERE email IS NULL AND uuid LIKE ? LIMIT 2",
+                    (email[5:] + "%",)
+                )
+                rows = await cursor.fetchall()
+                if len(rows) == 1:
+                    result[email] = rows[0]['uuid']
+        return result
+    
+    async def get_active_uuids(self) -> set:
+        """UUID всех активных пользователей"""
+        async with self._read() as db:
+            cursor = await db.execute(
+                "SELECT uuid FROM users WHERE status = ?", (UserStatus.ACTIVE.value,)
+            )
+            result = set()
+            while True:
+                rows = await cursor.fetchmany(USERS_FETCH_CHUNK)
+                if not rows:
+                    return result
+                result.update(row[0] for row in rows)
+    
+    async def get_generation(self, name: str = "users") -> int:
+        """Номер поколения данных (увеличивается триггерами при изменениях)"""
+        async with self._read() as db:
+            cursor = await db.execute("SELECT value FROM generations WHERE name = ?", (name,))
+            row = await cursor.fetchone()
+            return row[0] if row else 0
     
     async def get_user(self, uuid: str) -> Optional[User]:
         """Получить пользователя по UUID"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             cursor = await db.execute("""
                 SELECT * FROM users WHERE uuid = ?
             """, (uuid,))
             row = await cursor.fetchone()
             
             if row:
-                return User(
-                    uuid=row['uuid'],
-                    name=row['name'],
-                    email=row['email'],
-                    status=UserStatus(row['status']),
-                    created_at=datetime.fromisoformat(row['created_at']),
-                    updated_at=datetime.fromisoformat(row['updated_at'])
-                )
+                return _row_to_user(row)
             return None
     
-    async def get_all_users(self, status: Optional[UserStatus] = None) -> List[User]:
-        """Получить всех пользователей"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+    async def get_user_by_sub_token(self, token: str) -> Optional[User]:
+        """Получить пользователя по токену подписки"""
+        async with self._read() as db:
+            cursor = await db.execute("SELECT * FROM users WHERE sub_token = ?", (token,))
+            row = await cursor.fetchone()
+            return _row_to_user(row) if row else None
+    
+    async def iter_users(self, status: Optional[UserStatus] = None, email: Optional[str] = None,
+                         name: Optional[str] = None, after: Optional[Tuple[str, str]] = None,
+                         limit: Optional[int] = None) -> AsyncIterator[User]:
+        """Перебрать пользователей от новых к старым с keyset пагинацией.
+        
+        Порядок - (created_at, uuid) по убыванию. after - ключ (created_at, uuid)
+        последнего полученного пользователя, выдача продолжается строго после него.
+        name - префикс имени. Строки читаются страницами по USERS_FETCH_CHUNK:
+        соединение берется из пула на время чтения страницы и возвращается
+        до выдачи ее пользователей, поэтому медленный потребитель (клиент
+        потоковой выдачи) не держит соединение, а память не зависит от
+        количества пользователей.
+        """
+        conditions = []
+        params = []
+        if status:
+            conditions.append("status = ?")
+            params.append(status.value)
+        if email:
+            conditions.append("email = ?")
+            params.append(email)
+        if name:
+            # Префикс задается диапазоном, а не LIKE, чтобы использовался индекс
+            conditions.append("name >= ? AND name < ?")
+            params.extend((name, name + "\U0010ffff"))
+        
+        remaining = limit
+        while remaining is None or remaining > 0:
+            page_size = USERS_FETCH_CHUNK if remaining is None else min(remaining, USERS_FETCH_CHUNK)
+            page_conditions = list(conditions)
+            page_params = list(params)
+            if after:
+                page_conditions.append("(created_at, uuid) < (?, ?)")
+                page_params.extend(after)
             
-            if status:
-                cursor = await db.execute("""
-                    SELECT * FROM users WHERE status = ? ORDER BY created_at DESC
-                """, (status.value,))
-            else:
-                cursor = await db.execute("""
-                    SELECT * FROM users ORDER BY created_at DESC
-                """)
+            query = "SELECT * FROM users"
+            if page_conditions:
+                query += " WHERE " + " AND ".join(page_conditions)
+            query += " ORDER BY created_at DESC, uuid DESC LIMIT ?"
+            page_params.append(page_size)
             
-            rows = await cursor.fetchall()
-            users = []
+            async with self._read() as db:
+                cursor = await db.execute(query, page_params)
+                rows = await cursor.fetchall()
             
             for row in rows:
-                users.append(User(
-                    uuid=row['uuid'],
-                    name=row['name'],
-                    email=row['email'],
-                    status=UserStatus(row['status']),
-                    created_at=datetime.fromisoformat(row['created_at']),
-                    updated_at=datetime.fromisoformat(row['updated_at'])
-                ))
-            
-            return users
+                yield _row_to_user(row)
+            if len(rows) < page_size:
+                return
+            after = (rows[-1]['created_at'], rows[-1]['uuid'])
+            if remaining is not None:
+                remaining -= len(rows)
     
     async def update_user(self, uuid: str, **kwargs) -> Optional[User]:
         """Обновить пользователя"""
@@ -134,98 +464,424 @@ class Database:
             user.email = kwargs['email']
         if 'status' in kwargs:
             user.status = kwargs['status']
+        for field in ('traffic_limit', 'expires_at', 'reset_period', 'next_reset_at', 'reset_anchor'):
+            if field in kwargs:
+                setattr(user, field, kwargs[field])
         
         user.updated_at = datetime.utcnow()
         
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute("""
                 UPDATE users 
-                SET name = ?, email = ?, status = ?, updated_at = ?
+                SET name = ?, email = ?, status = ?, updated_at = ?,
+                    traffic_limit = ?, expires_at = ?, reset_period = ?, next_reset_at = ?,
+                    reset_anchor = ?
                 WHERE uuid = ?
             """, (
-                user.name, user.email, user.status.value,
-                user.updated_at.isoformat(), uuid
+                user.name, user.email, user.status.value, user.updated_at.isoformat(),
+                user.traffic_limit, _iso(user.expires_at),
+                user.reset_period.value if user.reset_period else None, _iso(user.next_reset_at),
+                _iso(user.reset_anchor), uuid
             ))
-            await db.commit()
         
+        response_cache.invalidate(uuid)
         return user
     
     async def delete_user(self, uuid: str) -> bool:
         """Удалить пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
-            # Удаляем трафик
+        async with self._write() as db:
+            # Удаляем трафик и его историю
             await db.execute("DELETE FROM traffic WHERE uuid = ?", (uuid,))
+            await db.execute("DELETE FROM traffic_samples WHERE uuid = ?", (uuid,))
+            await db.execute("DELETE FROM traffic_rollup WHERE uuid = ?", (uuid,))
             # Удаляем пользователя
             cursor = await db.execute("DELETE FROM users WHERE uuid = ?", (uuid,))
-            await db.commit()
-            return cursor.rowcount > 0
+        
+        response_cache.invalidate(uuid)
+        return cursor.rowcount > 0
+    
+    async def update_users_status(self, uuids: List[str], status: UserStatus) -> int:
+        """Изменить статус пачки пользователей одной транзакцией.
+        
+        Ручное изменение статуса снимает причину автоматической приостановки.
+        """
+        now = datetime.utcnow().isoformat()
+        async with self._write() as db:
+            cursor = await db.executemany("""
+                UPDATE users SET status = ?, suspend_reason = NULL, updated_at = ? WHERE uuid = ?
+            """, [(status.value, now, uuid) for uuid in uuids])
+        
+        response_cache.invalidate(*uuids)
+        return cursor.rowcount
+    
+    async def delete_users(self, uuids: List[str]) -> int:
+        """Удалить пачку пользователей одной транзакцией"""
+        params = [(uuid,) for uuid in uuids]
+        async with self._write() as db:
+            # Удаляем трафик и его историю
+            await db.executemany("DELETE FROM traffic WHERE uuid = ?", params)
+            await db.executemany("DELETE FROM traffic_samples WHERE uuid = ?", params)
+            await db.executemany("DELETE FROM traffic_rollup WHERE uuid = ?", params)
+            # Удаляем пользователей
+            cursor = await db.executemany("DELETE FROM users WHERE uuid = ?", params)
+        
+        response_cache.invalidate(*uuids)
+        return cursor.rowcount
     
     async def get_traffic(self, uuid: str) -> Optional[dict]:
         """Получить трафик пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             cursor = await db.execute("""
-                SELECT * FROM traffic WHERE uuid = ?
+                SELECT t.*, u.traffic_offset, u.traffic_limit
+                FROM traffic AS t JOIN users AS u ON u.uuid = t.uuid
+                WHERE t.uuid = ?
             """, (uuid,))
             row = await cursor.fetchone()
             
             if row:
+                total = row['upload'] + row['download']
                 return {
                     'uuid': row['uuid'],
                     'upload': row['upload'],
                     'download': row['download'],
-                    'total': row['upload'] + row['download'],
+                    'total': total,
+                    'used': max(total - row['traffic_offset'], 0),
+                    'traffic_limit': row['traffic_limit'],
                     'last_updated': datetime.fromisoformat(row['last_updated'])
                 }
             return None
     
-    async def update_traffic(self, uuid: str, upload: int, download: int) -> bool:
-        """Обновить трафик пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
+    async def add_traffic_batch(self, deltas: List[tuple], timestamp: Optional[int] = None) -> int:
+        """Прибавить приращения трафика пачкой: [(uuid, upload, download), ...].
+        
+        Одной транзакцией обновляются итоги в traffic, добавляются сырые
+        отсчеты и агрегаты всех уровней (минута, час, сутки). Строки создаются
+        только для существующих пользователей.
+        """
+        if not deltas:
+            return 0
+        ts = int(timestamp if timestamp is not None else time.time())
+        now = datetime.utcnow().isoformat()
+        async with self._write() as db:
+            cursor = await db.executemany("""
+                INSERT INTO traffic (uuid, upload, download, last_updated)
+                SELECT ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM users WHERE uuid = ?)
+                ON CONFLICT(uuid) DO UPDATE SET
+                    upload = upload + excluded.upload,
+                    download = download + excluded.download,
+                    last_updated = excluded.last_updated
+            """, [(uuid, upload, download, now, uuid) for uuid, upload, download in deltas])
+            updated = cursor.rowcount
+            
+            await db.executemany("""
+                INSERT INTO traffic_samples (uuid, ts, upload, download)
+                SELECT ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM users WHERE uuid = ?)
+                ON CONFLICT(uuid, ts) DO UPDATE SET
+                    upload = upload + excluded.upload,
+                    download = download + excluded.download
+            """, [(uuid, ts, upload, download, uuid) for uuid, upload, download in deltas])
+            
+            await db.executemany("""
+                INSERT INTO traffic_rollup (uuid, resolution, bucket, upload, download)
+                SELECT ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM users WHERE uuid = ?)
+                ON CONFLICT(uuid, resolution, bucket) DO UPDATE SET
+                    upload = upload + excluded.upload,
+                    download = download + excluded.download
+            """, [
+                (uuid, resolution, ts - ts % resolution, upload, download, uuid)
+                for uuid, upload, download in deltas
+                for resolution in TRAFFIC_ROLLUP_RESOLUTIONS
+            ])
+        
+        response_cache.invalidate(*(uuid for uuid, _, _ in deltas), kinds=(CACHE_TRAFFIC,))
+        return updated
+    
+    async def get_quota_violations(self, now: datetime, uuids: Optional[List[str]] = None) -> Dict[str, SuspendReason]:
+        """Активные пользователи с истекшим сроком или исчерпанной квотой.
+        
+        Один запрос на всю проверку: uuids (например, получившие трафик
+        за последний сбор) передаются одним JSON параметром, без разбиения
+        на части. Без uuids проверяются все активные пользователи.
+        """
+        query = """
+            SELECT u.uuid,
+                   u.expires_at IS NOT NULL AND u.expires_at <= :now AS expired
+            FROM users AS u LEFT JOIN traffic AS t ON t.uuid = u.uuid
+            WHERE u.status = :active
+              AND ((u.expires_at IS NOT NULL AND u.expires_at <= :now)
+                   OR (u.traffic_limit IS NOT NULL
+                       AND COALESCE(t.upload + t.download, 0) - u.traffic_offset >= u.traffic_limit))
+        """
+        params = {"now": now.isoformat(), "active": UserStatus.ACTIVE.value}
+        if uuids is not None:
+            query += " AND u.uuid IN (SELECT value FROM json_each(:uuids))"
+            params["uuids"] = json.dumps(uuids)
+        
+        async with self._read() as db:
+            cursor = await db.execute(query, params)
+            return {
+                row['uuid']: SuspendReason.EXPIRED if row['expired'] else SuspendReason.QUOTA
+                for row in await cursor.fetchall()
+            }
+    
+    async def get_restorable_users(self, now: datetime) -> List[User]:
+        """Автоматически приостановленные пользователи, ограничения которых сняты
+        (квота обнулена или увеличена, срок продлен)"""
+        async with self._read() as db:
             cursor = await db.execute("""
-                UPDATE traffic 
-                SET upload = ?, download = ?, last_updated = ?
+                SELECT u.* FROM users AS u LEFT JOIN traffic AS t ON t.uuid = u.uuid
+                WHERE u.suspend_reason IS NOT NULL AND u.status = ?
+                  AND (u.expires_at IS NULL OR u.expires_at > ?)
+                  AND (u.traffic_limit IS NULL
+                       OR COALESCE(t.upload + t.download, 0) - u.traffic_offset < u.traffic_limit)
+            """, (UserStatus.SUSPENDED.value, now.isoformat()))
+            return [_row_to_user(row) for row in await cursor.fetchall()]
+    
+    async def set_auto_suspended(self, reasons: Dict[str, SuspendReason]) -> int:
+        """Приостановить пользователей с указанием причины (только активных)"""
+        now = datetime.utcnow().isoformat()
+        async with self._write() as db:
+            cursor = await db.executemany("""
+                UPDATE users SET status = ?, suspend_reason = ?, updated_at = ?
+                WHERE uuid = ? AND status = ?
+            """, [
+                (UserStatus.SUSPENDED.value, reason.value, now, uuid, UserStatus.ACTIVE.value)
+                for uuid, reason in reasons.items()
+            ])
+        
+        response_cache.invalidate(*reasons)
+        return cursor.rowcount
+    
+    async def get_due_resets(self, now: datetime) -> List[Tuple[str, datetime, ResetPeriod]]:
+        """Пользователи, у которых наступил срок обнуления квоты: [(uuid, дата отсчета, период), ...]"""
+        async with self._read() as db:
+            cursor = await db.execute("""
+                SELECT uuid, COALESCE(reset_anchor, next_reset_at) AS anchor, reset_period FROM users
+                WHERE next_reset_at IS NOT NULL AND next_reset_at <= ?
+            """, (now.isoformat(),))
+            return [
+                (row['uuid'], datetime.fromisoformat(row['anchor']), ResetPeriod(row['reset_period']))
+                for row in await cursor.fetchall()
+                if row['reset_period']
+            ]
+    
+    async def reset_traffic_quotas(self, schedule: List[Tuple[str, datetime]]) -> int:
+        """Обнулить квоту пачки пользователей: [(uuid, следующее обнуление), ...].
+        
+        Итоги трафика не меняются - смещение квоты приравнивается к текущему
+        итогу, поэтому переписываются только строки этих пользователей.
+        """
+        async with self._write() as db:
+            cursor = await db.executemany("""
+                UPDATE users SET
+                    traffic_offset = COALESCE(
+                        (SELECT upload + download FROM traffic WHERE traffic.uuid = users.uuid), 0
+                    ),
+                    next_reset_at = ?
                 WHERE uuid = ?
-            """, (upload, download, datetime.utcnow().isoformat(), uuid))
-            await db.commit()
-            return cursor.rowcount > 0
+            """, [(_iso(next_reset_at), uuid) for uuid, next_reset_at in schedule])
+        
+        response_cache.invalidate(*(uuid for uuid, _ in schedule))
+        return cursor.rowcount
+    
+    async def get_traffic_history(self, uuid: str, start: int, end: int,
+                                  step: int, resolution: int) -> List[dict]:
+        """Получить историю трафика пользователя из агрегатов указанного уровня.
+        
+        Корзины уровня resolution суммируются в интервалы длиной step
+        на промежутке [start, end).
+        """
+        async with self._read() as db:
+            cursor = await db.execute("""
+                SELECT (bucket / ?) * ? AS ts, SUM(upload) AS upload, SUM(download) AS download
+                FROM traffic_rollup
+                WHERE uuid = ? AND resolution = ? AND bucket >= ? AND bucket < ?
+                GROUP BY ts
+                ORDER BY ts
+            """, (step, step, uuid, resolution, start, end))
+            return [
+                {'ts': row['ts'], 'upload': row['upload'], 'download': row['download']}
+                for row in await cursor.fetchall()
+            ]
+    
+    async def cleanup_traffic_history(self, retention: Dict[int, int], samples_retention: int) -> int:
+        """Удалить устаревшие отсчеты и агрегаты.
+        
+        retention - срок хранения в секундах для каждого уровня агрегации,
+        samples_retention - срок хранения сырых отсчетов.
+        """
+        now = int(time.time())
+        deleted = 0
+        async with self._write() as db:
+            cursor = await db.execute(
+                "DELETE FROM traffic_samples WHERE ts < ?", (now - samples_retention,)
+            )
+            deleted += cursor.rowcount
+            for resolution, keep in retention.items():
+                cursor = await db.execute(
+                    "DELETE FROM traffic_rollup WHERE resolution = ? AND bucket < ?",
+                    (resolution, now - keep)
+                )
+                deleted += cursor.rowcount
+        return deleted
     
     async def get_stats(self) -> dict:
-        """Получить статистику"""
-        async with aiosqlite.connect(self.db_path) as db:
-            # Общее количество пользователей
-            cursor = await db.execute("SELECT COUNT(*) FROM users")
-            total_users = (await cursor.fetchone())[0]
-            
-            # Активные пользователи
-            cursor = await db.execute("SELECT COUNT(*) FROM users WHERE status = ?", (UserStatus.ACTIVE.value,))
-            active_users = (await cursor.fetchone())[0]
-            
-            # Приостановленные пользователи
-            cursor = await db.execute("SELECT COUNT(*) FROM users WHERE status = ?", (UserStatus.SUSPENDED.value,))
-            suspended_users = (await cursor.fetchone())[0]
+        """Получить статистику.
+        
+        Количество пользователей читается из счетчиков user_counters,
+        которые триггеры обновляют в той же транзакции, что и users.
+        """
+        async with self._read() as db:
+            cursor = await db.execute("SELECT status, count FROM user_counters")
+            counters = {row['status']: row['count'] for row in await cursor.fetchall()}
+        
+        return {
+            'total_users': sum(counters.values()),
+            'active_users': counters.get(UserStatus.ACTIVE.value, 0),
+            'suspended_users': counters.get(UserStatus.SUSPENDED.value, 0)
+        }
+    
+    async def reconcile_user_counters(self) -> int:
+        """Сверить счетчики пользователей с таблицей users и исправить расхождения.
+        
+        Возвращает количество исправленных счетчиков.
+        """
+        async with self._write() as db:
+            cursor = await db.execute("SELECT status, COUNT(*) AS count FROM users GROUP BY status")
+            actual = {row['status']: row['count'] for row in await cursor.fetchall()}
+            cursor = await db.execute("SELECT status, count FROM user_counters")
+            stored = {row['status']: row['count'] for row in await cursor.fetchall()}
             
+            fixes = [
+                (status, actual.get(status, 0))
+                for status in set(actual) | set(stored)
+                if actual.get(status, 0) != stored.get(status, 0)
+            ]
+            for status, count in fixes:
+                logger.warning(
+                    f"Счетчик пользователей '{status}' расходится: {stored.get(status, 0)}, фактически {count}"
+                )
+            if fixes:
+                await db.executemany("""
+                    INSERT INTO user_counters (status, count) VALUES (?, ?)
+                    ON CONFLICT (status) DO UPDATE SET count = excluded.count
+                """, fixes)
+            return len(fixes)
+    
+    async def create_node(self, node_id: str, name: str, url: str, api_key: str) -> Dict:
+        """Зарегистрировать удаленный узел"""
+        node = {
+            "id": node_id, "name": name, "url": url, "api_key": api_key,
+            "enabled": True, "created_at": datetime.utcnow().isoformat()
+        }
+        async with self._write() as db:
+            await db.execute("""
+                INSERT INTO nodes (id, name, url, api_key, enabled, created_at)
+                VALUES (?, ?, ?, ?, 1, ?)
+            """, (node_id, name, url, api_key, node["created_at"]))
+        return node
+    
+    async def get_nodes(self) -> List[Dict]:
+        """Получить все удаленные узлы"""
+        async with self._read() as db:
+            cursor = await db.execute("SELECT * FROM nodes ORDER BY created_at")
+            return [
+                {**dict(row), "enabled": bool(row['enabled'])}
+                for row in await cursor.fetchall()
+            ]
+    
+    async def delete_node(self, node_id: str) -> bool:
+        """Удалить удаленный узел"""
+        async with self._write() as db:
+            cursor = await db.execute("DELETE FROM nodes WHERE id = ?", (node_id,))
+            return cursor.rowcount > 0
+    
+    async def get_api_keys(self) -> Dict[str, Dict]:
+        """Получить все API ключи: хеш -> данные ключа"""
+        async with self._read() as db:
+            cursor = await db.execute("SELECT * FROM api_keys")
             return {
-                'total_users': total_users,
-                'active_users': active_users,
-                'suspended_users': suspended_users
+                row['key_hash']: {**dict(row), "is_active": bool(row['is_active'])}
+                for row in await cursor.fetchall()
             }
     
+    async def create_api_key(self, key_hash: str, key_data: Dict, only_first: bool = False) -> bool:
+        """Сохранить API ключ.
+        
+        При only_first=True ключ сохраняется, только если активных ключей
+        еще нет (проверка и вставка - одна транзакция, безопасно для
+        одновременного запуска нескольких процессов).
+        """
+        async with self._write() as db:
+            cursor = await db.execute(f"""
+                INSERT INTO api_keys (key_hash, name, created_at, last_used, usage_count, is_active, expires_at)
+                SELECT ?, ?, ?, ?, ?, ?, ?
+                {"WHERE NOT EXISTS (SELECT 1 FROM api_keys WHERE is_active = 1)" if only_first else ""}
+            """, (
+                key_hash, key_data["name"], key_data["created_at"], key_data.get("last_used"),
+                key_data.get("usage_count", 0), int(key_data.get("is_active", True)), key_data.get("expires_at")
+            ))
+            return cursor.rowcount > 0
+    
+    async def import_api_keys(self, keys: Dict[str, Dict]) -> int:
+        """Перенести ключи из api_keys.json (существующие не перезаписываются)"""
+        async with self._write() as db:
+            cursor = await db.executemany("""
+                INSERT OR IGNORE INTO api_keys
+                    (key_hash, name, created_at, last_used, usage_count, is_active, expires_at, revoked_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, [
+                (key_hash, data.get("name", "unknown"), data.get("created_at") or datetime.now().isoformat(),
+                 data.get("last_used"), data.get("usage_count", 0), int(data.get("is_active", True)),
+                 data.get("expires_at"), data.get("revoked_at"))
+                for key_hash, data in keys.items()
+            ])
+            return cursor.rowcount
+    
+    async def revoke_api_key(self, key_hash: str) -> bool:
+        """Отозвать API ключ"""
+        async with self._write() as db:
+            cursor = await db.execute("""
+                UPDATE api_keys SET is_active = 0, revoked_at = ? WHERE key_hash = ?
+            """, (datetime.now().isoformat(), key_hash))
+            return cursor.rowcount > 0
+    
+    async def delete_api_keys(self, key_hashes: List[str]) -> int:
+        """Удалить API ключи"""
+        async with self._write() as db:
+            cursor = await db.executemany(
+                "DELETE FROM api_keys WHERE key_hash = ?", [(key_hash,) for key_hash in key_hashes]
+            )
+            return cursor.rowcount
+    
+    async def add_api_key_usage(self, usage: List[tuple]) -> None:
+        """Добавить накопленную статистику использования: (хеш, число проверок, последнее использование)"""
+        async with self._write() as db:
+            await db.executemany("""
+                UPDATE api_keys
+                SET usage_count = usage_count + ?,
+                    last_used = MAX(COALESCE(last_used, ''), ?)
+                WHERE key_hash = ?
+            """, [(count, last_used, key_hash) for key_hash, count, last_used in usage])
+    
     async def set_config(self, key: str, value: str) -> None:
         """Сохранить конфигурацию"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute("""
                 INSERT OR REPLACE INTO config (key, value, updated_at)
                 VALUES (?, ?, ?)
             """, (key, value, datetime.utcnow().isoformat()))
-            await db.commit()
     
     async def get_config(self, key: str) -> Optional[str]:
         """Получить конфигурацию"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             cursor = await db.execute("SELECT value FROM config WHERE key = ?", (key,))
             row = await cursor.fetchone()
             return row[0] if row else None
 
+# Время выполнения публичных методов - гистограмма db_query_duration_seconds в /metrics
+timed_methods(Database, db_query_duration, db_query_errors)
+
 # Глобальный экземпляр базы данных
-db = Database()
\ No newline at end of file
+db = Database()
+database = db
\ No newline at end of file
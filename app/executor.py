@@ -0,0 +1,62 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, TypeVar
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class IOExecutor:
+    """Ограниченный пул потоков для блокирующей работы с файлами.
+    
+    Чтение и запись config.json, файла ключей и резервных копий, разбор
+    и сериализация JSON, сжатие и fsync выполняются здесь, а не в цикле
+    событий, чтобы большая конфигурация не задерживала остальные запросы.
+    Пул отдельный от стандартного executor цикла, чтобы файловые операции
+    не конкурировали с другими пользователями run_in_executor.
+    """
+    
+    def __init__(self, max_workers: int = None):
+        self.max_workers = max_workers or settings.IO_EXECUTOR_WORKERS
+        self._pool: ThreadPoolExecutor = None
+    
+    @property
+    def pool(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="io")
+        return self._pool
+    
+    async def run(self, func: Callable[..., T], *args, **kwargs) -> T:
+        """Выполнить функцию в пуле и дождаться результата"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, functools.partial(func, *args, **kwargs))
+    
+    def submit(self, func: Callable[..., T], *args, **kwargs) -> None:
+        """Выполнить функцию в пуле, не дожидаясь результата (ошибки пишутся в лог)"""
+        def call():
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                logger.error(f"Ошибка фоновой операции ввода-вывода {getattr(func, '__name__', func)}: {e}")
+        
+        self.pool.submit(call)
+    
+    def shutdown(self) -> None:
+        """Дождаться завершения операций и остановить пул"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+
+# Глобальный пул для файловых операций
+io_executor = IOExecutor()
+
+
+async def run_io(func: Callable[..., T], *args, **kwargs) -> T:
+    """Выполнить блокирующую файловую операцию вне цикла событий"""
+    return await io_executor.run(func, *args, **kwargs)
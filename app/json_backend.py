@@ -0,0 +1,30 @@
+import json
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # orjson не установлен - используем стандартный json
+    orjson = None
+
+# Имя используемой реализации (для логов и бенчмарков)
+BACKEND = "orjson" if orjson is not None else "json"
+
+
+def loads(data: bytes) -> Any:
+    """Разобрать JSON из байтов"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any, compact: bool = False) -> bytes:
+    """Сериализовать объект в JSON (UTF-8).
+    
+    compact=True пишет без отступов - для больших списков клиентов
+    это заметно быстрее и уменьшает размер файла.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj) if compact else orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    if compact:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return json.dumps(obj, indent=2, ensure_ascii=False).encode("utf-8")
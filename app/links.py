@@ -0,0 +1,268 @@
+import base64
+import ipaddress
+import json
+import logging
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote, urlencode
+
+from .config import settings
+
+try:
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+    from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+except ImportError:  # cryptography не установлен - публичный ключ берется из REALITY_PUBLIC_KEY
+    X25519PrivateKey = None
+
+logger = logging.getLogger(__name__)
+
+# Форматы подписки
+SUB_BASE64 = "base64"
+SUB_PLAIN = "plain"
+SUB_CLASH = "clash"
+SUB_SINGBOX = "singbox"
+SUB_FORMATS = (SUB_BASE64, SUB_PLAIN, SUB_CLASH, SUB_SINGBOX)
+
+SUB_MEDIA_TYPES = {
+    SUB_BASE64: "text/plain",
+    SUB_PLAIN: "text/plain",
+    SUB_CLASH: "text/yaml",
+    SUB_SINGBOX: "application/json",
+}
+
+
+def _b64url_decode(value: str) -> bytes:
+    return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+
+
+@lru_cache(maxsize=8)
+def reality_public_key(private_key: str) -> Optional[str]:
+    """Получить публичный ключ Reality (X25519) из privateKey конфигурации Xray"""
+    if not private_key or X25519PrivateKey is None:
+        return None
+    try:
+        key = X25519PrivateKey.from_private_bytes(_b64url_decode(private_key))
+        public = key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+        return base64.urlsafe_b64encode(public).decode().rstrip("=")
+    except Exception as e:
+        logger.error(f"Некорректный privateKey Reality: {e}")
+        return None
+
+
+class LinkHostError(ValueError):
+    """Адрес сервера для ссылок не задан и не определяется из конфигурации"""
+
+
+def _listen_host(listen: str) -> Optional[str]:
+    """Адрес для клиентов из listen inbound: только конкретный внешний адрес.
+    
+    Любой адрес (0.0.0.0, ::), loopback и unix сокет адреса сервера не задают.
+    """
+    if not listen or listen.startswith(("/", "@")):
+        return None
+    try:
+        address = ipaddress.ip_address(listen.strip("[]"))
+    except ValueError:
+        return listen  # имя хоста
+    if address.is_unspecified or address.is_loopback:
+        return None
+    return str(address)
+
+
+def _authority(host: str, port: int) -> str:
+    """host:port для URI, IPv6 адрес - в квадратных скобках"""
+    if ":" in host and not host.startswith("["):
+        host = f"[{host}]"
+    return f"{host}:{port}"
+
+
+def _yaml_value(value) -> str:
+    """Значение для YAML: строки в двойных кавычках (JSON строка - валидная YAML строка)"""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return str(value)
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _yaml_lines(data, indent: int = 0) -> List[str]:
+    """Простейший YAML вывод для словарей, списков и скаляров"""
+    pad = "  " * indent
+    lines = []
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if isinstance(value, (dict, list)):
+                lines.append(f"{pad}{key}:")
+                lines.extend(_yaml_lines(value, indent + 1))
+            else:
+                lines.append(f"{pad}{key}: {_yaml_value(value)}")
+    else:
+        for item in data:
+            if isinstance(item, (dict, list)):
+                nested = _yaml_lines(item, indent + 1)
+                lines.append(f"{pad}- {nested[0].lstrip()}")
+                lines.extend(nested[1:])
+            else:
+                lines.append(f"{pad}- {_yaml_value(item)}")
+    return lines
+
+
+class LinkTemplate:
+    """Параметры подключения, собранные один раз из конфигурации Xray.
+    
+    Ссылка пользователя - подстановка uuid в заранее собранную строку,
+    форматы подписки строятся из тех же разобранных параметров.
+    """
+    
+    def __init__(self, host: str, port: int, network: str, security: str, flow: str,
+                 sni: str, fingerprint: str, public_key: str, short_id: str, remark: str):
+        self.host = host
+        self.port = port
+        self.network = network
+        self.security = security
+        self.flow = flow
+        self.sni = sni
+        self.fingerprint = fingerprint
+        self.public_key = public_key
+        self.short_id = short_id
+        self.remark = remark
+        
+        params = {"security": security, "encryption": "none"}
+        if flow:
+            params["flow"] = flow
+        params["type"] = network
+        if security in ("reality", "tls"):
+            params["fp"] = fingerprint
+            params["sni"] = sni
+        if security == "reality":
+            params["pbk"] = public_key
+            params["sid"] = short_id
+        
+        # vless://<uuid>@host:port?...#remark - хвост после uuid общий для всех
+        self._tail = f"?{urlencode(params, quote_via=quote)}#{quote(remark)}"
+        self._suffix = f"@{_authority(host, port)}{self._tail}" if host else None
+    
+    @property
+    def key(self) -> Tuple:
+        """Значения, от которых зависят ссылки (для обнаружения изменений)"""
+        return (self.host, self.port, self.network, self.security, self.flow,
+                self.sni, self.fingerprint, self.public_key, self.short_id, self.remark)
+    
+    @classmethod
+    def from_config(cls, config: Dict, inbound_tag: Optional[str] = None) -> "LinkTemplate":
+        """Собрать шаблон из VLESS inbound конфигурации Xray.
+        
+        Адрес сервера - PUBLIC_HOST, иначе конкретный адрес listen inbound;
+        если определить его нельзя, host пустой и ссылки не формируются.
+        """
+        inbounds = [i for i in config.get("inbounds", []) if i.get("protocol") == "vless"]
+        inbound = next((i for i in inbounds if i.get("tag") == inbound_tag), None)
+        if inbound is None:
+            inbound = inbounds[0] if inbounds else {}
+        
+        stream = inbound.get("streamSettings", {})
+        security = stream.get("security") or settings.DEFAULT_SECURITY
+        sni = settings.DEFAULT_SNI
+        public_key = settings.REALITY_PUBLIC_KEY
+        short_id = ""
+        if security == "reality":
+            reality = stream.get("realitySettings", {})
+            sni = next(iter(reality.get("serverNames") or []), sni)
+            short_id = next(iter(reality.get("shortIds") or []), "")
+            public_key = public_key or reality_public_key(reality.get("privateKey", "")) or ""
+        elif security == "tls":
+            sni = stream.get("tlsSettings", {}).get("serverName") or sni
+        
+        return cls(
+            host=settings.PUBLIC_HOST or _listen_host(inbound.get("listen") or "") or "",
+            port=inbound.get("port") or settings.DEFAULT_PORT,
+            network=stream.get("network") or "tcp",
+            security=security,
+            flow=settings.DEFAULT_FLOW,
+            sni=sni,
+            fingerprint=settings.DEFAULT_FP,
+            public_key=public_key,
+            short_id=short_id,
+            remark=settings.LINK_REMARK
+        )
+    
+    def _require_host(self) -> None:
+        if not self.host:
+            raise LinkHostError("Адрес сервера для ссылок не определен: задайте PUBLIC_HOST")
+    
+    def link(self, user_uuid: str, host: Optional[str] = None) -> str:
+        """VLESS ссылка пользователя"""
+        if host:
+            return f"vless://{user_uuid}@{_authority(host, self.port)}{self._tail}"
+        self._require_host()
+        return f"vless://{user_uuid}{self._suffix}"
+    
+    def clash_proxy(self, user_uuid: str) -> Dict:
+        """Описание прокси для Clash (Meta)"""
+        self._require_host()
+        proxy = {
+            "name": self.remark,
+            "type": "vless",
+            "server": self.host,
+            "port": self.port,
+            "uuid": user_uuid,
+            "network": self.network,
+            "udp": True,
+        }
+        if self.flow:
+            proxy["flow"] = self.flow
+        if self.security in ("reality", "tls"):
+            proxy["tls"] = True
+            proxy["servername"] = self.sni
+            proxy["client-fingerprint"] = self.fingerprint
+        if self.security == "reality":
+            proxy["reality-opts"] = {"public-key": self.public_key, "short-id": self.short_id}
+        return proxy
+    
+    def singbox_outbound(self, user_uuid: str) -> Dict:
+        """Описание outbound для sing-box"""
+        self._require_host()
+        outbound = {
+            "type": "vless",
+            "tag": self.remark,
+            "server": self.host,
+            "server_port": self.port,
+            "uuid": user_uuid,
+        }
+        if self.flow:
+            outbound["flow"] = self.flow
+        if self.security in ("reality", "tls"):
+            tls = {
+                "enabled": True,
+                "server_name": self.sni,
+                "utls": {"enabled": True, "fingerprint": self.fingerprint},
+            }
+            if self.security == "reality":
+                tls["reality"] = {"enabled": True, "public_key": self.public_key, "short_id": self.short_id}
+            outbound["tls"] = tls
+        return outbound
+    
+    def subscription(self, user_uuid: str, fmt: str) -> bytes:
+        """Тело подписки пользователя в указанном формате"""
+        if fmt == SUB_PLAIN:
+            return (self.link(user_uuid) + "\n").encode()
+        if fmt == SUB_BASE64:
+            return base64.b64encode((self.link(user_uuid) + "\n").encode())
+        if fmt == SUB_CLASH:
+            proxy = self.clash_proxy(user_uuid)
+            document = {
+                "proxies": [proxy],
+                "proxy-groups": [{"name": "PROXY", "type": "select", "proxies": [proxy["name"]]}],
+                "rules": ["MATCH,PROXY"],
+            }
+            return ("\n".join(_yaml_lines(document)) + "\n").encode()
+        if fmt == SUB_SINGBOX:
+            document = {
+                "outbounds": [
+                    self.singbox_outbound(user_uuid),
+                    {"type": "direct", "tag": "direct"},
+                ],
+                "route": {"final": self.remark},
+            }
+            return json.dumps(document, ensure_ascii=False, indent=2).encode()
+        raise ValueError(f"Неизвестный формат подписки: {fmt}")
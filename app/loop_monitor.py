@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from typing import Dict, Optional
+
+from .config import settings
+from .metrics import loop_lag
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних кадров стека цикла событий выводить при блокировке
+STACK_LIMIT = 12
+
+
+class LoopMonitor:
+    """Детектор блокировок цикла событий.
+    
+    Корутина-пульс каждые interval секунд отмечает время и измеряет, насколько
+    позже запланированного она проснулась (задержка цикла). Сторожевой поток
+    проверяет отметку: если пульса нет дольше порога, значит, какой-то
+    обработчик выполняется синхронно слишком долго - в лог пишется стек
+    потока цикла событий в этот момент, а после разблокировки - длительность.
+    """
+    
+    def __init__(self, threshold_ms: float = None, interval: float = None):
+        self.threshold = (threshold_ms if threshold_ms is not None else settings.LOOP_BLOCK_THRESHOLD_MS) / 1000
+        self.interval = interval or settings.LOOP_MONITOR_INTERVAL
+        self._beat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        # Начало текущей обнаруженной блокировки (None - блокировки нет)
+        self._blocked_since: Optional[float] = None
+        
+        self.lag_last = 0.0
+        self.lag_max = 0.0
+        self.blocks = 0
+        self.blocked_total = 0.0
+    
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0
+    
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+    
+    async def _heartbeat(self) -> None:
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._beat = now
+            lag = max(0.0, now - expected)
+            self.lag_last = lag
+            loop_lag.observe(lag)
+            if lag > self.lag_max:
+                self.lag_max = lag
+            
+            blocked_since = self._blocked_since
+            if blocked_since is not None:
+                self._blocked_since = None
+                duration = now - blocked_since
+                self.blocked_total += duration
+                logger.warning(f"Цикл событий был заблокирован {duration * 1000:.0f} мс")
+    
+    def _watch(self) -> None:
+        while not self._stop.wait(self.interval):
+            beat = self._beat
+            stalled = time.monotonic() - beat
+            if stalled <= self.threshold + self.interval or self._blocked_since is not None:
+                continue
+            
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if self._beat != beat:
+                # Пульс успел пройти, пока мы проверяли
+                continue
+            self._blocked_since = beat + self.interval
+            self.blocks += 1
+            stack = "".join(traceback.format_stack(frame, limit=STACK_LIMIT)) if frame else ""
+            logger.warning(
+                f"Цикл событий не отвечает {stalled * 1000:.0f} мс "
+                f"(порог {self.threshold * 1000:.0f} мс), текущий стек:\n{stack}"
+            )
+    
+    def start(self) -> None:
+        """Запустить пульс и сторожевой поток (в потоке цикла событий)"""
+        if not self.enabled or self.running:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat(), name="loop_monitor")
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+        logger.info(f"Запущен детектор блокировок цикла событий (порог {self.threshold * 1000:.0f} мс)")
+    
+    async def stop(self) -> None:
+        """Остановить пульс и сторожевой поток"""
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval * 2)
+            self._thread = None
+    
+    def stats(self) -> Dict:
+        """Задержка цикла событий и обнаруженные блокировки"""
+        return {
+            "lag_ms": round(self.lag_last * 1000, 3),
+            "lag_max_ms": round(self.lag_max * 1000, 3),
+            "blocks": self.blocks,
+            "blocked_ms_total": round(self.blocked_total * 1000, 3),
+            "threshold_ms": round(self.threshold * 1000, 3),
+        }
+
+
+# Глобальный детектор блокировок
+loop_monitor = LoopMonitor()
@@ -1,17 +1,38 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, status
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
+import aiosqlite
+import base64
+import json
 import logging
 import uuid
-from typing import Dict, List
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
 
+from . import auth
 from .config import settings
 from .models import (
     UserCreate, UserResponse, UserUpdate, TrafficResponse, 
-    StatusResponse, APIResponse, ErrorResponse, UserStatus
+    StatusResponse, APIResponse, ErrorResponse, UserStatus,
+    UserBatchCreate, UserBatchRequest, BatchItemResult, BatchResponse, User,
+    TrafficHistoryResponse, TrafficPoint, NodeCreate, NodeInfo,
+    AgentUsersRequest, AgentResultsResponse
 )
+from .cache import CACHE_SUB, CACHE_TRAFFIC, CACHE_USER, CachedResponse, response_cache
 from .database import database
+from .links import SUB_BASE64, SUB_FORMATS, SUB_MEDIA_TYPES, LinkHostError
+from .nodes import LOCAL_NODE_ID, fleet
+from .reconciler import reconciler
+from .quota import next_reset, quota_enforcer, to_utc
+from .executor import io_executor
+from .loop_monitor import loop_monitor
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsMiddleware, registry as metrics_registry
 from .xray_manager import xray_manager
+from .xray_watcher import xray_watcher
+from .background import PeriodicTask, background_tasks
+from .coordination import leader, users_lock
+from .stats_collector import choose_resolution, cleanup_traffic_history, collect_traffic
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -26,6 +47,9 @@ app = FastAPI(
     redoc_url="/redoc"
 )
 
+# Время запуска сервиса (для uptime в /status)
+STARTED_AT = datetime.utcnow()
+
 # Настройка CORS
 app.add_middleware(
     CORSMiddleware,
@@ -35,12 +59,15 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Время обработки запросов по маршрутам (добавлен последним - измеряет весь стек)
+app.add_middleware(MetricsMiddleware)
+
 # Настройка аутентификации
 security = HTTPBearer()
 
 async def verify_api_key(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Проверка API ключа"""
-    if not settings.verify_api_key(credentials.credentials):
+    if not auth.verify_api_key(credentials.credentials):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Неверный API ключ",
@@ -48,26 +75,128 @@ async def verify_api_key(credentials: HTTPAuthorizationCredentials = Depends(sec
         )
     return credentials.credentials
 
+async def _refresh_shared_state() -> None:
+    """Подхватить ключи API и узлы, измененные другими процессами"""
+    await auth.refresh_api_keys()
+    await fleet.refresh()
+
+async def _start_leader_tasks() -> None:
+    """Запустить фоновые задачи ведущего процесса"""
+    tasks = []
+    tasks.append(PeriodicTask(
+        "traffic_retention", settings.TRAFFIC_RETENTION_INTERVAL, cleanup_traffic_history
+    ))
+    tasks.append(PeriodicTask(
+        "user_counters_reconcile", settings.USER_COUNTERS_RECONCILE_INTERVAL,
+        database.reconcile_user_counters
+    ))
+    if settings.NODE_ROLE == "agent":
+        # Пользователи агента хранятся в базе главного сервера, а не в локальной:
+        # сверка и квоты по локальной базе удалили бы клиентов, переданных через
+        # /agent/*, а сбор со сбросом счетчиков забирал бы трафик у главного сервера
+        logger.info("Режим агента: сверка, квоты, сбор трафика и сходимость узлов не запускаются")
+        for task in tasks:
+            background_tasks.add(task).start()
+        return
+    
+    # Фоновый сбор статистики трафика через Xray API
+    if xray_manager.api:
+        tasks.append(PeriodicTask(
+            "traffic_collector", settings.TRAFFIC_COLLECT_INTERVAL, collect_traffic
+        ))
+    
+    # Сверка клиентов Xray с базой: при получении роли ведущего и периодически
+    report = await reconciler.reconcile()
+    if report["error"]:
+        logger.warning(f"Сверка с Xray при запуске не выполнена: {report['error']}")
+    tasks.append(PeriodicTask(
+        "reconciler", settings.RECONCILE_INTERVAL, reconciler.run
+    ))
+    
+    # Обнуление квот, приостановка по квоте и сроку действия
+    tasks.append(PeriodicTask(
+        "quota_enforcer", settings.QUOTA_CHECK_INTERVAL, quota_enforcer.run
+    ))
+    
+    # Цикл сходимости клиентов удаленных узлов с базой
+    tasks.append(PeriodicTask(
+        "fleet_convergence", settings.NODE_CONVERGE_INTERVAL, fleet.converge
+    ))
+    for task in tasks:
+        background_tasks.add(task).start()
+
 @app.on_event("startup")
 async def startup_event():
     """Инициализация при запуске приложения"""
+    loop_monitor.start()
     try:
         # Инициализация базы данных
         await database.init_db()
         logger.info("База данных инициализирована")
         
-        # Проверка статуса Xray
-        status = await xray_manager.get_status()
-        logger.info(f"Статус Xray: {status}")
+        # Проверка статуса Xray, дальше состояние обновляет фоновый наблюдатель
+        state = await xray_watcher.refresh()
+        logger.info(f"Статус Xray: {state} (проверка: {xray_watcher.method})")
+        background_tasks.add(PeriodicTask(
+            "xray_watcher", settings.XRAY_WATCH_INTERVAL, xray_watcher.refresh
+        ))
+        
+        # Шаблон ссылок читается из конфигурации заранее, а не в первом запросе
+        template = await xray_manager.refresh_link_template()
+        if not template.host and settings.NODE_ROLE != "agent":
+            raise LinkHostError(
+                "Адрес сервера для ссылок не определен: задайте PUBLIC_HOST "
+                "или конкретный адрес listen в VLESS inbound"
+            )
+        
+        # Ключи API и узлы общие для всех процессов (таблицы базы),
+        # изменения других процессов подхватываются периодически
+        await auth.api_key_manager.load()
+        await fleet.load()
+        background_tasks.add(PeriodicTask(
+            "api_keys_flush", settings.API_KEYS_FLUSH_INTERVAL, auth.flush_api_key_usage
+        ))
+        background_tasks.add(PeriodicTask(
+            "shared_state_refresh", settings.SHARED_STATE_REFRESH_INTERVAL, _refresh_shared_state
+        ))
+        
+        # Задачи, которые нельзя выполнять параллельно в нескольких процессах,
+        # запускает только ведущий; остальные периодически пытаются им стать
+        leader.on_elected(_start_leader_tasks)
+        if not await leader.try_acquire():
+            logger.info("Фоновые задачи выполняет другой процесс")
+            background_tasks.add(PeriodicTask(
+                "leader_election", settings.LEADER_RETRY_INTERVAL, leader.run
+            ))
+        background_tasks.start_all()
         
         # Генерация API ключа если не существует
-        if not settings.API_KEY:
-            api_key = settings.generate_api_key()
+        api_key = await auth.generate_initial_key()
+        if api_key:
             logger.info(f"Сгенерирован новый API ключ: {api_key}")
         
+    except LinkHostError:
+        # Без адреса сервера ссылки и подписки неработоспособны - не запускаться
+        raise
     except Exception as e:
         logger.error(f"Ошибка при запуске приложения: {e}")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Освобождение ресурсов при остановке приложения"""
+    await background_tasks.stop_all()
+    await fleet.close()
+    if xray_manager.api:
+        await xray_manager.api.close()
+    await xray_manager.service.close()
+    await xray_manager.flush_backup()
+    await auth.api_key_manager.flush()
+    leader.release()
+    await database.close()
+    await loop_monitor.stop()
+    io_executor.shutdown()
+    logger.info("Соединения с базой данных закрыты")
+
 @app.get("/", response_model=APIResponse)
 async def root():
     """Корневой эндпоинт"""
@@ -77,6 +206,72 @@ async def root():
         data={"version": "1.0.0"}
     )
 
+@app.get("/healthz")
+async def healthz():
+    """Проверка живости: процесс API работает и обрабатывает запросы"""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """Проверка готовности: база открыта, Xray работает.
+    
+    Состояние Xray берется из кэша фонового наблюдателя,
+    дочерние процессы при проверке не запускаются.
+    """
+    xray = xray_watcher.snapshot()
+    ready = database.is_open and xray_watcher.is_active
+    return JSONResponse(
+        status_code=status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={
+            "status": "ready" if ready else "not_ready",
+            "database": "open" if database.is_open else "closed",
+            "xray": xray
+        }
+    )
+
+def _cached_json(request: Request, entry: CachedResponse,
+                 media_type: str = "application/json") -> Response:
+    """Ответ из кэша: 304 при совпадении If-None-Match, иначе готовое тело"""
+    headers = {"ETag": entry.etag, "Cache-Control": "private, no-cache"}
+    if entry.matches(request.headers.get("if-none-match")):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=entry.body, media_type=media_type, headers=headers)
+
+def _user_response(user: User, nodes: Optional[Dict[str, Dict]] = None) -> UserResponse:
+    """Сформировать ответ с данными пользователя"""
+    return UserResponse(
+        uuid=user.uuid,
+        email=user.email,
+        name=user.name,
+        status=user.status,
+        suspend_reason=user.suspend_reason,
+        traffic_limit=user.traffic_limit,
+        expires_at=user.expires_at,
+        reset_period=user.reset_period,
+        next_reset_at=user.next_reset_at,
+        vless_link=xray_manager.generate_vless_link(user.uuid),
+        subscription_url=f"/sub/{user.sub_token}",
+        nodes=nodes,
+        created_at=user.created_at,
+        updated_at=user.updated_at
+    )
+
+def _new_user(user_data: UserCreate) -> User:
+    """Пользователь из запроса на создание, с квотой и сроком действия"""
+    now = datetime.utcnow()
+    return User(
+        uuid=str(uuid.uuid4()),
+        email=user_data.email or None,
+        name=user_data.name,
+        created_at=now,
+        updated_at=now,
+        traffic_limit=user_data.traffic_limit,
+        expires_at=to_utc(user_data.expires_at),
+        reset_period=user_data.reset_period,
+        next_reset_at=next_reset(now, user_data.reset_period) if user_data.reset_period else None,
+        reset_anchor=now if user_data.reset_period else None
+    )
+
 @app.post("/users", response_model=UserResponse)
 async def create_user(
     user_data: UserCreate,
@@ -85,15 +280,17 @@ async def create_user(
     """Создать нового VLESS пользователя"""
     try:
         # Генерируем UUID для пользователя
-        user_uuid = str(uuid.uuid4())
+        new_user = _new_user(user_data)
+        user_uuid = new_user.uuid
         
         # Создаем пользователя в базе данных
-        user = await database.create_user(
-            uuid=user_uuid,
-            email=user_data.email,
-            name=user_data.name,
-            traffic_limit=user_data.traffic_limit
-        )
+        try:
+            user = await database.create_user(new_user)
+        except aiosqlite.IntegrityError:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Пользователь с таким email уже существует"
+            )
         
         if not user:
             raise HTTPException(
@@ -101,33 +298,239 @@ async def create_user(
                 detail="Ошибка создания пользователя в базе данных"
             )
         
-        # Добавляем пользователя в конфигурацию Xray
-        if not await xray_manager.add_user(user):
-            # Если не удалось добавить в Xray, удаляем из базы
+        # Добавляем пользователя в конфигурацию Xray на всех узлах
+        fleet_result = await fleet.add_users([user])
+        if not fleet_result.results[0]:
+            # Если не удалось добавить в локальный Xray, удаляем из базы
             await database.delete_user(user_uuid)
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail="Ошибка добавления пользователя в Xray"
             )
         
-        # Генерируем VLESS ссылку
-        vless_link = xray_manager.generate_vless_link(user_uuid)
+        return _user_response(user, fleet_result.nodes())
         
-        return UserResponse(
-            uuid=user_uuid,
-            email=user.email,
-            name=user.name,
-            status=UserStatus.ACTIVE,
-            vless_link=vless_link,
-            traffic_limit=user.traffic_limit,
-            traffic_used=0,
-            created_at=user.created_at
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка создания пользователя: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Внутренняя ошибка сервера"
+        )
+
+# Пакетные операции. Объявлены до маршрутов /users/{user_uuid},
+# чтобы "batch" не принимался за UUID пользователя.
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+def _check_batch_size(size: int) -> None:
+    """Проверить размер пакетного запроса"""
+    if size > settings.BATCH_MAX_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Слишком много элементов в запросе (максимум {settings.BATCH_MAX_SIZE})"
         )
+
+def _batch_response(request: Request, results: List[BatchItemResult],
+                    nodes: Optional[Dict[str, Dict]] = None):
+    """Сформировать ответ пакетной операции.
+    
+    Если клиент принимает NDJSON, результаты отдаются потоком по одной
+    строке на элемент, без построения всего ответа в памяти,
+    а результаты по узлам передаются в заголовке X-Node-Results.
+    """
+    if NDJSON_MEDIA_TYPE in request.headers.get("accept", ""):
+        async def lines():
+            for item in results:
+                yield item.model_dump_json() + "\n"
+        
+        headers = {"X-Node-Results": json.dumps(nodes, ensure_ascii=True)} if nodes else None
+        return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE, headers=headers)
+    
+    failed = sum(1 for item in results if not item.success)
+    return BatchResponse(
+        success=failed == 0,
+        total=len(results),
+        failed=failed,
+        results=results,
+        nodes=nodes
+    )
+
+def _unique_uuids(uuids: List[str]) -> List[str]:
+    """Убрать повторы, сохранив порядок"""
+    return list(dict.fromkeys(uuids))
+
+@app.post("/users/batch", response_model=BatchResponse)
+async def create_users_batch(
+    batch: UserBatchCreate,
+    request: Request,
+    api_key: str = Depends(verify_api_key)
+):
+    """Создать пачку VLESS пользователей"""
+    _check_batch_size(len(batch.users))
+    try:
+        users = [_new_user(item) for item in batch.users]
+        
+        # Email уникален: повторы внутри пачки и уже занятые email не создаются
+        taken = await database.find_emails([user.email for user in users if user.email])
+        results: Dict[str, BatchItemResult] = {}
+        new_users = []
+        for user in users:
+            if user.email and user.email in taken:
+                results[user.uuid] = BatchItemResult(
+                    uuid=user.uuid,
+                    success=False,
+                    message="Пользователь с таким email уже существует"
+                )
+                continue
+            if user.email:
+                taken.add(user.email)
+            new_users.append(user)
+        
+        # Одна транзакция в базе и одно изменение конфигурации Xray
+        await database.create_users(new_users)
+        fleet_result = await fleet.add_users(new_users)
+        xray_results = fleet_result.results
+        
+        # Пользователей, которых не удалось добавить в Xray, удаляем из базы
+        failed_uuids = [user.uuid for user, ok in zip(new_users, xray_results) if not ok]
+        if failed_uuids:
+            await database.delete_users(failed_uuids)
+        
+        for user, ok in zip(new_users, xray_results):
+            results[user.uuid] = BatchItemResult(
+                uuid=user.uuid,
+                success=True,
+                vless_link=xray_manager.generate_vless_link(user.uuid)
+            ) if ok else BatchItemResult(
+                uuid=user.uuid,
+                success=False,
+                message="Ошибка добавления пользователя в Xray"
+            )
+        return _batch_response(request, [results[user.uuid] for user in users], fleet_result.nodes())
+    
+    except HTTPException:
+        raise
+    except aiosqlite.IntegrityError:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Пользователь с таким email уже существует"
+        )
+    except Exception as e:
+        logger.error(f"Ошибка пакетного создания пользователей: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Внутренняя ошибка сервера"
+        )
+
+@app.delete("/users/batch", response_model=BatchResponse)
+async def delete_users_batch(
+    batch: UserBatchRequest,
+    request: Request,
+    api_key: str = Depends(verify_api_key)
+):
+    """Удалить пачку пользователей"""
+    uuids = _unique_uuids(batch.uuids)
+    _check_batch_size(len(uuids))
+    try:
+        existing = await database.get_users(uuids)
+        found = [user_uuid for user_uuid in uuids if user_uuid in existing]
+        
+        async with users_lock.shared():
+            # Удаляем из конфигурации Xray на всех узлах
+            fleet_result = await fleet.remove_users(found)
+            for user_uuid, ok in zip(found, fleet_result.results):
+                if not ok:
+                    logger.warning(f"Не удалось удалить пользователя {user_uuid} из Xray")
+            
+            # Удаляем из базы данных
+            await database.delete_users(found)
         
+        results = [
+            BatchItemResult(uuid=user_uuid, success=True, message="Пользователь успешно удален")
+            if user_uuid in existing else
+            BatchItemResult(uuid=user_uuid, success=False, message="Пользователь не найден")
+            for user_uuid in uuids
+        ]
+        return _batch_response(request, results, fleet_result.nodes())
+    
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Ошибка создания пользователя: {e}")
+        logger.error(f"Ошибка пакетного удаления пользователей: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Внутренняя ошибка сервера"
+        )
+
+async def _change_users_status(uuids: List[str], target: UserStatus) -> Tuple[List[BatchItemResult], Dict]:
+    """Приостановить или возобновить пачку пользователей.
+    
+    Возвращает результаты по пользователям и по узлам.
+    """
+    existing = await database.get_users(uuids)
+    pending = [
+        existing[user_uuid] for user_uuid in uuids
+        if user_uuid in existing and existing[user_uuid].status != target
+    ]
+    
+    # Одно изменение конфигурации Xray для всей пачки на каждом узле
+    async with users_lock.shared():
+        if target == UserStatus.SUSPENDED:
+            fleet_result = await fleet.suspend_users([user.uuid for user in pending])
+        else:
+            fleet_result = await fleet.add_users(pending)
+        xray_results = fleet_result.results
+        
+        applied = {user.uuid for user, ok in zip(pending, xray_results) if ok}
+        if applied:
+            await database.update_users_status(list(applied), target)
+    
+    pending_uuids = {user.uuid for user in pending}
+    results = []
+    for user_uuid in uuids:
+        if user_uuid not in existing:
+            results.append(BatchItemResult(uuid=user_uuid, success=False, message="Пользователь не найден"))
+        elif user_uuid not in pending_uuids:
+            results.append(BatchItemResult(uuid=user_uuid, success=True, message="Статус не изменился"))
+        elif user_uuid in applied:
+            results.append(BatchItemResult(uuid=user_uuid, success=True, message="Статус пользователя обновлен"))
+        else:
+            results.append(BatchItemResult(uuid=user_uuid, success=False, message="Ошибка изменения пользователя в Xray"))
+    return results, fleet_result.nodes()
+
+@app.post("/users/batch/suspend", response_model=BatchResponse)
+async def suspend_users_batch(
+    batch: UserBatchRequest,
+    request: Request,
+    api_key: str = Depends(verify_api_key)
+):
+    """Приостановить пачку пользователей"""
+    uuids = _unique_uuids(batch.uuids)
+    _check_batch_size(len(uuids))
+    try:
+        return _batch_response(request, *await _change_users_status(uuids, UserStatus.SUSPENDED))
+    except Exception as e:
+        logger.error(f"Ошибка пакетной приостановки пользователей: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Внутренняя ошибка сервера"
+        )
+
+@app.post("/users/batch/resume", response_model=BatchResponse)
+async def resume_users_batch(
+    batch: UserBatchRequest,
+    request: Request,
+    api_key: str = Depends(verify_api_key)
+):
+    """Возобновить пачку пользователей"""
+    uuids = _unique_uuids(batch.uuids)
+    _check_batch_size(len(uuids))
+    try:
+        return _batch_response(request, *await _change_users_status(uuids, UserStatus.ACTIVE))
+    except Exception as e:
+        logger.error(f"Ошибка пакетного возобновления пользователей: {e}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Внутренняя ошибка сервера"
@@ -148,15 +551,20 @@ async def delete_user(
                 detail="Пользователь не найден"
             )
         
-        # Удаляем из конфигурации Xray
-        if not await xray_manager.remove_user(user_uuid):
-            logger.warning(f"Не удалось удалить пользователя {user_uuid} из Xray")
+        async with users_lock.shared():
+            # Удаляем из конфигурации Xray на всех узлах
+            fleet_result = await fleet.remove_users([user_uuid])
+            if not fleet_result.results[0]:
+                logger.warning(f"Не удалось удалить пользователя {user_uuid} из Xray")
+            
+            # Удаляем из базы данных
+            deleted = await database.delete_user(user_uuid)
         
-        # Удаляем из базы данных
-        if await database.delete_user(user_uuid):
+        if deleted:
             return APIResponse(
                 success=True,
-                message="Пользователь успешно удален"
+                message="Пользователь успешно удален",
+                data={"nodes": fleet_result.nodes()}
             )
         else:
             raise HTTPException(
@@ -194,18 +602,23 @@ async def suspend_user(
                 message="Пользователь уже приостановлен"
             )
         
-        # Удаляем из конфигурации Xray (временно)
-        if not await xray_manager.remove_user(user_uuid):
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Ошибка приостановки пользователя в Xray"
-            )
+        async with users_lock.shared():
+            # Удаляем из конфигурации Xray (временно) на всех узлах
+            fleet_result = await fleet.suspend_users([user_uuid])
+            if not fleet_result.results[0]:
+                raise HTTPException(
+                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                    detail="Ошибка приостановки пользователя в Xray"
+                )
+            
+            # Обновляем статус в базе данных
+            updated = await database.update_users_status([user_uuid], UserStatus.SUSPENDED)
         
-        # Обновляем статус в базе данных
-        if await database.update_user_status(user_uuid, UserStatus.SUSPENDED):
+        if updated:
             return APIResponse(
                 success=True,
-                message="Пользователь успешно приостановлен"
+                message="Пользователь успешно приостановлен",
+                data={"nodes": fleet_result.nodes()}
             )
         else:
             raise HTTPException(
@@ -243,18 +656,23 @@ async def resume_user(
                 message="Пользователь уже активен"
             )
         
-        # Добавляем обратно в конфигурацию Xray
-        if not await xray_manager.add_user(user):
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Ошибка возобновления пользователя в Xray"
-            )
+        async with users_lock.shared():
+            # Добавляем обратно в конфигурацию Xray на всех узлах
+            fleet_result = await fleet.add_users([user])
+            if not fleet_result.results[0]:
+                raise HTTPException(
+                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                    detail="Ошибка возобновления пользователя в Xray"
+                )
+            
+            # Обновляем статус в базе данных
+            updated = await database.update_users_status([user_uuid], UserStatus.ACTIVE)
         
-        # Обновляем статус в базе данных
-        if await database.update_user_status(user_uuid, UserStatus.ACTIVE):
+        if updated:
             return APIResponse(
                 success=True,
-                message="Пользователь успешно возобновлен"
+                message="Пользователь успешно возобновлен",
+                data={"nodes": fleet_result.nodes()}
             )
         else:
             raise HTTPException(
@@ -274,9 +692,48 @@ async def resume_user(
 @app.get("/users/{user_uuid}", response_model=UserResponse)
 async def get_user(
     user_uuid: str,
+    request: Request,
     api_key: str = Depends(verify_api_key)
 ):
     """Получить информацию о пользователе"""
+    try:
+        # Запускает проверку параметров подключения: при изменении кэш сбрасывается
+        xray_manager.link_template()
+        key = (CACHE_USER, user_uuid)
+        entry = response_cache.get(key)
+        if entry is None:
+            epoch = response_cache.epoch(key[0])
+            user = await database.get_user(user_uuid)
+            if not user:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="Пользователь не найден"
+                )
+            entry = response_cache.put(key, _user_response(user).model_dump_json().encode(), epoch)
+        
+        return _cached_json(request, entry)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка получения пользователя: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Внутренняя ошибка сервера"
+        )
+
+@app.patch("/users/{user_uuid}", response_model=UserResponse)
+async def update_user(
+    user_uuid: str,
+    user_data: UserUpdate,
+    api_key: str = Depends(verify_api_key)
+):
+    """Изменить имя, квоту трафика или срок действия пользователя.
+    
+    Передаются только изменяемые поля; null снимает квоту или срок.
+    Превышение новой квоты применяется сразу, снятие ограничений -
+    при следующей проверке квот.
+    """
     try:
         user = await database.get_user(user_uuid)
         if not user:
@@ -285,52 +742,126 @@ async def get_user(
                 detail="Пользователь не найден"
             )
         
-        # Генерируем VLESS ссылку
-        vless_link = xray_manager.generate_vless_link(user_uuid)
+        changes = user_data.model_dump(exclude_unset=True)
+        # Email - идентификатор клиента в Xray, его изменение не поддерживается
+        if "email" in changes and (changes.pop("email") or None) != user.email:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Email пользователя изменить нельзя"
+            )
+        if "expires_at" in changes:
+            changes["expires_at"] = to_utc(changes["expires_at"])
+        if "reset_period" in changes and changes["reset_period"] != user.reset_period:
+            period = changes["reset_period"]
+            now = datetime.utcnow()
+            changes["next_reset_at"] = next_reset(now, period) if period else None
+            changes["reset_anchor"] = now if period else None
         
-        return UserResponse(
-            uuid=user.uuid,
-            email=user.email,
-            name=user.name,
-            status=user.status,
-            vless_link=vless_link,
-            traffic_limit=user.traffic_limit,
-            traffic_used=user.traffic_used,
-            created_at=user.created_at
-        )
+        user = await database.update_user(user_uuid, **changes)
+        if not user:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Пользователь не найден"
+            )
         
+        if user.status == UserStatus.ACTIVE and ("traffic_limit" in changes or "expires_at" in changes):
+            report = await quota_enforcer.enforce([user_uuid])
+            if report["suspended"]:
+                user = await database.get_user(user_uuid)
+        return _user_response(user)
+    
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Ошибка получения пользователя: {e}")
+        logger.error(f"Ошибка изменения пользователя: {e}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Внутренняя ошибка сервера"
         )
 
+# Максимальный размер страницы списка пользователей
+USERS_PAGE_MAX = 1000
+
+def _encode_cursor(user: User) -> str:
+    """Курсор страницы: ключ (created_at, uuid) последнего пользователя"""
+    key = json.dumps([user.created_at.isoformat(), user.uuid], separators=(",", ":"))
+    return base64.urlsafe_b64encode(key.encode()).decode().rstrip("=")
+
+def _decode_cursor(cursor: str) -> Tuple[str, str]:
+    """Разобрать курсор страницы"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, user_uuid = json.loads(base64.urlsafe_b64decode(padded))
+        return str(created_at), str(user_uuid)
+    except Exception:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Некорректный курсор"
+        )
+
+async def _iterate(items: List):
+    """Асинхронный итератор по готовому списку"""
+    for item in items:
+        yield item
+
+def _users_stream(request: Request, users, headers: Optional[Dict[str, str]] = None) -> StreamingResponse:
+    """Отдать пользователей потоком: NDJSON или JSON массив.
+    
+    Пользователи сериализуются по одному по мере чтения из базы,
+    список целиком в памяти не строится.
+    """
+    ndjson = NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+    
+    async def body():
+        try:
+            first = True
+            if not ndjson:
+                yield "["
+            async for user in users:
+                item = _user_response(user).model_dump_json()
+                if ndjson:
+                    yield item + "\n"
+                else:
+                    yield item if first else "," + item
+                first = False
+            if not ndjson:
+                yield "]"
+        finally:
+            # Завершаем генератор, даже если клиент отключился
+            await users.aclose()
+    
+    media_type = NDJSON_MEDIA_TYPE if ndjson else "application/json"
+    return StreamingResponse(body(), media_type=media_type, headers=headers)
+
 @app.get("/users", response_model=List[UserResponse])
 async def list_users(
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=USERS_PAGE_MAX, description="Размер страницы"),
+    cursor: Optional[str] = Query(None, description="Курсор из заголовка X-Next-Cursor"),
+    status_filter: Optional[UserStatus] = Query(None, alias="status", description="Фильтр по статусу"),
+    email: Optional[str] = Query(None, description="Фильтр по email"),
+    name: Optional[str] = Query(None, description="Фильтр по префиксу имени"),
     api_key: str = Depends(verify_api_key)
 ):
-    """Получить список всех пользователей"""
+    """Получить список пользователей (от новых к старым).
+    
+    Без limit отдаются все подходящие пользователи потоком. С limit - одна
+    страница, курсор следующей страницы передается в заголовке X-Next-Cursor.
+    """
+    after = _decode_cursor(cursor) if cursor else None
+    filters = {"status": status_filter, "email": email, "name": name}
+    
     try:
-        users = await database.get_all_users()
-        result = []
+        if limit is None:
+            return _users_stream(request, database.iter_users(after=after, **filters))
         
-        for user in users:
-            vless_link = xray_manager.generate_vless_link(user.uuid)
-            result.append(UserResponse(
-                uuid=user.uuid,
-                email=user.email,
-                name=user.name,
-                status=user.status,
-                vless_link=vless_link,
-                traffic_limit=user.traffic_limit,
-                traffic_used=user.traffic_used,
-                created_at=user.created_at
-            ))
-        
-        return result
+        # Читаем на одного пользователя больше, чтобы узнать, есть ли следующая страница
+        page = [user async for user in database.iter_users(after=after, limit=limit + 1, **filters)]
+        headers = {}
+        if len(page) > limit:
+            page = page[:limit]
+            headers["X-Next-Cursor"] = _encode_cursor(page[-1])
+        return _users_stream(request, _iterate(page), headers)
         
     except Exception as e:
         logger.error(f"Ошибка получения списка пользователей: {e}")
@@ -342,33 +873,102 @@ async def list_users(
 @app.get("/traffic/{user_uuid}", response_model=TrafficResponse)
 async def get_user_traffic(
     user_uuid: str,
+    request: Request,
     api_key: str = Depends(verify_api_key)
 ):
     """Получить статистику трафика пользователя"""
     try:
-        # Проверяем существование пользователя
-        user = await database.get_user(user_uuid)
-        if not user:
+        key = (CACHE_TRAFFIC, user_uuid)
+        entry = response_cache.get(key)
+        if entry is None:
+            # Трафик накапливает фоновый сборщик, здесь читаются только сохраненные итоги
+            epoch = response_cache.epoch(key[0])
+            traffic = await database.get_traffic(user_uuid)
+            if not traffic:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="Пользователь не найден"
+                )
+            entry = response_cache.put(key, TrafficResponse(**traffic).model_dump_json().encode(), epoch)
+        
+        return _cached_json(request, entry)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка получения трафика пользователя: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Внутренняя ошибка сервера"
+        )
+
+# Максимум интервалов в одном ответе истории трафика
+TRAFFIC_HISTORY_MAX_POINTS = 10000
+
+def _to_timestamp(value: datetime) -> int:
+    """Перевести datetime в unix-время (время без часового пояса считается UTC)"""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp())
+
+@app.get("/traffic/{user_uuid}/history", response_model=TrafficHistoryResponse)
+async def get_user_traffic_history(
+    user_uuid: str,
+    start: Optional[datetime] = Query(None, alias="from", description="Начало периода (по умолчанию сутки назад)"),
+    end: Optional[datetime] = Query(None, alias="to", description="Конец периода (по умолчанию сейчас)"),
+    step: int = Query(3600, ge=60, description="Длина интервала в секундах, кратная 60"),
+    api_key: str = Depends(verify_api_key)
+):
+    """Получить историю трафика пользователя по интервалам"""
+    end_ts = _to_timestamp(end) if end else int(datetime.now(timezone.utc).timestamp())
+    start_ts = _to_timestamp(start) if start else end_ts - int(timedelta(days=1).total_seconds())
+    
+    if step % 60 != 0:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Шаг должен быть кратен 60 секундам"
+        )
+    if start_ts >= end_ts:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Начало периода должно быть раньше конца"
+        )
+    if (end_ts - start_ts) // step > TRAFFIC_HISTORY_MAX_POINTS:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Слишком много интервалов (максимум {TRAFFIC_HISTORY_MAX_POINTS}), увеличьте шаг"
+        )
+    
+    try:
+        if not await database.get_traffic(user_uuid):
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Пользователь не найден"
             )
         
-        # Получаем статистику трафика из Xray
-        traffic_stats = await xray_manager.get_traffic_stats()
-        user_traffic = traffic_stats.get(user_uuid, {"uplink": 0, "downlink": 0})
+        # Ответ строится из самого крупного уровня агрегации, на который делится шаг
+        resolution = choose_resolution(step)
+        rows = await database.get_traffic_history(user_uuid, start_ts, end_ts, step, resolution)
         
-        return TrafficResponse(
+        return TrafficHistoryResponse(
             uuid=user_uuid,
-            uplink=user_traffic.get("uplink", 0),
-            downlink=user_traffic.get("downlink", 0),
-            total=user_traffic.get("uplink", 0) + user_traffic.get("downlink", 0)
+            step=step,
+            resolution=resolution,
+            points=[
+                TrafficPoint(
+                    timestamp=datetime.fromtimestamp(row['ts'], tz=timezone.utc),
+                    upload=row['upload'],
+                    download=row['download'],
+                    total=row['upload'] + row['download']
+                )
+                for row in rows
+            ]
         )
-        
+    
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Ошибка получения трафика пользователя: {e}")
+        logger.error(f"Ошибка получения истории трафика: {e}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Внутренняя ошибка сервера"
@@ -378,13 +978,16 @@ async def get_user_traffic(
 async def get_status(api_key: str = Depends(verify_api_key)):
     """Получить статус Xray сервиса"""
     try:
-        xray_status = await xray_manager.get_status()
+        stats = await database.get_stats()
+        uptime = datetime.utcnow() - STARTED_AT
         
         return StatusResponse(
-            xray_status=xray_status["status"],
-            xray_details=xray_status.get("details", ""),
-            api_version="1.0.0",
-            users_count=await database.get_users_count()
+            xray_status=xray_watcher.snapshot()["state"],
+            api_status="running",
+            total_users=stats["total_users"],
+            active_users=stats["active_users"],
+            suspended_users=stats["suspended_users"],
+            uptime=str(uptime - timedelta(microseconds=uptime.microseconds))
         )
         
     except Exception as e:
@@ -394,30 +997,345 @@ async def get_status(api_key: str = Depends(verify_api_key)):
             detail="Внутренняя ошибка сервера"
         )
 
+@app.get("/sub/{token}")
+async def get_subscription(
+    token: str,
+    request: Request,
+    fmt: str = Query(SUB_BASE64, alias="format", description="Формат: base64, plain, clash, singbox")
+):
+    """Подписка пользователя для клиентских приложений (авторизация - токен в пути)"""
+    if fmt not in SUB_FORMATS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Неизвестный формат подписки (доступны: {', '.join(SUB_FORMATS)})"
+        )
+    
+    try:
+        template = xray_manager.link_template()
+        key = (CACHE_SUB, token, fmt)
+        entry = response_cache.get(key)
+        if entry is None:
+            epoch = response_cache.epoch(key[0])
+            user = await database.get_user_by_sub_token(token)
+            if not user:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="Подписка не найдена"
+                )
+            if user.status != UserStatus.ACTIVE:
+                raise HTTPException(
+                    status_code=status.HTTP_403_FORBIDDEN,
+                    detail="Подписка приостановлена"
+                )
+            body = template.subscription(user.uuid, fmt)
+            entry = response_cache.put(key, body, epoch, owner=user.uuid)
+        
+        return _cached_json(request, entry, SUB_MEDIA_TYPES[fmt])
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка формирования подписки: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Внутренняя ошибка сервера"
+        )
+
+@app.get("/cache/stats", response_model=APIResponse)
+async def get_cache_stats(api_key: str = Depends(verify_api_key)):
+    """Получить статистику кэша ответов"""
+    return APIResponse(
+        success=True,
+        message="Статистика кэша ответов",
+        data=response_cache.stats()
+    )
+
+@app.get("/loop/stats", response_model=APIResponse)
+async def get_loop_stats(api_key: str = Depends(verify_api_key)):
+    """Получить задержку цикла событий и число обнаруженных блокировок"""
+    return APIResponse(
+        success=True,
+        message="Статистика цикла событий",
+        data=loop_monitor.stats()
+    )
+
+# Метрики, значения которых ведут сами компоненты, читаются при запросе /metrics
+metrics_registry.callback_counter(
+    "response_cache_hits_total", "Попадания в кэш ответов", lambda: response_cache.hits
+)
+metrics_registry.callback_counter(
+    "response_cache_misses_total", "Промахи кэша ответов", lambda: response_cache.misses
+)
+metrics_registry.gauge(
+    "response_cache_hit_ratio", "Доля попаданий в кэш ответов", lambda: response_cache.stats()["hit_ratio"]
+)
+metrics_registry.gauge(
+    "response_cache_entries", "Количество записей в кэше ответов", lambda: response_cache.stats()["size"]
+)
+metrics_registry.gauge(
+    "event_loop_lag_max_seconds", "Максимальная задержка цикла событий", lambda: loop_monitor.lag_max
+)
+metrics_registry.callback_counter(
+    "event_loop_blocks_total", "Обнаруженные блокировки цикла событий", lambda: loop_monitor.blocks
+)
+metrics_registry.gauge(
+    "leader", "Процесс выполняет фоновые задачи ведущего (1) или нет (0)", lambda: int(leader.is_leader)
+)
+metrics_registry.gauge(
+    "start_time_seconds", "Время запуска процесса (Unix time)",
+    lambda: STARTED_AT.replace(tzinfo=timezone.utc).timestamp()
+)
+
+@app.get("/metrics")
+async def get_metrics(api_key: str = Depends(verify_api_key)):
+    """Метрики процесса в текстовом формате Prometheus"""
+    return Response(content=metrics_registry.render(), media_type=METRICS_CONTENT_TYPE)
+
+@app.get("/reconcile", response_model=APIResponse)
+async def get_reconcile_status(api_key: str = Depends(verify_api_key)):
+    """Получить результат последней сверки базы с Xray"""
+    return APIResponse(
+        success=True,
+        message="Статистика сверки с Xray",
+        data=reconciler.stats()
+    )
+
+@app.post("/reconcile", response_model=APIResponse)
+async def run_reconcile(
+    force: bool = Query(False, description="Сверить, даже если база и конфигурация не менялись"),
+    api_key: str = Depends(verify_api_key)
+):
+    """Сверить активных пользователей базы с клиентами Xray и устранить расхождения"""
+    try:
+        report = await reconciler.reconcile(force=force)
+    except Exception as e:
+        logger.error(f"Ошибка сверки с Xray: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Внутренняя ошибка сервера"
+        )
+    return APIResponse(
+        success=report["error"] is None and report["failed"] == 0,
+        message="Сверка с Xray выполнена",
+        data=report
+    )
+
+@app.get("/quota", response_model=APIResponse)
+async def get_quota_status(api_key: str = Depends(verify_api_key)):
+    """Получить результат последней проверки квот и сроков действия"""
+    return APIResponse(
+        success=True,
+        message="Статистика применения квот",
+        data=quota_enforcer.stats()
+    )
+
+@app.post("/quota/enforce", response_model=APIResponse)
+async def run_quota_enforcement(api_key: str = Depends(verify_api_key)):
+    """Обнулить наступившие квоты и применить квоты и сроки действия ко всем пользователям"""
+    try:
+        report = await quota_enforcer.run()
+    except Exception as e:
+        logger.error(f"Ошибка применения квот: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Внутренняя ошибка сервера"
+        )
+    return APIResponse(
+        success=report["failed"] == 0 and report["restore_failed"] == 0,
+        message="Квоты применены",
+        data=report
+    )
+
+@app.get("/config/backups", response_model=APIResponse)
+async def list_config_backups(api_key: str = Depends(verify_api_key)):
+    """Получить список резервных копий конфигурации Xray"""
+    return APIResponse(
+        success=True,
+        message="Список резервных копий конфигурации",
+        data={"backups": xray_manager.list_backups()}
+    )
+
+@app.post("/config/rollback/{generation}", response_model=APIResponse)
+async def rollback_config(
+    generation: int,
+    api_key: str = Depends(verify_api_key)
+):
+    """Откатить конфигурацию Xray к указанному поколению резервной копии
+    
+    Доступны только поколения из /config/backups: при XRAY_BACKUP_INTERVAL > 0
+    промежуточные версии списков клиентов в кольцо не попадают и не восстанавливаются
+    """
+    try:
+        if not any(backup["generation"] == generation for backup in xray_manager.list_backups()):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Резервная копия не найдена"
+            )
+        
+        if not await xray_manager.rollback_config(generation):
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Ошибка отката конфигурации Xray"
+            )
+        
+        return APIResponse(
+            success=True,
+            message=f"Конфигурация откачена к поколению {generation}"
+        )
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка отката конфигурации: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Внутренняя ошибка сервера"
+        )
+
+# Удаленные узлы. Изменения пользователей рассылаются на все узлы,
+# на узле запущен этот же сервис, принимающий их через /agent/*.
+
+def _node_info(node: Dict) -> NodeInfo:
+    return NodeInfo(
+        id=node["id"],
+        name=node["name"],
+        url=node["url"],
+        enabled=node["enabled"],
+        created_at=datetime.fromisoformat(node["created_at"])
+    )
+
+@app.get("/nodes", response_model=List[NodeInfo])
+async def list_nodes(api_key: str = Depends(verify_api_key)):
+    """Получить список удаленных узлов"""
+    return [_node_info(node) for node in await database.get_nodes()]
+
+@app.post("/nodes", response_model=NodeInfo)
+async def create_node(
+    node_data: NodeCreate,
+    api_key: str = Depends(verify_api_key)
+):
+    """Зарегистрировать удаленный узел.
+    
+    Клиенты на узле появятся после ближайшего цикла сходимости
+    (или вызова POST /nodes/converge).
+    """
+    if node_data.name == LOCAL_NODE_ID:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Название {LOCAL_NODE_ID} зарезервировано за локальным Xray"
+        )
+    try:
+        node = await database.create_node(str(uuid.uuid4()), node_data.name, node_data.url, node_data.api_key)
+    except aiosqlite.IntegrityError:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Узел с таким названием уже существует"
+        )
+    fleet.register(node)
+    return _node_info(node)
+
+@app.delete("/nodes/{node_id}", response_model=APIResponse)
+async def delete_node(
+    node_id: str,
+    api_key: str = Depends(verify_api_key)
+):
+    """Удалить удаленный узел (клиенты на самом узле не удаляются)"""
+    if not await database.delete_node(node_id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Узел не найден"
+        )
+    await fleet.unregister(node_id)
+    return APIResponse(success=True, message="Узел удален")
+
+@app.post("/nodes/converge", response_model=APIResponse)
+async def converge_nodes(api_key: str = Depends(verify_api_key)):
+    """Исправить расхождения клиентов удаленных узлов с базой"""
+    try:
+        return APIResponse(
+            success=True,
+            message="Сходимость узлов выполнена",
+            data={"nodes": await fleet.converge()}
+        )
+    except Exception as e:
+        logger.error(f"Ошибка сходимости узлов: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Внутренняя ошибка сервера"
+        )
+
+# Эндпоинты агента: применяют изменения только к локальному Xray
+
+@app.post("/agent/users", response_model=AgentResultsResponse)
+async def agent_add_users(
+    request_data: AgentUsersRequest,
+    api_key: str = Depends(verify_api_key)
+):
+    """Добавить клиентов в локальный Xray"""
+    _check_batch_size(len(request_data.users))
+    users = [User(uuid=item.uuid, email=item.email) for item in request_data.users]
+    return AgentResultsResponse(results=await xray_manager.add_users(users))
+
+@app.post("/agent/users/remove", response_model=AgentResultsResponse)
+async def agent_remove_users(
+    batch: UserBatchRequest,
+    api_key: str = Depends(verify_api_key)
+):
+    """Удалить клиентов из локального Xray"""
+    _check_batch_size(len(batch.uuids))
+    return AgentResultsResponse(results=await xray_manager.remove_users(batch.uuids))
+
+@app.post("/agent/users/suspend", response_model=AgentResultsResponse)
+async def agent_suspend_users(
+    batch: UserBatchRequest,
+    api_key: str = Depends(verify_api_key)
+):
+    """Приостановить клиентов в локальном Xray"""
+    _check_batch_size(len(batch.uuids))
+    return AgentResultsResponse(results=await xray_manager.suspend_users(batch.uuids))
+
+@app.get("/agent/clients")
+async def agent_list_clients(api_key: str = Depends(verify_api_key)):
+    """UUID клиентов локального Xray"""
+    clients = await xray_manager.list_client_ids()
+    if clients is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Конфигурация Xray недоступна"
+        )
+    return JSONResponse({"uuids": sorted(clients)})
+
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request, exc):
     """Обработчик HTTP исключений"""
-    return ErrorResponse(
-        success=False,
-        error=exc.detail,
-        status_code=exc.status_code
+    return JSONResponse(
+        status_code=exc.status_code,
+        content=ErrorResponse(
+            success=False,
+            error=str(exc.detail),
+            code=exc.status_code
+        ).model_dump(),
+        headers=exc.headers
     )
 
 @app.exception_handler(Exception)
 async def general_exception_handler(request, exc):
     """Обработчик общих исключений"""
     logger.error(f"Необработанная ошибка: {exc}")
-    return ErrorResponse(
-        success=False,
-        error="Внутренняя ошибка сервера",
-        status_code=500
+    return JSONResponse(
+        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        content=ErrorResponse(
+            success=False,
+            error="Внутренняя ошибка сервера",
+            code=status.HTTP_500_INTERNAL_SERVER_ERROR
+        ).model_dump()
     )
 
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(
         "app.main:app",
-        host=settings.HOST,
-        port=settings.PORT,
-        reload=settings.DEBUG
+        host=settings.SERVER_HOST,
+        port=settings.SERVER_PORT,
+        workers=settings.WORKERS
     )
\ No newline at end of file
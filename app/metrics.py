@@ -0,0 +1,369 @@
+import functools
+import inspect
+import math
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+# Формат ответа /metrics (Prometheus text exposition 0.0.4; charset добавляет Starlette)
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+# Префикс имен всех метрик сервиса
+PREFIX = "xray_manager_"
+
+# Границы корзин гистограмм
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1024, 16384, 131072, 1048576, 4194304, 16777216, 67108864)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+
+# Метка маршрута для запросов, не совпавших ни с одним маршрутом
+UNMATCHED_ROUTE = "unmatched"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, int) or value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class CounterChild:
+    """Значение счетчика для одного набора меток"""
+    
+    __slots__ = ("value",)
+    
+    def __init__(self):
+        self.value = 0
+    
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class HistogramChild:
+    """Корзины гистограммы для одного набора меток.
+    
+    Счетчики корзин хранятся без накопления и заранее выделены: наблюдение -
+    поиск корзины и три сложения, без создания объектов и блокировок.
+    """
+    
+    __slots__ = ("bounds", "counts", "sum", "count")
+    
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        # Последняя корзина - +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric:
+    """Метрика с метками; дочерние значения создаются один раз на набор меток.
+    
+    Горячий путь берет дочернее значение заранее (labels(...) при
+    инициализации модуля или первом обращении) и дальше обновляет только
+    его. Блокировок нет: обновления выполняются в потоке цикла событий,
+    а редкие наблюдения из пула потоков допускают потерю отдельного
+    инкремента при одновременной записи.
+    """
+    
+    kind = ""
+    
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+    
+    def _new_child(self):
+        raise NotImplementedError
+    
+    def labels(self, *values: str):
+        """Дочернее значение для набора меток (создается при первом обращении)"""
+        child = self._children.get(values)
+        if child is None:
+            child = self._children.setdefault(values, self._new_child())
+        return child
+    
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """Монотонно растущий счетчик"""
+    
+    kind = "counter"
+    
+    def _new_child(self) -> CounterChild:
+        return CounterChild()
+    
+    def inc(self, amount: float = 1) -> None:
+        """Увеличить счетчик без меток"""
+        self.labels().inc(amount)
+    
+    def render(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"
+            for values, child in list(self._children.items())
+        ]
+
+
+class Histogram(Metric):
+    """Гистограмма с фиксированными границами корзин"""
+    
+    kind = "histogram"
+    
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.bounds = tuple(sorted(buckets))
+    
+    def _new_child(self) -> HistogramChild:
+        return HistogramChild(self.bounds)
+    
+    def observe(self, value: float) -> None:
+        """Наблюдение для гистограммы без меток"""
+        self.labels().observe(value)
+    
+    def render(self) -> List[str]:
+        lines = []
+        for values, child in list(self._children.items()):
+            # Заранее созданные, но еще не использованные ряды не выводятся
+            if not child.count:
+                continue
+            cumulative = 0
+            for bound, count in zip((*self.bounds, math.inf), child.counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+class Gauge(Metric):
+    """Значение, вычисляемое при каждом чтении /metrics.
+    
+    Функция возвращает число или словарь {кортеж значений меток: число}.
+    Используется для данных, которые компоненты уже ведут сами
+    (размер кэша, задержка цикла событий), чтобы не дублировать их учет.
+    """
+    
+    kind = "gauge"
+    
+    def __init__(self, name: str, documentation: str,
+                 func: Callable[[], Union[float, Dict[Tuple[str, ...], float]]],
+                 labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.func = func
+    
+    def render(self) -> List[str]:
+        value = self.func()
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        return [
+            f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(float(item))}"
+            for values, item in items
+        ]
+
+
+class CallbackCounter(Gauge):
+    """Счетчик, значение которого ведет сам компонент (например, попадания в кэш)"""
+    
+    kind = "counter"
+
+
+class MetricsRegistry:
+    """Реестр метрик сервиса"""
+    
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+    
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+    
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+    
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+    
+    def gauge(self, name: str, documentation: str, func: Callable, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, func, labelnames))
+    
+    def callback_counter(self, name: str, documentation: str, func: Callable,
+                         labelnames: Sequence[str] = ()) -> CallbackCounter:
+        return self.register(CallbackCounter(name, documentation, func, labelnames))
+    
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus"""
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# Глобальный реестр метрик
+registry = MetricsRegistry()
+
+# HTTP
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "Время обработки HTTP запроса по маршрутам", ("method", "route")
+)
+http_requests_failed = registry.counter(
+    "http_requests_failed_total", "HTTP запросы, завершившиеся ответом 5xx или исключением", ("method", "route")
+)
+
+# SQLite
+db_query_duration = registry.histogram(
+    "db_query_duration_seconds", "Время выполнения методов Database", ("method",)
+)
+db_query_errors = registry.counter(
+    "db_query_errors_total", "Методы Database, завершившиеся исключением", ("method",)
+)
+
+# Дочерние процессы
+subprocess_duration = registry.histogram(
+    "subprocess_duration_seconds", "Время выполнения дочерних процессов (запуск и ожидание)", ("command",)
+)
+subprocess_failures = registry.counter(
+    "subprocess_failures_total", "Дочерние процессы с ненулевым кодом возврата или ошибкой запуска", ("command",)
+)
+
+# Конфигурация Xray
+config_io_duration = registry.histogram(
+    "config_io_duration_seconds", "Время чтения, разбора, сериализации и записи config.json", ("operation",)
+)
+config_io_bytes = registry.histogram(
+    "config_io_bytes", "Размер прочитанного и записанного config.json", ("operation",), SIZE_BUCKETS
+)
+config_cache_lookups = registry.counter(
+    "config_cache_lookups_total", "Обращения к кэшу разобранной конфигурации Xray", ("result",)
+)
+
+# Перезапуски Xray
+xray_restarts = registry.counter(
+    "xray_restarts_total", "Перезапуски Xray по результату", ("result",)
+)
+xray_config_checks = registry.counter(
+    "xray_config_checks_total",
+    "Проверки конфигурации перед перезапуском: rejected - найдены ошибки без xray -test, "
+    "skipped - изменились только клиенты, passed/failed - результат xray -test", ("result",)
+)
+xray_restart_downtime = registry.histogram(
+    "xray_restart_downtime_seconds", "Время от команды перезапуска до подтверждения работы Xray"
+)
+
+xray_apply_duration = registry.histogram(
+    "xray_apply_duration_seconds",
+    "Время применения изменений к работающему Xray до подтверждения готовности по способу "
+    "(hot - Xray API, signal, reload, restart)", ("tier",)
+)
+xray_apply_results = registry.counter(
+    "xray_apply_total", "Попытки применения изменений к работающему Xray по способу и результату",
+    ("tier", "result")
+)
+
+# Цикл событий
+loop_lag = registry.histogram(
+    "event_loop_lag_seconds", "Задержка пробуждения пульса цикла событий", buckets=LAG_BUCKETS
+)
+
+
+def timed_methods(cls: type, histogram: Histogram, errors: Counter) -> type:
+    """Обернуть публичные корутины класса измерением времени.
+    
+    Дочерние значения метрик создаются один раз при обертке, вызов
+    добавляет только замер perf_counter и наблюдение. Асинхронные
+    генераторы (потоковое чтение) не оборачиваются.
+    """
+    for name, func in list(vars(cls).items()):
+        if name.startswith("_") or not inspect.iscoroutinefunction(func):
+            continue
+        setattr(cls, name, _timed(func, histogram.labels(name), errors.labels(name)))
+    return cls
+
+
+def _timed(func: Callable, child: HistogramChild, errors: CounterChild) -> Callable:
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except BaseException:
+            errors.inc()
+            raise
+        finally:
+            child.observe(time.perf_counter() - started)
+    return wrapper
+
+
+class MetricsMiddleware:
+    """ASGI middleware: время обработки запросов по шаблону маршрута.
+    
+    Метка route - шаблон пути (/users/{user_uuid}), а не фактический
+    путь, чтобы число рядов не росло с числом пользователей. Маршрут
+    определяется по обработчику, который роутер записывает в scope,
+    дочерние значения метрик кэшируются по (обработчик, метод).
+    """
+    
+    def __init__(self, app):
+        self.app = app
+        self._paths: Optional[Dict[object, str]] = None
+        self._children: Dict[Tuple[object, str], Tuple[HistogramChild, CounterChild]] = {}
+    
+    def _children_for(self, scope) -> Tuple[HistogramChild, CounterChild]:
+        endpoint = scope.get("endpoint")
+        method = scope.get("method", "")
+        key = (endpoint, method)
+        children = self._children.get(key)
+        if children is None:
+            if self._paths is None:
+                routes = getattr(scope.get("app"), "routes", [])
+                self._paths = {route.endpoint: route.path for route in routes if hasattr(route, "endpoint")}
+            path = self._paths.get(endpoint, UNMATCHED_ROUTE)
+            children = (http_request_duration.labels(method, path), http_requests_failed.labels(method, path))
+            self._children[key] = children
+        return children
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        started = time.perf_counter()
+        status_code = 500
+        
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            histogram, failed = self._children_for(scope)
+            histogram.observe(time.perf_counter() - started)
+            if status_code >= 500:
+                failed.inc()
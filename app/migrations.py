@@ -0,0 +1,250 @@
+import logging
+import secrets
+from typing import Awaitable, Callable, List
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+
+class Migration:
+    """Шаг миграции схемы базы данных.
+    
+    Шаги применяются по возрастанию version, каждый в своей транзакции.
+    Номер примененного шага записывается в таблицу schema_version.
+    """
+    
+    def __init__(self, version: int, name: str, apply: Callable[[aiosqlite.Connection], Awaitable[None]]):
+        self.version = version
+        self.name = name
+        self.apply = apply
+
+
+async def _users_indexes(db: aiosqlite.Connection) -> None:
+    """Индексы для списка пользователей, фильтра и подсчета по статусу"""
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_created ON users (created_at, uuid)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_status_created ON users (status, created_at, uuid)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_name ON users (name)")
+
+
+async def _users_email_unique(db: aiosqlite.Connection) -> None:
+    """Уникальный email - он же идентификатор клиента в Xray"""
+    # Пустой email равнозначен отсутствию email
+    await db.execute("UPDATE users SET email = NULL WHERE email = ''")
+    
+    # У повторяющихся email оставляем самого раннего пользователя,
+    # у остальных email сбрасывается (в Xray используется user_<uuid>)
+    cursor = await db.execute("""
+        SELECT uuid, email FROM users AS u
+        WHERE email IS NOT NULL AND EXISTS (
+            SELECT 1 FROM users AS o
+            WHERE o.email = u.email AND (o.created_at, o.uuid) < (u.created_at, u.uuid)
+        )
+    """)
+    duplicates = await cursor.fetchall()
+    for row in duplicates:
+        logger.warning(f"Повторяющийся email {row['email']} сброшен у пользователя {row['uuid']}")
+    if duplicates:
+        await db.executemany(
+            "UPDATE users SET email = NULL WHERE uuid = ?", [(row['uuid'],) for row in duplicates]
+        )
+    
+    await db.execute("DROP INDEX IF EXISTS idx_users_email")
+    await db.execute("""
+        CREATE UNIQUE INDEX idx_users_email ON users (email) WHERE email IS NOT NULL
+    """)
+
+
+async def _user_counters(db: aiosqlite.Connection) -> None:
+    """Счетчики пользователей по статусам, которые поддерживают триггеры"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS user_counters (
+            status TEXT PRIMARY KEY,
+            count INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+    await db.execute("DELETE FROM user_counters")
+    await db.execute("""
+        INSERT INTO user_counters (status, count)
+        SELECT status, COUNT(*) FROM users GROUP BY status
+    """)
+    
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_counters_insert AFTER INSERT ON users
+        BEGIN
+            INSERT INTO user_counters (status, count) VALUES (NEW.status, 1)
+            ON CONFLICT (status) DO UPDATE SET count = count + 1;
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_counters_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE user_counters SET count = count - 1 WHERE status = OLD.status;
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_counters_update AFTER UPDATE OF status ON users
+        WHEN OLD.status IS NOT NEW.status
+        BEGIN
+            UPDATE user_counters SET count = count - 1 WHERE status = OLD.status;
+            INSERT INTO user_counters (status, count) VALUES (NEW.status, 1)
+            ON CONFLICT (status) DO UPDATE SET count = count + 1;
+        END
+    """)
+
+
+async def _users_sub_token(db: aiosqlite.Connection) -> None:
+    """Токен подписки пользователя для GET /sub/{token}"""
+    await db.execute("ALTER TABLE users ADD COLUMN sub_token TEXT")
+    cursor = await db.execute("SELECT uuid FROM users")
+    await db.executemany(
+        "UPDATE users SET sub_token = ? WHERE uuid = ?",
+        [(secrets.token_urlsafe(16), row['uuid']) for row in await cursor.fetchall()]
+    )
+    await db.execute("CREATE UNIQUE INDEX idx_users_sub_token ON users (sub_token)")
+
+
+async def _nodes(db: aiosqlite.Connection) -> None:
+    """Реестр удаленных узлов Xray (агентов), на которые рассылаются изменения"""
+    await db.execute("""
+        CREATE TABLE nodes (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            url TEXT NOT NULL,
+            api_key TEXT NOT NULL,
+            enabled INTEGER NOT NULL DEFAULT 1,
+            created_at TEXT NOT NULL
+        )
+    """)
+
+
+async def _users_generation(db: aiosqlite.Connection) -> None:
+    """Номер поколения набора активных пользователей.
+    
+    Увеличивается триггерами при каждом изменении, влияющем на список
+    клиентов Xray, чтобы сверка пропускала проход, если с прошлого раза
+    ничего не изменилось.
+    """
+    await db.execute("""
+        CREATE TABLE generations (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+    await db.execute("INSERT INTO generations (name, value) VALUES ('users', 0)")
+    
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_generation_insert AFTER INSERT ON users
+        BEGIN
+            UPDATE generations SET value = value + 1 WHERE name = 'users';
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_generation_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE generations SET value = value + 1 WHERE name = 'users';
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_generation_update AFTER UPDATE OF status ON users
+        WHEN OLD.status IS NOT NEW.status
+        BEGIN
+            UPDATE generations SET value = value + 1 WHERE name = 'users';
+        END
+    """)
+
+
+async def _api_keys(db: aiosqlite.Connection) -> None:
+    """API ключи в базе, общей для всех процессов (вместо api_keys.json).
+    
+    Поколения api_keys и nodes позволяют процессам дешево проверять,
+    нужно ли перечитать ключи и реестр узлов.
+    """
+    await db.execute("""
+        CREATE TABLE api_keys (
+            key_hash TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            last_used TEXT,
+            usage_count INTEGER NOT NULL DEFAULT 0,
+            is_active INTEGER NOT NULL DEFAULT 1,
+            expires_at TEXT,
+            revoked_at TEXT
+        ) WITHOUT ROWID
+    """)
+    await db.execute("INSERT INTO generations (name, value) VALUES ('api_keys', 0), ('nodes', 0)")
+    
+    for table in ("api_keys", "nodes"):
+        for event in ("INSERT", "DELETE", "UPDATE"):
+            # Счетчики использования ключей меняются постоянно и на проверку не влияют
+            update_of = " OF is_active, expires_at" if table == "api_keys" and event == "UPDATE" else ""
+            await db.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_generation_{event.lower()}
+                AFTER {event}{update_of} ON {table}
+                BEGIN
+                    UPDATE generations SET value = value + 1 WHERE name = '{table}';
+                END
+            """)
+
+
+async def _user_quotas(db: aiosqlite.Connection) -> None:
+    """Квота трафика, срок действия и периодическое обнуление квоты.
+    
+    Итоги в traffic не обнуляются: traffic_offset хранит итог на момент
+    последнего обнуления, израсходованная квота - разность. Обнуление
+    меняет только строки пользователей, у которых наступил срок.
+    """
+    await db.execute("ALTER TABLE users ADD COLUMN traffic_limit INTEGER")
+    await db.execute("ALTER TABLE users ADD COLUMN traffic_offset INTEGER NOT NULL DEFAULT 0")
+    await db.execute("ALTER TABLE users ADD COLUMN expires_at TEXT")
+    await db.execute("ALTER TABLE users ADD COLUMN reset_period TEXT")
+    await db.execute("ALTER TABLE users ADD COLUMN next_reset_at TEXT")
+    await db.execute("ALTER TABLE users ADD COLUMN suspend_reason TEXT")
+    
+    # Частичные индексы: в них только пользователи с ограничениями
+    await db.execute("""
+        CREATE INDEX idx_users_expires ON users (expires_at) WHERE expires_at IS NOT NULL
+    """)
+    await db.execute("""
+        CREATE INDEX idx_users_next_reset ON users (next_reset_at) WHERE next_reset_at IS NOT NULL
+    """)
+    await db.execute("""
+        CREATE INDEX idx_users_quota ON users (status) WHERE traffic_limit IS NOT NULL
+    """)
+    await db.execute("""
+        CREATE INDEX idx_users_suspend_reason ON users (suspend_reason) WHERE suspend_reason IS NOT NULL
+    """)
+
+
+async def _users_reset_anchor(db: aiosqlite.Connection) -> None:
+    """Дата отсчета обнулений квоты.
+    
+    Следующее обнуление считалось от предыдущего, и день месяца сдвигался
+    (31 января -> 28 февраля -> 28 марта). Теперь все обнуления
+    отсчитываются от reset_anchor. Если период задан при создании,
+    next_reset_at совпадает с created_at по времени суток - отсчет от
+    created_at; иначе дата установки периода неизвестна, и отсчет ведется
+    от уже запланированного обнуления.
+    """
+    await db.execute("ALTER TABLE users ADD COLUMN reset_anchor TEXT")
+    await db.execute("""
+        UPDATE users SET reset_anchor = CASE
+            WHEN substr(next_reset_at, 11) = substr(created_at, 11) THEN created_at
+            ELSE next_reset_at
+        END
+        WHERE reset_period IS NOT NULL AND next_reset_at IS NOT NULL
+    """)
+
+
+# Порядок шагов менять нельзя, новые шаги добавляются только в конец
+MIGRATIONS: List[Migration] = [
+    Migration(1, "users_indexes", _users_indexes),
+    Migration(2, "users_email_unique", _users_email_unique),
+    Migration(3, "user_counters", _user_counters),
+    Migration(4, "users_sub_token", _users_sub_token),
+    Migration(5, "nodes", _nodes),
+    Migration(6, "users_generation", _users_generation),
+    Migration(7, "api_keys", _api_keys),
+    Migration(8, "user_quotas", _user_quotas),
+    Migration(9, "users_reset_anchor", _users_reset_anchor),
+]
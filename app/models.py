@@ -1,7 +1,8 @@
 from datetime import datetime
 from enum import Enum
-from typing import Optional
+from typing import Dict, List, Optional
 from pydantic import BaseModel, Field
+import secrets
 import uuid
 
 class UserStatus(str, Enum):
@@ -10,10 +11,29 @@ class UserStatus(str, Enum):
     SUSPENDED = "suspended"
     DELETED = "deleted"
 
+class ResetPeriod(str, Enum):
+    """Периодичность обнуления квоты трафика"""
+    MONTHLY = "monthly"
+
+class SuspendReason(str, Enum):
+    """Причина автоматической приостановки пользователя"""
+    QUOTA = "quota"
+    EXPIRED = "expired"
+
 class UserCreate(BaseModel):
     """Модель для создания пользователя"""
     name: Optional[str] = Field(None, description="Имя пользователя")
     email: Optional[str] = Field(None, description="Email пользователя")
+    traffic_limit: Optional[int] = Field(None, ge=0, description="Квота трафика за период в байтах")
+    expires_at: Optional[datetime] = Field(None, description="Дата окончания доступа")
+    reset_period: Optional[ResetPeriod] = Field(None, description="Периодичность обнуления квоты")
+
+class NodeOperationResult(BaseModel):
+    """Результат операции с пользователями на одном узле"""
+    success: bool = Field(..., description="Все элементы применены на узле")
+    failed: int = Field(..., description="Количество неуспешных элементов")
+    attempts: int = Field(..., description="Количество попыток")
+    error: Optional[str] = Field(None, description="Ошибка последней попытки")
 
 class UserResponse(BaseModel):
     """Модель ответа при создании/получении пользователя"""
@@ -21,14 +41,74 @@ class UserResponse(BaseModel):
     name: Optional[str] = Field(None, description="Имя пользователя")
     email: Optional[str] = Field(None, description="Email пользователя")
     vless_link: str = Field(..., description="VLESS ссылка для подключения")
+    subscription_url: Optional[str] = Field(None, description="Путь подписки (/sub/{token})")
+    nodes: Optional[Dict[str, NodeOperationResult]] = Field(None, description="Результаты по узлам (при создании)")
     status: UserStatus = Field(..., description="Статус пользователя")
+    suspend_reason: Optional[SuspendReason] = Field(None, description="Причина автоматической приостановки")
+    traffic_limit: Optional[int] = Field(None, description="Квота трафика за период в байтах")
+    expires_at: Optional[datetime] = Field(None, description="Дата окончания доступа")
+    reset_period: Optional[ResetPeriod] = Field(None, description="Периодичность обнуления квоты")
+    next_reset_at: Optional[datetime] = Field(None, description="Дата следующего обнуления квоты")
     created_at: datetime = Field(..., description="Дата создания")
     updated_at: datetime = Field(..., description="Дата последнего обновления")
 
 class UserUpdate(BaseModel):
-    """Модель для обновления пользователя"""
+    """Модель для обновления пользователя (null в квоте или сроке снимает ограничение)"""
     name: Optional[str] = Field(None, description="Имя пользователя")
     email: Optional[str] = Field(None, description="Email пользователя")
+    traffic_limit: Optional[int] = Field(None, ge=0, description="Квота трафика за период в байтах")
+    expires_at: Optional[datetime] = Field(None, description="Дата окончания доступа")
+    reset_period: Optional[ResetPeriod] = Field(None, description="Периодичность обнуления квоты")
+
+class UserBatchCreate(BaseModel):
+    """Модель для пакетного создания пользователей"""
+    users: List[UserCreate] = Field(..., min_length=1, description="Создаваемые пользователи")
+
+class UserBatchRequest(BaseModel):
+    """Модель пакетной операции над существующими пользователями"""
+    uuids: List[str] = Field(..., min_length=1, description="UUID пользователей")
+
+class BatchItemResult(BaseModel):
+    """Результат пакетной операции для одного пользователя"""
+    uuid: str = Field(..., description="UUID пользователя")
+    success: bool = Field(..., description="Успешность операции")
+    message: Optional[str] = Field(None, description="Сообщение или описание ошибки")
+    vless_link: Optional[str] = Field(None, description="VLESS ссылка (для созданных пользователей)")
+
+class BatchResponse(BaseModel):
+    """Модель ответа пакетной операции"""
+    success: bool = Field(..., description="Все операции выполнены успешно")
+    total: int = Field(..., description="Количество обработанных элементов")
+    failed: int = Field(..., description="Количество неуспешных элементов")
+    results: List[BatchItemResult] = Field(..., description="Результаты по каждому элементу")
+    nodes: Optional[Dict[str, NodeOperationResult]] = Field(None, description="Результаты по узлам")
+
+class NodeCreate(BaseModel):
+    """Модель регистрации удаленного узла"""
+    name: str = Field(..., min_length=1, description="Название узла")
+    url: str = Field(..., description="Адрес API агента, например https://node1:8000")
+    api_key: str = Field(..., min_length=1, description="API ключ агента")
+
+class NodeInfo(BaseModel):
+    """Модель ответа с информацией об узле"""
+    id: str = Field(..., description="Идентификатор узла")
+    name: str = Field(..., description="Название узла")
+    url: str = Field(..., description="Адрес API агента")
+    enabled: bool = Field(..., description="Узел используется")
+    created_at: datetime = Field(..., description="Дата регистрации")
+
+class AgentUser(BaseModel):
+    """Клиент, добавляемый на узел агентом"""
+    uuid: str = Field(..., description="UUID пользователя")
+    email: Optional[str] = Field(None, description="Email пользователя")
+
+class AgentUsersRequest(BaseModel):
+    """Добавление клиентов на узел"""
+    users: List[AgentUser] = Field(..., description="Клиенты")
+
+class AgentResultsResponse(BaseModel):
+    """Результаты операции агента по каждому элементу"""
+    results: List[bool] = Field(..., description="Успешность по каждому элементу")
 
 class TrafficResponse(BaseModel):
     """Модель ответа с информацией о трафике"""
@@ -36,8 +116,24 @@ class TrafficResponse(BaseModel):
     upload: int = Field(..., description="Исходящий трафик в байтах")
     download: int = Field(..., description="Входящий трафик в байтах")
     total: int = Field(..., description="Общий трафик в байтах")
+    used: int = Field(..., description="Трафик с последнего обнуления квоты в байтах")
+    traffic_limit: Optional[int] = Field(None, description="Квота трафика за период в байтах")
     last_updated: datetime = Field(..., description="Время последнего обновления")
 
+class TrafficPoint(BaseModel):
+    """Трафик пользователя за один интервал истории"""
+    timestamp: datetime = Field(..., description="Начало интервала (UTC)")
+    upload: int = Field(..., description="Исходящий трафик в байтах")
+    download: int = Field(..., description="Входящий трафик в байтах")
+    total: int = Field(..., description="Общий трафик в байтах")
+
+class TrafficHistoryResponse(BaseModel):
+    """Модель ответа с историей трафика"""
+    uuid: str = Field(..., description="UUID пользователя")
+    step: int = Field(..., description="Длина интервала в секундах")
+    resolution: int = Field(..., description="Уровень агрегации, из которого построен ответ (секунды)")
+    points: List[TrafficPoint] = Field(..., description="Интервалы с ненулевым трафиком")
+
 class StatusResponse(BaseModel):
     """Модель ответа статуса сервиса"""
     xray_status: str = Field(..., description="Статус Xray сервиса")
@@ -64,13 +160,25 @@ class User:
     """Модель пользователя для базы данных"""
     def __init__(self, uuid: str, name: Optional[str] = None, email: Optional[str] = None,
                  status: UserStatus = UserStatus.ACTIVE, created_at: Optional[datetime] = None,
-                 updated_at: Optional[datetime] = None):
+                 updated_at: Optional[datetime] = None, sub_token: Optional[str] = None,
+                 traffic_limit: Optional[int] = None, expires_at: Optional[datetime] = None,
+                 reset_period: Optional[ResetPeriod] = None, next_reset_at: Optional[datetime] = None,
+                 suspend_reason: Optional[SuspendReason] = None, reset_anchor: Optional[datetime] = None):
         self.uuid = uuid
         self.name = name
         self.email = email
         self.status = status
         self.created_at = created_at or datetime.utcnow()
         self.updated_at = updated_at or datetime.utcnow()
+        self.sub_token = sub_token or secrets.token_urlsafe(16)
+        # Квота и срок действия (даты - UTC без часового пояса, как created_at)
+        self.traffic_limit = traffic_limit
+        self.expires_at = expires_at
+        self.reset_period = reset_period
+        self.next_reset_at = next_reset_at
+        # Дата, от которой отсчитываются обнуления (день месяца не сдвигается)
+        self.reset_anchor = reset_anchor
+        self.suspend_reason = suspend_reason
     
     def to_dict(self) -> dict:
         """Преобразовать в словарь"""
@@ -80,7 +188,14 @@ class User:
             'email': self.email,
             'status': self.status.value,
             'created_at': self.created_at.isoformat(),
-            'updated_at': self.updated_at.isoformat()
+            'updated_at': self.updated_at.isoformat(),
+            'sub_token': self.sub_token,
+            'traffic_limit': self.traffic_limit,
+            'expires_at': self.expires_at.isoformat() if self.expires_at else None,
+            'reset_period': self.reset_period.value if self.reset_period else None,
+            'next_reset_at': self.next_reset_at.isoformat() if self.next_reset_at else None,
+            'suspend_reason': self.suspend_reason.value if self.suspend_reason else None,
+            'reset_anchor': self.reset_anchor.isoformat() if self.reset_anchor else None
         }
     
     @classmethod
@@ -92,5 +207,12 @@ class User:
             email=data.get('email'),
             status=UserStatus(data['status']),
             created_at=datetime.fromisoformat(data['created_at']),
-            updated_at=datetime.fromisoformat(data['updated_at'])
-        )
\ No newline at end of file
+            updated_at=datetime.fromisoformat(data['updated_at']),
+            sub_token=data.get('sub_token'),
+            traffic_limit=data.get('traffic_limit'),
+            expires_at=datetime.fromisoformat(data['expires_at']) if data.get('expires_at') else None,
+            reset_period=ResetPeriod(data['reset_period']) if data.get('reset_period') else None,
+            next_reset_at=datetime.fromisoformat(data['next_reset_at']) if data.get('next_reset_at') else None,
+            suspend_reason=SuspendReason(data['suspend_reason']) if data.get('suspend_reason') else None,
+            reset_anchor=datetime.fromisoformat(data['reset_anchor']) if data.get('reset_anchor') else None
+        )
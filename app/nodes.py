@@ -0,0 +1,315 @@
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Set
+
+from .config import settings
+from .database import database
+from .models import User, UserStatus
+from .xray_manager import xray_manager
+
+try:
+    import httpx
+except ImportError:  # httpx не установлен - удаленные узлы недоступны
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+# Идентификатор локального узла (Xray на этом же сервере)
+LOCAL_NODE_ID = "local"
+
+# Операции с пользователями на узлах
+OP_ADD = "add"
+OP_REMOVE = "remove"
+OP_SUSPEND = "suspend"
+
+
+class NodeDriver(ABC):
+    """Узел с Xray, на который применяются изменения пользователей.
+    
+    Все операции пакетные и возвращают результат для каждого элемента.
+    Повторное добавление существующего клиента и удаление отсутствующего
+    считаются успешными, поэтому операции можно безопасно повторять.
+    """
+    
+    def __init__(self, node_id: str, name: str):
+        self.node_id = node_id
+        self.name = name
+    
+    @abstractmethod
+    async def add_users(self, users: List[User]) -> List[bool]:
+        """Добавить клиентов"""
+    
+    @abstractmethod
+    async def remove_users(self, user_uuids: List[str]) -> List[bool]:
+        """Удалить клиентов"""
+    
+    @abstractmethod
+    async def suspend_users(self, user_uuids: List[str]) -> List[bool]:
+        """Приостановить клиентов"""
+    
+    @abstractmethod
+    async def list_clients(self) -> Optional[Set[str]]:
+        """UUID клиентов, настроенных на узле (None - узел недоступен)"""
+    
+    async def close(self) -> None:
+        """Освободить ресурсы драйвера"""
+
+
+class LocalNodeDriver(NodeDriver):
+    """Локальный Xray: config.json и сервис на этом сервере"""
+    
+    def __init__(self):
+        super().__init__(LOCAL_NODE_ID, LOCAL_NODE_ID)
+    
+    async def add_users(self, users: List[User]) -> List[bool]:
+        return await xray_manager.add_users(users)
+    
+    async def remove_users(self, user_uuids: List[str]) -> List[bool]:
+        return await xray_manager.remove_users(user_uuids)
+    
+    async def suspend_users(self, user_uuids: List[str]) -> List[bool]:
+        return await xray_manager.suspend_users(user_uuids)
+    
+    async def list_clients(self) -> Optional[Set[str]]:
+        return await xray_manager.list_client_ids()
+
+
+class RemoteAgentDriver(NodeDriver):
+    """Удаленный узел, на котором запущен этот же сервис в роли агента.
+    
+    Изменения передаются на эндпоинты /agent/* агента с его API ключом.
+    """
+    
+    def __init__(self, node_id: str, name: str, url: str, api_key: str, timeout: float = None):
+        super().__init__(node_id, name)
+        self.url = url.rstrip("/")
+        self.api_key = api_key
+        self.timeout = timeout or settings.NODE_TIMEOUT
+        self._client = None
+    
+    def _get_client(self):
+        """Получить (или создать) HTTP клиент узла"""
+        if httpx is None:
+            raise RuntimeError("httpx не установлен")
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.url,
+                headers={"Authorization": f"Bearer {self.api_key}"},
+                timeout=self.timeout
+            )
+        return self._client
+    
+    async def _post(self, path: str, payload: Dict, count: int) -> List[bool]:
+        response = await self._get_client().post(path, json=payload)
+        response.raise_for_status()
+        results = response.json().get("results", [])
+        if len(results) != count:
+            raise RuntimeError(f"агент вернул {len(results)} результатов вместо {count}")
+        return [bool(result) for result in results]
+    
+    async def add_users(self, users: List[User]) -> List[bool]:
+        payload = {"users": [{"uuid": user.uuid, "email": user.email} for user in users]}
+        return await self._post("/agent/users", payload, len(users))
+    
+    async def remove_users(self, user_uuids: List[str]) -> List[bool]:
+        return await self._post("/agent/users/remove", {"uuids": user_uuids}, len(user_uuids))
+    
+    async def suspend_users(self, user_uuids: List[str]) -> List[bool]:
+        return await self._post("/agent/users/suspend", {"uuids": user_uuids}, len(user_uuids))
+    
+    async def list_clients(self) -> Optional[Set[str]]:
+        response = await self._get_client().get("/agent/clients")
+        response.raise_for_status()
+        return set(response.json().get("uuids", []))
+    
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class NodeResult:
+    """Результат операции на одном узле"""
+    
+    def __init__(self, node: str, results: List[bool], error: Optional[str] = None, attempts: int = 1):
+        self.node = node
+        self.results = results
+        self.error = error
+        self.attempts = attempts
+    
+    @property
+    def success(self) -> bool:
+        return self.error is None and all(self.results)
+    
+    def to_dict(self) -> Dict:
+        return {
+            "success": self.success,
+            "failed": sum(1 for ok in self.results if not ok),
+            "attempts": self.attempts,
+            "error": self.error
+        }
+
+
+class FleetResult:
+    """Результат операции на всех узлах.
+    
+    results - результаты локального узла по каждому элементу: по ним
+    принимается решение об изменении базы. Расхождения удаленных узлов
+    исправляет цикл сходимости.
+    """
+    
+    def __init__(self, local: NodeResult, remote: List[NodeResult]):
+        self.local = local
+        self.remote = remote
+    
+    @property
+    def results(self) -> List[bool]:
+        return self.local.results
+    
+    def nodes(self) -> Dict[str, Dict]:
+        """Сводка по узлам для ответа API (ключ - название узла)"""
+        return {result.node: result.to_dict() for result in [self.local, *self.remote]}
+
+
+class NodeFleet:
+    """Реестр узлов и параллельная рассылка изменений пользователей"""
+    
+    def __init__(self):
+        self.local = LocalNodeDriver()
+        self.remote: Dict[str, RemoteAgentDriver] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        # Поколение узлов в базе, соответствующее реестру
+        self._generation: Optional[int] = None
+    
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(settings.NODE_FANOUT_CONCURRENCY)
+        return self._semaphore
+    
+    async def load(self) -> None:
+        """Загрузить удаленные узлы из базы данных"""
+        self._generation = await database.get_generation("nodes")
+        for node in await database.get_nodes():
+            if node["enabled"]:
+                self.register(node)
+        if self.remote:
+            logger.info(f"Загружено удаленных узлов: {len(self.remote)}")
+    
+    async def refresh(self) -> bool:
+        """Перезагрузить реестр, если узлы изменил этот или другой процесс"""
+        try:
+            generation = await database.get_generation("nodes")
+            if generation == self._generation:
+                return False
+            nodes = {node["id"]: node for node in await database.get_nodes() if node["enabled"]}
+        except Exception as e:
+            logger.error(f"Ошибка загрузки узлов: {e}")
+            return False
+        
+        for node_id in list(self.remote.keys() - nodes.keys()):
+            await self.unregister(node_id)
+        for node_id, node in nodes.items():
+            if node_id not in self.remote:
+                self.register(node)
+        self._generation = generation
+        return True
+    
+    def register(self, node: Dict) -> None:
+        """Добавить удаленный узел в реестр"""
+        if httpx is None:
+            logger.warning(f"httpx не установлен, узел {node['name']} не используется")
+            return
+        self.remote[node["id"]] = RemoteAgentDriver(node["id"], node["name"], node["url"], node["api_key"])
+    
+    async def unregister(self, node_id: str) -> None:
+        """Удалить удаленный узел из реестра"""
+        driver = self.remote.pop(node_id, None)
+        if driver is not None:
+            await driver.close()
+    
+    async def close(self) -> None:
+        for driver in self.remote.values():
+            await driver.close()
+        self.remote.clear()
+    
+    async def _call_remote(self, driver: NodeDriver, op: str, items: List) -> NodeResult:
+        """Выполнить операцию на удаленном узле с таймаутом и повторами"""
+        attempts = 1 + settings.NODE_RETRIES
+        error = None
+        async with self._get_semaphore():
+            for attempt in range(1, attempts + 1):
+                try:
+                    results = await asyncio.wait_for(
+                        getattr(driver, f"{op}_users")(items), timeout=settings.NODE_TIMEOUT
+                    )
+                    return NodeResult(driver.name, results, attempts=attempt)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    error = str(e) or type(e).__name__
+                    logger.warning(f"Узел {driver.name}: ошибка операции {op} (попытка {attempt}/{attempts}): {error}")
+                if attempt < attempts:
+                    await asyncio.sleep(settings.NODE_RETRY_BACKOFF * 2 ** (attempt - 1))
+        return NodeResult(driver.name, [False] * len(items), error=error, attempts=attempts)
+    
+    async def _call_local(self, op: str, items: List) -> NodeResult:
+        results = await getattr(self.local, f"{op}_users")(items)
+        return NodeResult(LOCAL_NODE_ID, results)
+    
+    async def _fan_out(self, op: str, items: List) -> FleetResult:
+        """Применить операцию на всех узлах параллельно"""
+        if not items:
+            return FleetResult(NodeResult(LOCAL_NODE_ID, []), [])
+        local, *remote = await asyncio.gather(
+            self._call_local(op, items),
+            *(self._call_remote(driver, op, items) for driver in self.remote.values())
+        )
+        return FleetResult(local, remote)
+    
+    async def add_users(self, users: List[User]) -> FleetResult:
+        return await self._fan_out(OP_ADD, users)
+    
+    async def remove_users(self, user_uuids: List[str]) -> FleetResult:
+        return await self._fan_out(OP_REMOVE, user_uuids)
+    
+    async def suspend_users(self, user_uuids: List[str]) -> FleetResult:
+        return await self._fan_out(OP_SUSPEND, user_uuids)
+    
+    async def _converge_node(self, driver: NodeDriver, desired: Dict[str, User]) -> Dict:
+        """Привести набор клиентов узла к активным пользователям базы"""
+        async with self._get_semaphore():
+            try:
+                clients = await asyncio.wait_for(driver.list_clients(), timeout=settings.NODE_TIMEOUT)
+            except Exception as e:
+                return {"added": 0, "removed": 0, "error": str(e) or type(e).__name__}
+        if clients is None:
+            return {"added": 0, "removed": 0, "error": "конфигурация недоступна"}
+        
+        missing = [desired[user_uuid] for user_uuid in desired.keys() - clients]
+        extra = list(clients - desired.keys())
+        summary = {"added": 0, "removed": 0, "error": None}
+        if missing:
+            result = await self._call_remote(driver, OP_ADD, missing)
+            summary["added"] = sum(result.results)
+            summary["error"] = result.error
+        if extra:
+            result = await self._call_remote(driver, OP_REMOVE, extra)
+            summary["removed"] = sum(result.results)
+            summary["error"] = summary["error"] or result.error
+        if missing or extra:
+            logger.info(f"Узел {driver.name}: добавлено {summary['added']}, удалено {summary['removed']}")
+        return summary
+    
+    async def converge(self) -> Dict[str, Dict]:
+        """Цикл сходимости: исправить расхождения удаленных узлов с базой"""
+        if not self.remote:
+            return {}
+        desired = {user.uuid: user async for user in database.iter_users(status=UserStatus.ACTIVE)}
+        drivers = list(self.remote.values())
+        summaries = await asyncio.gather(*(self._converge_node(driver, desired) for driver in drivers))
+        return {driver.name: summary for driver, summary in zip(drivers, summaries)}
+
+
+# Глобальный реестр узлов
+fleet = NodeFleet()
@@ -0,0 +1,81 @@
+import asyncio
+import logging
+import os
+import time
+from typing import List, Optional, Tuple
+
+from .config import settings
+from .metrics import subprocess_duration, subprocess_failures
+
+logger = logging.getLogger(__name__)
+
+# Код возврата команды, прерванной по таймауту (как у timeout(1))
+TIMEOUT_RETURNCODE = 124
+
+
+class ProcessRunner:
+    """Запуск дочерних процессов с таймаутом и ограничением параллелизма.
+    
+    Одновременно выполняется не больше max_concurrency процессов, остальные
+    ждут очереди. Процесс, не завершившийся за таймаут, и процесс, ожидание
+    которого отменено (остановка сервиса, отмена запроса), принудительно
+    завершается, чтобы не оставлять зависших xray -test и systemctl.
+    """
+    
+    def __init__(self, timeout: float = None, max_concurrency: int = None):
+        self.timeout = timeout or settings.PROCESS_TIMEOUT
+        self.max_concurrency = max_concurrency or settings.PROCESS_MAX_CONCURRENCY
+        self._semaphore: Optional[asyncio.Semaphore] = None
+    
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+    
+    @staticmethod
+    async def _kill(process: asyncio.subprocess.Process) -> None:
+        """Завершить процесс и дождаться его, чтобы не оставить зомби"""
+        if process.returncode is None:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+        await process.wait()
+    
+    async def run(self, command: List[str], timeout: float = None) -> Tuple[int, str, str]:
+        """Выполнить команду и вернуть (код возврата, stdout, stderr)"""
+        timeout = timeout or self.timeout
+        name = os.path.basename(command[0])
+        async with self._get_semaphore():
+            started = time.perf_counter()
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *command,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE
+                )
+            except Exception as e:
+                subprocess_failures.labels(name).inc()
+                logger.error(f"Ошибка выполнения команды {' '.join(command)}: {e}")
+                return 1, "", str(e)
+            
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+            except asyncio.TimeoutError:
+                await self._kill(process)
+                subprocess_failures.labels(name).inc()
+                logger.error(f"Команда {' '.join(command)} не завершилась за {timeout} с и остановлена")
+                return TIMEOUT_RETURNCODE, "", f"таймаут {timeout} с"
+            except asyncio.CancelledError:
+                await self._kill(process)
+                raise
+            finally:
+                subprocess_duration.labels(name).observe(time.perf_counter() - started)
+            
+            if process.returncode != 0:
+                subprocess_failures.labels(name).inc()
+            return process.returncode, stdout.decode(), stderr.decode()
+
+
+# Глобальный запуск дочерних процессов
+process_runner = ProcessRunner()
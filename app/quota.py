@@ -0,0 +1,149 @@
+import asyncio
+import calendar
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from .coordination import users_lock
+from .database import database
+from .models import ResetPeriod, UserStatus
+from .nodes import fleet
+
+logger = logging.getLogger(__name__)
+
+# Сколько UUID включать в отчет
+REPORT_UUIDS_LIMIT = 100
+
+
+def to_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Привести дату к UTC без часового пояса (так даты хранятся в базе)"""
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def add_months(value: datetime, months: int) -> datetime:
+    """Сдвинуть дату на месяцы; 31 января + 1 месяц = последний день февраля"""
+    month = value.month - 1 + months
+    year = value.year + month // 12
+    month = month % 12 + 1
+    day = min(value.day, calendar.monthrange(year, month)[1])
+    return value.replace(year=year, month=month, day=day)
+
+
+def next_reset(anchor: datetime, period: ResetPeriod, now: Optional[datetime] = None) -> datetime:
+    """Ближайшая дата обнуления квоты позже now, отсчитываемая от anchor.
+    
+    Все обнуления считаются от одной даты отсчета, а не от предыдущего
+    обнуления: день месяца anchor ограничивается длиной каждого месяца,
+    но не сдвигается (31 января -> 28 февраля -> 31 марта). Если сервис не
+    работал несколько периодов, пропущенные обнуления не выполняются по
+    очереди - выбирается первая дата в будущем.
+    """
+    now = now or datetime.utcnow()
+    months = 1
+    candidate = add_months(anchor, months)
+    while candidate <= now:
+        months += 1
+        candidate = add_months(anchor, months)
+    return candidate
+
+
+class QuotaEnforcer:
+    """Применение квот трафика и сроков действия пользователей.
+    
+    После каждого сбора трафика пользователи, получившие приращения,
+    проверяются одним запросом; периодический проход проверяет всех
+    (истечение срока не зависит от трафика), обнуляет квоты, у которых
+    наступил срок, и возвращает пользователей, ограничения которых сняты.
+    Все приостановки (и возобновления) прохода применяются к Xray одним
+    пакетным изменением на каждом узле.
+    """
+    
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        self.last_report: Optional[Dict] = None
+        self.runs = 0
+        self.suspended_total = 0
+        self.restored_total = 0
+    
+    async def enforce(self, uuids: Optional[List[str]] = None) -> Dict:
+        """Приостановить нарушителей среди uuids (None - среди всех активных)"""
+        async with self._lock:
+            return await self._suspend(datetime.utcnow(), uuids)
+    
+    async def _suspend(self, now: datetime, uuids: Optional[List[str]]) -> Dict:
+        report = {"suspended": 0, "failed": 0, "suspended_uuids": []}
+        violations = await database.get_quota_violations(now, uuids)
+        if not violations:
+            return report
+        
+        pending = list(violations)
+        async with users_lock.shared():
+            fleet_result = await fleet.suspend_users(pending)
+            applied = {user_uuid: violations[user_uuid] for user_uuid, ok in zip(pending, fleet_result.results) if ok}
+            if applied:
+                await database.set_auto_suspended(applied)
+        
+        report["suspended"] = len(applied)
+        report["failed"] = len(pending) - len(applied)
+        report["suspended_uuids"] = list(applied)[:REPORT_UUIDS_LIMIT]
+        self.suspended_total += len(applied)
+        logger.info(f"Приостановлено по квоте или сроку: {len(applied)}, ошибок {report['failed']}")
+        return report
+    
+    async def _reset_due(self, now: datetime) -> int:
+        """Обнулить квоты, у которых наступил срок"""
+        due = await database.get_due_resets(now)
+        if not due:
+            return 0
+        schedule = [(user_uuid, next_reset(anchor, period, now)) for user_uuid, anchor, period in due]
+        reset = await database.reset_traffic_quotas(schedule)
+        logger.info(f"Обнулена квота трафика у {reset} пользователей")
+        return reset
+    
+    async def _restore(self, now: datetime) -> Dict:
+        """Возобновить автоматически приостановленных, если ограничения сняты"""
+        report = {"restored": 0, "restore_failed": 0}
+        users = await database.get_restorable_users(now)
+        if not users:
+            return report
+        
+        async with users_lock.shared():
+            fleet_result = await fleet.add_users(users)
+            applied = [user.uuid for user, ok in zip(users, fleet_result.results) if ok]
+            if applied:
+                await database.update_users_status(applied, UserStatus.ACTIVE)
+        
+        report["restored"] = len(applied)
+        report["restore_failed"] = len(users) - len(applied)
+        self.restored_total += len(applied)
+        logger.info(f"Возобновлено после снятия ограничений: {len(applied)}")
+        return report
+    
+    async def run(self) -> Dict:
+        """Полный проход: обнуление квот, возобновление, приостановка (для фоновой задачи)"""
+        started = time.perf_counter()
+        async with self._lock:
+            now = datetime.utcnow()
+            report = {"started_at": now.isoformat(), "reset": await self._reset_due(now)}
+            report.update(await self._restore(now))
+            report.update(await self._suspend(now, None))
+        report["duration_ms"] = round((time.perf_counter() - started) * 1000, 3)
+        self.runs += 1
+        self.last_report = report
+        return report
+    
+    def stats(self) -> Dict:
+        """Статистика применения квот"""
+        return {
+            "runs": self.runs,
+            "suspended_total": self.suspended_total,
+            "restored_total": self.restored_total,
+            "last_report": self.last_report,
+        }
+
+
+# Глобальный экземпляр применения квот
+quota_enforcer = QuotaEnforcer()
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from .coordination import users_lock
+from .database import database
+from .models import UserStatus
+from .xray_manager import xray_manager
+
+logger = logging.getLogger(__name__)
+
+# Сколько UUID каждого вида включать в отчет
+REPORT_UUIDS_LIMIT = 100
+
+
+class Reconciler:
+    """Сверка активных пользователей базы с клиентами локального Xray.
+    
+    Желаемое состояние - множество активных пользователей базы, фактическое -
+    клиенты всех VLESS inbound конфигурации. Недостающие клиенты добавляются,
+    лишние (удаленные, приостановленные и неизвестные базе) удаляются,
+    все изменения применяются одной записью конфигурации.
+    
+    Проход пропускается без чтения пользователей, если не изменились ни
+    поколение пользователей в базе, ни подпись файла конфигурации с прошлой
+    успешной сверки.
+    
+    Операции API и квот сначала меняют Xray, затем базу. Сверка между
+    этими шагами вернула бы приостановленного пользователя в Xray (или
+    удалила бы возобновленного), поэтому такие операции держат общую
+    users_lock, а сверка читает и применяет изменения под эксклюзивной.
+    """
+    
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        # (поколение пользователей, подпись конфигурации) последней успешной сверки
+        self._state: Optional[Tuple[int, Optional[tuple]]] = None
+        self.last_report: Optional[Dict] = None
+        self.runs = 0
+        self.skipped = 0
+    
+    async def reconcile(self, force: bool = False) -> Dict:
+        """Выполнить сверку и вернуть отчет об изменениях"""
+        async with self._lock:
+            report = await self._reconcile(force)
+        self.last_report = report
+        return report
+    
+    async def _reconcile(self, force: bool) -> Dict:
+        started = time.perf_counter()
+        report = {
+            "started_at": datetime.utcnow().isoformat(),
+            "skipped": False,
+            "added": 0,
+            "removed": 0,
+            "failed": 0,
+            "added_uuids": [],
+            "removed_uuids": [],
+            "error": None,
+        }
+        self.runs += 1
+        
+        # Поколение читается до снимков: изменения, сделанные во время сверки,
+        # увеличат его, и следующий проход не будет пропущен
+        generation = await database.get_generation()
+        
+        # Клиенты Xray и активные пользователи читаются и сверяются под
+        # эксклюзивной блокировкой: ни одна операция не находится между
+        # изменением Xray и записью в базу
+        async with users_lock.exclusive():
+            client_state = await xray_manager.client_state()
+            if client_state is None:
+                report["error"] = "конфигурация Xray недоступна"
+                report["duration_ms"] = round((time.perf_counter() - started) * 1000, 3)
+                return report
+            signature, clients = client_state
+            
+            if not force and self._state == (generation, signature):
+                self.skipped += 1
+                report["skipped"] = True
+                report["duration_ms"] = round((time.perf_counter() - started) * 1000, 3)
+                return report
+            
+            await self._apply(await database.get_active_uuids(), clients, report)
+        
+        # Запоминаем состояние только если все расхождения устранены;
+        # после собственной записи подпись файла изменится, и следующий
+        # проход один раз подтвердит результат
+        if not report["failed"]:
+            self._state = (generation, signature)
+        report["duration_ms"] = round((time.perf_counter() - started) * 1000, 3)
+        return report
+    
+    async def _apply(self, active: set, clients: set, report: Dict) -> None:
+        """Добавить недостающих и удалить лишних клиентов Xray"""
+        missing = active - clients
+        extra = clients - active
+        
+        # Пустая база при непустой конфигурации - скорее всего, потерянная
+        # или не та база, а не удаление всех пользователей
+        if not active and extra:
+            logger.warning(
+                f"В базе нет активных пользователей, удаление {len(extra)} клиентов Xray пропущено"
+            )
+            report["error"] = "в базе нет активных пользователей, удаление клиентов пропущено"
+            extra = set()
+        
+        if not missing and not extra:
+            return
+        
+        # Статус перечитывается вместе с данными пользователей: добавляются
+        # только те, кто по-прежнему активен
+        users = await database.get_users(list(missing))
+        add = [
+            users[user_uuid] for user_uuid in missing
+            if user_uuid in users and users[user_uuid].status == UserStatus.ACTIVE
+        ]
+        remove = list(extra)
+        results = await xray_manager.sync_clients(add, remove)
+        
+        added = [user.uuid for user, ok in zip(add, results) if ok]
+        removed = [user_uuid for user_uuid, ok in zip(remove, results[len(add):]) if ok]
+        report["added"] = len(added)
+        report["removed"] = len(removed)
+        report["failed"] = len(results) - len(added) - len(removed)
+        report["added_uuids"] = added[:REPORT_UUIDS_LIMIT]
+        report["removed_uuids"] = removed[:REPORT_UUIDS_LIMIT]
+        logger.info(
+            f"Сверка с Xray: добавлено {len(added)}, удалено {len(removed)}, "
+            f"ошибок {report['failed']}"
+        )
+    
+    async def run(self) -> None:
+        """Периодическая сверка (для фоновой задачи)"""
+        await self.reconcile()
+    
+    def stats(self) -> Dict:
+        """Статистика сверок"""
+        return {
+            "runs": self.runs,
+            "skipped": self.skipped,
+            "last_report": self.last_report,
+        }
+
+
+# Глобальный экземпляр сверки
+reconciler = Reconciler()
@@ -0,0 +1,313 @@
+import asyncio
+import logging
+import os
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from .config import settings
+from .process_runner import ProcessRunner, process_runner
+
+try:
+    from dbus_next import BusType, Message, MessageType
+    from dbus_next.aio import MessageBus
+except ImportError:  # dbus-next не установлен - сервисом управляет systemctl
+    MessageBus = None
+
+logger = logging.getLogger(__name__)
+
+# Способы управления сервисом (XRAY_SERVICE_CONTROL)
+CONTROL_AUTO = "auto"
+CONTROL_DBUS = "dbus"
+CONTROL_SYSTEMCTL = "systemctl"
+
+# systemd на системной шине
+SYSTEMD_BUS_NAME = "org.freedesktop.systemd1"
+SYSTEMD_PATH = "/org/freedesktop/systemd1"
+SYSTEMD_MANAGER = "org.freedesktop.systemd1.Manager"
+SYSTEMD_UNIT = "org.freedesktop.systemd1.Unit"
+SYSTEMD_SERVICE = "org.freedesktop.systemd1.Service"
+SYSTEMD_JOB = "org.freedesktop.systemd1.Job"
+DBUS_PROPERTIES = "org.freedesktop.DBus.Properties"
+DBUS_UNKNOWN_OBJECT = "org.freedesktop.DBus.Error.UnknownObject"
+SYSTEM_BUS_SOCKET = "/run/dbus/system_bus_socket"
+
+# Каталоги cgroup сервисов: cgroup v2 и именованная иерархия systemd в cgroup v1
+CGROUP_SERVICE_DIRS = ("/sys/fs/cgroup/system.slice", "/sys/fs/cgroup/systemd/system.slice")
+
+
+def unit_name(service: str) -> str:
+    """Имя юнита systemd (xray -> xray.service)"""
+    return service if "." in service else f"{service}.service"
+
+
+class ServiceManager(ABC):
+    """Управление сервисом Xray (перезапуск, reload и состояние)"""
+    
+    backend = ""
+    
+    @abstractmethod
+    async def restart(self, service: str) -> Tuple[bool, str]:
+        """Перезапустить сервис, вернуть (успех, описание ошибки)"""
+    
+    @abstractmethod
+    async def reload(self, service: str) -> Tuple[bool, str]:
+        """Перечитать конфигурацию сервиса без перезапуска (ExecReload юнита)"""
+    
+    @abstractmethod
+    async def can_reload(self, service: str) -> bool:
+        """Поддерживает ли юнит reload"""
+    
+    @abstractmethod
+    async def main_pid(self, service: str) -> Optional[int]:
+        """PID основного процесса сервиса (None - не запущен или неизвестен)"""
+    
+    @abstractmethod
+    async def is_active(self, service: str) -> bool:
+        """Активен ли сервис"""
+    
+    @abstractmethod
+    async def status(self, service: str) -> Tuple[bool, str]:
+        """Состояние сервиса: (активен, подробности)"""
+    
+    async def close(self) -> None:
+        """Освободить ресурсы"""
+
+
+class SystemctlServiceManager(ServiceManager):
+    """Управление через systemctl в дочерних процессах.
+    
+    Проверка активности сначала читает cgroup юнита: если каталог есть,
+    процессы сервиса видны без запуска systemctl; systemctl is-active
+    запускается, только когда cgroup недоступна (юнит остановлен, нет
+    доступа к /sys/fs/cgroup, не systemd).
+    """
+    
+    backend = CONTROL_SYSTEMCTL
+    
+    def __init__(self, runner: ProcessRunner = None):
+        self.runner = runner or process_runner
+        # Поддержка reload юнитами: проверяется один раз, а не при каждом изменении
+        self._can_reload: Dict[str, bool] = {}
+    
+    @staticmethod
+    def _cgroup_running(service: str) -> Optional[bool]:
+        """Есть ли процессы в cgroup юнита (None - cgroup не найдена)"""
+        unit = unit_name(service)
+        for directory in CGROUP_SERVICE_DIRS:
+            try:
+                return bool(Path(directory, unit, "cgroup.procs").read_text().strip())
+            except OSError:
+                continue
+        return None
+    
+    async def restart(self, service: str) -> Tuple[bool, str]:
+        returncode, stdout, stderr = await self.runner.run(["systemctl", "restart", service])
+        return returncode == 0, stderr
+    
+    async def _show(self, service: str, prop: str) -> Optional[str]:
+        """Значение свойства юнита из systemctl show"""
+        returncode, stdout, stderr = await self.runner.run(["systemctl", "show", "-p", prop, service])
+        if returncode != 0:
+            return None
+        # Вывод вида "CanReload=yes" (без --value, которого нет в старых systemd)
+        return stdout.strip().partition("=")[2]
+    
+    async def reload(self, service: str) -> Tuple[bool, str]:
+        returncode, stdout, stderr = await self.runner.run(["systemctl", "reload", service])
+        if returncode != 0:
+            self._can_reload.pop(service, None)
+        return returncode == 0, stderr
+    
+    async def can_reload(self, service: str) -> bool:
+        if service not in self._can_reload:
+            value = await self._show(service, "CanReload")
+            if value is None:
+                return False
+            self._can_reload[service] = value == "yes"
+        return self._can_reload[service]
+    
+    async def main_pid(self, service: str) -> Optional[int]:
+        value = await self._show(service, "MainPID")
+        return int(value) if value and value.isdigit() and int(value) > 0 else None
+    
+    async def is_active(self, service: str) -> bool:
+        running = self._cgroup_running(service)
+        if running:
+            return True
+        returncode, stdout, stderr = await self.runner.run(["systemctl", "is-active", service])
+        return returncode == 0 and "active" in stdout
+    
+    async def status(self, service: str) -> Tuple[bool, str]:
+        # Код возврата systemctl status: 0 - активен, 3 - не активен
+        returncode, stdout, stderr = await self.runner.run(["systemctl", "status", service, "--no-pager"])
+        return returncode == 0, stdout or stderr
+
+
+class DBusError(Exception):
+    """Ошибка вызова systemd через D-Bus"""
+    
+    def __init__(self, name: str, message: str = ""):
+        super().__init__(f"{name}: {message}" if message else name)
+        self.name = name
+
+
+class DBusServiceManager(ServiceManager):
+    """Управление через D-Bus API systemd без дочерних процессов.
+    
+    Одно соединение с системной шиной открывается при первом вызове и
+    используется повторно. Если шина недоступна (перезапущена, соединение
+    разорвано), операция выполняется через systemctl, а соединение
+    открывается заново при следующем вызове. Ошибку самого systemd
+    (например, юнит не найден) перезапуск возвращает как есть.
+    """
+    
+    backend = CONTROL_DBUS
+    
+    # Как часто проверять завершение задания перезапуска (секунды)
+    JOB_POLL_INTERVAL = 0.02
+    
+    def __init__(self, fallback: ServiceManager = None, timeout: float = None):
+        self.fallback = fallback or SystemctlServiceManager()
+        self.timeout = timeout or settings.PROCESS_TIMEOUT
+        self._bus = None
+        self._bus_lock = asyncio.Lock()
+        self._unit_paths: Dict[str, str] = {}
+    
+    @staticmethod
+    def is_available() -> bool:
+        """Установлен ли dbus-next и есть ли системная шина"""
+        return MessageBus is not None and os.path.exists(SYSTEM_BUS_SOCKET)
+    
+    async def _get_bus(self):
+        if self._bus is None:
+            async with self._bus_lock:
+                if self._bus is None:
+                    self._bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
+        return self._bus
+    
+    async def _call(self, path: str, interface: str, member: str,
+                    signature: str = "", body: List = None) -> List:
+        bus = await self._get_bus()
+        reply = await asyncio.wait_for(bus.call(Message(
+            destination=SYSTEMD_BUS_NAME, path=path, interface=interface,
+            member=member, signature=signature, body=body or []
+        )), timeout=self.timeout)
+        if reply.message_type == MessageType.ERROR:
+            raise DBusError(reply.error_name, reply.body[0] if reply.body else "")
+        return reply.body
+    
+    async def _unit_path(self, service: str) -> str:
+        path = self._unit_paths.get(service)
+        if path is None:
+            body = await self._call(SYSTEMD_PATH, SYSTEMD_MANAGER, "LoadUnit", "s", [unit_name(service)])
+            path = self._unit_paths[service] = body[0]
+        return path
+    
+    async def _active_state(self, service: str) -> Tuple[str, str]:
+        """(ActiveState, SubState) юнита"""
+        properties = (await self._call(
+            await self._unit_path(service), DBUS_PROPERTIES, "GetAll", "s", [SYSTEMD_UNIT]
+        ))[0]
+        return properties["ActiveState"].value, properties["SubState"].value
+    
+    async def _wait_job(self, job: str) -> bool:
+        """Дождаться завершения задания systemd (объект задания исчезает)"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        while loop.time() < deadline:
+            try:
+                await self._call(job, DBUS_PROPERTIES, "Get", "ss", [SYSTEMD_JOB, "State"])
+            except DBusError as e:
+                if e.name == DBUS_UNKNOWN_OBJECT:
+                    return True
+                raise
+            await asyncio.sleep(self.JOB_POLL_INTERVAL)
+        return False
+    
+    async def _reset(self, error: Exception) -> None:
+        logger.warning(f"Ошибка управления Xray через D-Bus, используется systemctl: {error}")
+        bus, self._bus = self._bus, None
+        self._unit_paths.clear()
+        if bus is not None:
+            bus.disconnect()
+    
+    async def restart(self, service: str) -> Tuple[bool, str]:
+        try:
+            job = (await self._call(
+                SYSTEMD_PATH, SYSTEMD_MANAGER, "RestartUnit", "ss", [unit_name(service), "replace"]
+            ))[0]
+            if not await self._wait_job(job):
+                return False, f"перезапуск не завершился за {self.timeout} с"
+            return True, ""
+        except DBusError as e:
+            return False, str(e)
+        except Exception as e:
+            await self._reset(e)
+            return await self.fallback.restart(service)
+    
+    async def _property(self, service: str, interface: str, name: str):
+        body = await self._call(
+            await self._unit_path(service), DBUS_PROPERTIES, "Get", "ss", [interface, name]
+        )
+        return body[0].value
+    
+    async def reload(self, service: str) -> Tuple[bool, str]:
+        try:
+            job = (await self._call(
+                SYSTEMD_PATH, SYSTEMD_MANAGER, "ReloadUnit", "ss", [unit_name(service), "replace"]
+            ))[0]
+            if not await self._wait_job(job):
+                return False, f"reload не завершился за {self.timeout} с"
+            return True, ""
+        except DBusError as e:
+            return False, str(e)
+        except Exception as e:
+            await self._reset(e)
+            return await self.fallback.reload(service)
+    
+    async def can_reload(self, service: str) -> bool:
+        try:
+            return bool(await self._property(service, SYSTEMD_UNIT, "CanReload"))
+        except Exception as e:
+            await self._reset(e)
+            return await self.fallback.can_reload(service)
+    
+    async def main_pid(self, service: str) -> Optional[int]:
+        try:
+            return await self._property(service, SYSTEMD_SERVICE, "MainPID") or None
+        except Exception as e:
+            await self._reset(e)
+            return await self.fallback.main_pid(service)
+    
+    async def is_active(self, service: str) -> bool:
+        try:
+            return (await self._active_state(service))[0] == "active"
+        except Exception as e:
+            await self._reset(e)
+            return await self.fallback.is_active(service)
+    
+    async def status(self, service: str) -> Tuple[bool, str]:
+        try:
+            active_state, sub_state = await self._active_state(service)
+        except Exception as e:
+            await self._reset(e)
+            return await self.fallback.status(service)
+        return active_state == "active", f"{unit_name(service)}: {active_state} ({sub_state})"
+    
+    async def close(self) -> None:
+        if self._bus is not None:
+            self._bus.disconnect()
+            self._bus = None
+
+
+def create_service_manager(control: str = None) -> ServiceManager:
+    """Выбрать способ управления сервисом по XRAY_SERVICE_CONTROL"""
+    control = (control or settings.XRAY_SERVICE_CONTROL).lower()
+    if control == CONTROL_SYSTEMCTL:
+        return SystemctlServiceManager()
+    if DBusServiceManager.is_available():
+        return DBusServiceManager()
+    if control == CONTROL_DBUS:
+        logger.warning("D-Bus недоступен (нужны dbus-next и системная шина), используется systemctl")
+    return SystemctlServiceManager()
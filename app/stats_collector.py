@@ -0,0 +1,99 @@
+import logging
+from typing import Dict, List
+
+from .config import settings
+from .database import TRAFFIC_ROLLUP_RESOLUTIONS, database
+from .quota import quota_enforcer
+from .xray_manager import xray_manager
+
+logger = logging.getLogger(__name__)
+
+DAY = 86400
+
+# Приращения, уже снятые из Xray со сбросом счетчиков, но еще не сохраненные
+# в базу: uuid -> [upload, download] и email клиента -> [upload, download]
+# для клиентов, которых нет в конфигурации. Хранятся до успешной записи.
+_unsaved: Dict[str, List[int]] = {}
+_unsaved_emails: Dict[str, List[int]] = {}
+
+
+def _merge(target: Dict[str, List[int]], stats: Dict[str, Dict[str, int]]) -> None:
+    for key, traffic in stats.items():
+        totals = target.setdefault(key, [0, 0])
+        totals[0] += traffic.get("uplink", 0)
+        totals[1] += traffic.get("downlink", 0)
+
+
+async def _resolve_emails() -> None:
+    """Сопоставить клиентов, которых нет в конфигурации, с пользователями базы"""
+    owners = await database.get_uuids_by_client_emails(list(_unsaved_emails))
+    dropped = 0
+    for email, (upload, download) in _unsaved_emails.items():
+        user_uuid = owners.get(email)
+        if user_uuid is None:
+            dropped += upload + download
+            continue
+        totals = _unsaved.setdefault(user_uuid, [0, 0])
+        totals[0] += upload
+        totals[1] += download
+    if dropped:
+        missing = len(_unsaved_emails) - len(owners)
+        logger.warning(f"Трафик {dropped} байт клиентов Xray, которых нет в базе ({missing}), не сохранен")
+    _unsaved_emails.clear()
+
+
+async def collect_traffic() -> int:
+    """Снять приращения трафика из Xray и сохранить их в базу.
+    
+    Счетчики запрашиваются с обнулением (reset), поэтому каждый вызов
+    получает только трафик с прошлого сбора. Все приращения записываются
+    одним пакетным upsert, после чего пользователи с приращениями
+    проверяются на превышение квоты. Возвращает количество обновленных
+    пользователей.
+    
+    Xray обнуляет счетчики до записи, поэтому приращения, которые не
+    удалось сохранить, остаются в памяти и прибавляются к следующему сбору.
+    Трафик клиентов, уже удаленных из конфигурации, относится к
+    пользователю по email через базу.
+    """
+    stats = await xray_manager.get_traffic_stats(reset=True)
+    if stats:
+        known, unknown = stats
+        _merge(_unsaved, known)
+        _merge(_unsaved_emails, unknown)
+    
+    if _unsaved_emails:
+        await _resolve_emails()
+    if not _unsaved:
+        return 0
+    
+    deltas = [(user_uuid, upload, download) for user_uuid, (upload, download) in _unsaved.items()]
+    try:
+        updated = await database.add_traffic_batch(deltas)
+    except Exception as e:
+        logger.warning(f"Трафик {len(deltas)} пользователей не сохранен, повтор при следующем сборе: {e}")
+        raise
+    _unsaved.clear()
+    logger.debug(f"Сохранена статистика трафика для {updated} пользователей")
+    await quota_enforcer.enforce([user_uuid for user_uuid, _, _ in deltas])
+    return updated
+
+
+def choose_resolution(step: int) -> int:
+    """Выбрать самый крупный уровень агрегации, на который делится шаг истории"""
+    return max(r for r in TRAFFIC_ROLLUP_RESOLUTIONS if step % r == 0)
+
+
+async def cleanup_traffic_history() -> int:
+    """Удалить историю трафика старше сроков хранения каждого уровня"""
+    retention = {
+        60: settings.TRAFFIC_1M_RETENTION_DAYS * DAY,
+        3600: settings.TRAFFIC_1H_RETENTION_DAYS * DAY,
+        86400: settings.TRAFFIC_1D_RETENTION_DAYS * DAY,
+    }
+    deleted = await database.cleanup_traffic_history(
+        retention, settings.TRAFFIC_SAMPLES_RETENTION_DAYS * DAY
+    )
+    if deleted:
+        logger.info(f"Удалено {deleted} устаревших записей истории трафика")
+    return deleted
@@ -0,0 +1,273 @@
+import logging
+from typing import Dict, Iterator, Optional, Tuple
+
+from .config import settings
+
+try:
+    import grpc
+    from grpc import aio as grpc_aio
+except ImportError:  # grpcio не установлен - горячее обновление недоступно
+    grpc = None
+    grpc_aio = None
+
+logger = logging.getLogger(__name__)
+
+# gRPC методы Xray API
+ALTER_INBOUND_METHOD = "/xray.app.proxyman.command.HandlerService/AlterInbound"
+GET_INBOUND_USERS_METHOD = "/xray.app.proxyman.command.HandlerService/GetInboundUsers"
+QUERY_STATS_METHOD = "/xray.app.stats.command.StatsService/QueryStats"
+
+# Имена protobuf типов для TypedMessage
+ADD_USER_OPERATION_TYPE = "xray.app.proxyman.command.AddUserOperation"
+REMOVE_USER_OPERATION_TYPE = "xray.app.proxyman.command.RemoveUserOperation"
+VLESS_ACCOUNT_TYPE = "xray.proxy.vless.Account"
+
+
+# Минимальный protobuf энкодер/декодер. Сообщения Xray API простые, поэтому
+# сгенерированные стабы не нужны - поля кодируются вручную.
+
+def _varint(value: int) -> bytes:
+    """Закодировать число в формате varint"""
+    result = bytearray()
+    while True:
+        bits = value & 0x7F
+        value >>= 7
+        if value:
+            result.append(bits | 0x80)
+        else:
+            result.append(bits)
+            return bytes(result)
+
+
+def _field_bytes(number: int, value: bytes) -> bytes:
+    """Закодировать length-delimited поле (string/bytes/message)"""
+    return _varint((number << 3) | 2) + _varint(len(value)) + value
+
+
+def _field_str(number: int, value: str) -> bytes:
+    """Закодировать строковое поле (пустые строки не передаются)"""
+    if not value:
+        return b""
+    return _field_bytes(number, value.encode("utf-8"))
+
+
+def _field_uint(number: int, value: int) -> bytes:
+    """Закодировать varint поле (нулевые значения не передаются)"""
+    if not value:
+        return b""
+    return _varint(number << 3) + _varint(value)
+
+
+def _field_bool(number: int, value: bool) -> bytes:
+    """Закодировать bool поле"""
+    return _field_uint(number, 1 if value else 0)
+
+
+def _read_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    """Прочитать varint, вернуть (значение, новая позиция)"""
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _iter_fields(data: bytes) -> Iterator[Tuple[int, object]]:
+    """Перебрать поля protobuf сообщения: (номер поля, значение)"""
+    pos = 0
+    while pos < len(data):
+        key, pos = _read_varint(data, pos)
+        number, wire_type = key >> 3, key & 0x07
+        if wire_type == 0:
+            value, pos = _read_varint(data, pos)
+        elif wire_type == 2:
+            length, pos = _read_varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        elif wire_type == 1:
+            value = int.from_bytes(data[pos:pos + 8], "little")
+            pos += 8
+        elif wire_type == 5:
+            value = int.from_bytes(data[pos:pos + 4], "little")
+            pos += 4
+        else:
+            raise ValueError(f"Неподдерживаемый тип поля protobuf: {wire_type}")
+        yield number, value
+
+
+def _typed_message(type_name: str, value: bytes) -> bytes:
+    """Закодировать xray.common.serial.TypedMessage"""
+    return _field_str(1, type_name) + _field_bytes(2, value)
+
+
+def encode_add_user_request(tag: str, user_uuid: str, email: str,
+                            flow: str = "", level: int = 0) -> bytes:
+    """Сформировать AlterInboundRequest с AddUserOperation для VLESS клиента"""
+    account = _field_str(1, user_uuid) + _field_str(2, flow) + _field_str(3, "none")
+    user = (
+        _field_uint(1, level)
+        + _field_str(2, email)
+        + _field_bytes(3, _typed_message(VLESS_ACCOUNT_TYPE, account))
+    )
+    operation = _field_bytes(1, user)
+    return _field_str(1, tag) + _field_bytes(2, _typed_message(ADD_USER_OPERATION_TYPE, operation))
+
+
+def encode_remove_user_request(tag: str, email: str) -> bytes:
+    """Сформировать AlterInboundRequest с RemoveUserOperation"""
+    operation = _field_str(1, email)
+    return _field_str(1, tag) + _field_bytes(2, _typed_message(REMOVE_USER_OPERATION_TYPE, operation))
+
+
+def encode_get_inbound_users_request(tag: str, email: str) -> bytes:
+    """Сформировать GetInboundUserRequest"""
+    return _field_str(1, tag) + _field_str(2, email)
+
+
+def decode_inbound_user_ids(data: bytes) -> Dict[str, str]:
+    """Разобрать GetInboundUserResponse в словарь email -> uuid VLESS клиента"""
+    result = {}
+    for number, user in _iter_fields(data):
+        if number != 1:
+            continue
+        email, user_uuid = "", ""
+        for field, value in _iter_fields(user):
+            if field == 2:
+                email = value.decode("utf-8")
+            elif field == 3:
+                # TypedMessage с xray.proxy.vless.Account, uuid - поле 1 аккаунта
+                for message_field, message_value in _iter_fields(value):
+                    if message_field != 2:
+                        continue
+                    for account_field, account_value in _iter_fields(message_value):
+                        if account_field == 1:
+                            user_uuid = account_value.decode("utf-8")
+        result[email] = user_uuid
+    return result
+
+
+def encode_query_stats_request(pattern: str, reset: bool) -> bytes:
+    """Сформировать QueryStatsRequest"""
+    return _field_str(1, pattern) + _field_bool(2, reset)
+
+
+def decode_query_stats_response(data: bytes) -> Dict[str, int]:
+    """Разобрать QueryStatsResponse в словарь имя счетчика -> значение"""
+    result = {}
+    for number, stat in _iter_fields(data):
+        if number != 1:
+            continue
+        name, value = "", 0
+        for field, field_value in _iter_fields(stat):
+            if field == 1:
+                name = field_value.decode("utf-8")
+            elif field == 2:
+                # int64 в дополнительном коде
+                value = field_value - (1 << 64) if field_value >= 1 << 63 else field_value
+        result[name] = value
+    return result
+
+
+class XrayAPIClient:
+    """Клиент gRPC API работающего ядра Xray (HandlerService, StatsService)"""
+    
+    def __init__(self, address: str = None, timeout: float = None):
+        self.address = address or f"{settings.XRAY_API_HOST}:{settings.XRAY_API_PORT}"
+        self.timeout = timeout or settings.XRAY_API_TIMEOUT
+        self._channel = None
+    
+    @staticmethod
+    def is_available() -> bool:
+        """Проверить, установлен ли grpcio"""
+        return grpc_aio is not None
+    
+    def _get_channel(self):
+        """Получить (или создать) gRPC канал"""
+        if self._channel is None:
+            self._channel = grpc_aio.insecure_channel(self.address)
+        return self._channel
+    
+    async def _call(self, method: str, request: bytes) -> Optional[bytes]:
+        """Выполнить unary вызов с сырыми protobuf байтами"""
+        call = self._get_channel().unary_unary(method)
+        return await call(request, timeout=self.timeout)
+    
+    async def add_user(self, tag: str, user_uuid: str, email: str,
+                       flow: str = "", level: int = 0) -> bool:
+        """Добавить клиента в inbound без перезапуска Xray"""
+        try:
+            await self._call(ALTER_INBOUND_METHOD,
+                             encode_add_user_request(tag, user_uuid, email, flow, level))
+            return True
+        except grpc.RpcError as e:
+            if "already exists" in (e.details() or ""):
+                # Успех, только если под этим email работает тот же клиент
+                existing = await self.get_user_id(tag, email)
+                if existing is not None and existing.lower() == user_uuid.lower():
+                    logger.warning(f"Клиент {email} уже есть в работающем Xray")
+                    return True
+                logger.error(
+                    f"Email {email} в работающем Xray занят другим клиентом "
+                    f"({existing or 'uuid неизвестен'})"
+                )
+                return False
+            logger.error(f"Ошибка добавления клиента {email} через Xray API: {e.details()}")
+            return False
+        except Exception as e:
+            logger.error(f"Ошибка добавления клиента {email} через Xray API: {e}")
+            return False
+    
+    async def get_user_id(self, tag: str, email: str) -> Optional[str]:
+        """UUID клиента inbound с указанным email (None - не найден или API не поддерживает запрос)"""
+        try:
+            response = await self._call(GET_INBOUND_USERS_METHOD, encode_get_inbound_users_request(tag, email))
+        except grpc.RpcError as e:
+            logger.warning(f"Не удалось получить клиента {email} через Xray API: {e.details()}")
+            return None
+        except Exception as e:
+            logger.warning(f"Не удалось получить клиента {email} через Xray API: {e}")
+            return None
+        users = decode_inbound_user_ids(response or b"")
+        return next((user_uuid for user_email, user_uuid in users.items()
+                     if user_email.lower() == email.lower()), None)
+    
+    async def remove_user(self, tag: str, email: str) -> bool:
+        """Удалить клиента из inbound без перезапуска Xray"""
+        try:
+            await self._call(ALTER_INBOUND_METHOD, encode_remove_user_request(tag, email))
+            return True
+        except grpc.RpcError as e:
+            if "not found" in (e.details() or ""):
+                logger.warning(f"Клиент {email} отсутствует в работающем Xray")
+                return True
+            logger.error(f"Ошибка удаления клиента {email} через Xray API: {e.details()}")
+            return False
+        except Exception as e:
+            logger.error(f"Ошибка удаления клиента {email} через Xray API: {e}")
+            return False
+    
+    async def query_stats(self, pattern: str = "", reset: bool = False) -> Optional[Dict[str, int]]:
+        """Получить счетчики статистики одним вызовом.
+        
+        reset=True обнуляет счетчики в Xray, возвращая накопленные с прошлого
+        запроса значения (дельты).
+        """
+        try:
+            response = await self._call(QUERY_STATS_METHOD, encode_query_stats_request(pattern, reset))
+            return decode_query_stats_response(response or b"")
+        except grpc.RpcError as e:
+            logger.error(f"Ошибка запроса статистики Xray: {e.details()}")
+            return None
+        except Exception as e:
+            logger.error(f"Ошибка запроса статистики Xray: {e}")
+            return None
+    
+    async def close(self) -> None:
+        """Закрыть gRPC канал"""
+        if self._channel is not None:
+            await self._channel.close()
+            self._channel = None
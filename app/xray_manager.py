@@ -1,103 +1,508 @@
-import json
 import asyncio
-import subprocess
+import os
+import signal
+import time
 import uuid
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Set, Tuple
 from pathlib import Path
 import logging
 
+from . import config_store, json_backend
 from .config import settings
+from .coordination import FileLock
+from .executor import io_executor, run_io
+from .cache import CACHE_SUB, CACHE_USER, response_cache
+from .client_registry import ClientRegistry
+from .config_validator import structure_signature, validate_config
+from .links import LinkTemplate
+from .metrics import (
+    config_cache_lookups, config_io_bytes, config_io_duration, xray_apply_duration, xray_apply_results,
+    xray_config_checks, xray_restart_downtime, xray_restarts
+)
 from .models import User
+from .process_runner import process_runner
+from .service_control import create_service_manager
+from .xray_api import XrayAPIClient
+from .xray_watcher import probe_tcp
 
 logger = logging.getLogger(__name__)
 
+# Типы операций с клиентами Xray
+MUTATION_ADD = "add"
+MUTATION_REMOVE = "remove"
+MUTATION_SUSPEND = "suspend"
+
+# Способы применения изменений к работающему Xray, от самого мягкого
+APPLY_HOT = "hot"
+APPLY_SIGNAL = "signal"
+APPLY_RELOAD = "reload"
+APPLY_RESTART = "restart"
+
+# Адреса "все интерфейсы": готовность проверяется подключением к localhost
+ANY_ADDRESSES = ("", "0.0.0.0", "::")
+
+# Как часто проверять конфигурацию на изменение параметров ссылок (секунды)
+LINK_TEMPLATE_CHECK_INTERVAL = 1.0
+
+# Дочерние значения метрик горячего пути, созданные заранее
+_CONFIG_CACHE_HIT = config_cache_lookups.labels("hit")
+_CONFIG_CACHE_MISS = config_cache_lookups.labels("miss")
+_CONFIG_READ_TIME = config_io_duration.labels("read")
+_CONFIG_PARSE_TIME = config_io_duration.labels("parse")
+_CONFIG_SERIALIZE_TIME = config_io_duration.labels("serialize")
+_CONFIG_WRITE_TIME = config_io_duration.labels("write")
+_CONFIG_READ_BYTES = config_io_bytes.labels("read")
+_CONFIG_WRITE_BYTES = config_io_bytes.labels("write")
+_CHECK_REJECTED = xray_config_checks.labels("rejected")
+_CHECK_SKIPPED = xray_config_checks.labels("skipped")
+_CHECK_PASSED = xray_config_checks.labels("passed")
+_CHECK_FAILED = xray_config_checks.labels("failed")
+# Способ применения -> (время, успешные, неудачные)
+_APPLY_METRICS = {
+    tier: (xray_apply_duration.labels(tier), xray_apply_results.labels(tier, "success"),
+           xray_apply_results.labels(tier, "failed"))
+    for tier in (APPLY_HOT, APPLY_SIGNAL, APPLY_RELOAD, APPLY_RESTART)
+}
+
+class XrayMutation:
+    """Отложенная операция с клиентом Xray, ожидающая применения пачкой"""
+    
+    def __init__(self, kind: str, user: Optional[User] = None, user_uuid: Optional[str] = None):
+        self.kind = kind
+        self.user = user
+        self.user_uuid = user_uuid or (user.uuid if user else None)
+        self.future: Optional[asyncio.Future] = None
+
 class XrayManager:
     """Класс для управления Xray конфигурацией"""
     
     def __init__(self, config_path: str = None):
         self.config_path = config_path or settings.XRAY_CONFIG_PATH
         self.service_name = settings.XRAY_SERVICE_NAME
+        self.inbound_tag = settings.XRAY_INBOUND_TAG
         
-    async def _run_command(self, command: List[str]) -> tuple[int, str, str]:
-        """Выполнить команду асинхронно"""
-        try:
-            process = await asyncio.create_subprocess_exec(
-                *command,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await process.communicate()
-            return process.returncode, stdout.decode(), stderr.decode()
-        except Exception as e:
-            logger.error(f"Ошибка выполнения команды {' '.join(command)}: {e}")
-            return 1, "", str(e)
+        # Клиент gRPC API для горячего обновления пользователей
+        self.api: Optional[XrayAPIClient] = None
+        if settings.XRAY_API_ENABLED:
+            if XrayAPIClient.is_available():
+                self.api = XrayAPIClient()
+            else:
+                logger.warning("grpcio не установлен, изменения пользователей будут применяться перезапуском Xray")
+        
+        # Управление сервисом: D-Bus или systemctl
+        self.service = create_service_manager()
+        self.reload_signal = self._parse_signal(settings.XRAY_RELOAD_SIGNAL)
+        # Последнее применение изменений к работающему Xray
+        self.last_apply: Optional[Dict] = None
+        
+        # Подпись структуры (конфигурация без клиентов) последней конфигурации,
+        # прошедшей xray -test: пока она не меняется, xray -test не запускается
+        self._tested_structure: Optional[str] = None
+        
+        # Очередь операций с пользователями и ее единственный обработчик
+        self._pending: List[XrayMutation] = []
+        self._worker: Optional[asyncio.Task] = None
+        
+        # Атомарная запись конфигурации и кольцо резервных копий
+        self.fsync_policy = config_store.FsyncPolicy(settings.XRAY_FSYNC_POLICY, settings.XRAY_FSYNC_INTERVAL)
+        self.backups = config_store.BackupRing(
+            self.config_path, settings.XRAY_BACKUP_COUNT, settings.XRAY_BACKUP_COMPRESSION,
+            shared=settings.WORKERS > 1
+        )
+        self._fsync_handle: Optional[asyncio.TimerHandle] = None
+        
+        # Резервная копия пишется сразу при изменении структуры конфигурации,
+        # изменения только клиентов - не чаще XRAY_BACKUP_INTERVAL секунд;
+        # последняя пропущенная версия сохраняется по таймеру
+        self._backup_structure: Optional[str] = None
+        self._backup_at = 0.0
+        self._backup_pending: Optional[bytes] = None
+        self._backup_handle: Optional[asyncio.TimerHandle] = None
+        
+        # Блокировка записи конфигурации (пачки операций и откаты): внутри
+        # процесса и между процессами, если сервис запущен с несколькими workers
+        self._config_lock = asyncio.Lock()
+        self._file_lock = FileLock(f"{self.config_path}.lock")
+        
+        # Кэш разобранной конфигурации: (подпись файла, конфигурация)
+        self._config_cache: Optional[tuple] = None
+        
+        # Разобранная конфигурация с индексами клиентов
+        self._registry: Optional[ClientRegistry] = None
+        
+        # Шаблон ссылок, время последней проверки конфигурации для него
+        # и фоновая проверка, если она выполняется
+        self._link_template: Optional[LinkTemplate] = None
+        self._link_checked_at = 0.0
+        self._link_refresh: Optional[asyncio.Task] = None
     
     async def get_config(self) -> Optional[Dict]:
-        """Получить текущую конфигурацию Xray"""
+        """Получить текущую конфигурацию Xray.
+        
+        Разобранная конфигурация кэшируется и перечитывается только при
+        изменении файла (mtime, размер, inode). Возвращается общий объект:
+        изменять его можно только с последующим save_config.
+        Чтение и разбор файла выполняются в пуле потоков.
+        """
+        signature = self._file_signature()
+        if signature is None:
+            logger.warning(f"Конфигурационный файл {self.config_path} не найден")
+            return None
+        
+        if self._config_cache is not None and self._config_cache[0] == signature:
+            _CONFIG_CACHE_HIT.inc()
+            return self._config_cache[1]
+        _CONFIG_CACHE_MISS.inc()
+        
         try:
-            if not Path(self.config_path).exists():
-                logger.warning(f"Конфигурационный файл {self.config_path} не найден")
-                return None
-                
-            with open(self.config_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            config = await run_io(self._read_config)
         except Exception as e:
             logger.error(f"Ошибка чтения конфигурации: {e}")
             return None
+        
+        self._config_cache = (signature, config)
+        return config
+    
+    def _read_config(self) -> Dict:
+        """Прочитать и разобрать файл конфигурации (блокирующая операция)"""
+        started = time.perf_counter()
+        with open(self.config_path, 'rb') as f:
+            data = f.read()
+        read_at = time.perf_counter()
+        config = json_backend.loads(data)
+        _CONFIG_READ_TIME.observe(read_at - started)
+        _CONFIG_PARSE_TIME.observe(time.perf_counter() - read_at)
+        _CONFIG_READ_BYTES.observe(len(data))
+        return config
     
     async def save_config(self, config: Dict) -> bool:
-        """Сохранить конфигурацию Xray"""
+        """Сохранить конфигурацию Xray (атомарно, с резервной копией в кольце поколений).
+        
+        Сериализация, запись, fsync и сжатие резервной копии выполняются в пуле потоков.
+        """
         try:
-            # Создаем резервную копию
-            backup_path = f"{self.config_path}.backup"
-            if Path(self.config_path).exists():
-                await self._run_command(["cp", self.config_path, backup_path])
-            
-            # Сохраняем новую конфигурацию
-            with open(self.config_path, 'w', encoding='utf-8') as f:
-                json.dump(config, f, indent=2, ensure_ascii=False)
+            data, structure = await run_io(self._write_config, config)
+            if self.fsync_policy.has_pending:
+                self._schedule_fsync()
             
-            return True
+            self._config_cache = (self._file_signature(), config)
         except Exception as e:
+            self._config_cache = None
             logger.error(f"Ошибка сохранения конфигурации: {e}")
             return False
+        
+        self._set_link_template(config)
+        
+        elapsed = time.monotonic() - self._backup_at
+        if structure != self._backup_structure or elapsed >= settings.XRAY_BACKUP_INTERVAL:
+            self._backup_structure = structure
+            self._backup_pending = None
+            await self._write_backup(data)
+        else:
+            self._backup_pending = data
+            self._schedule_backup(settings.XRAY_BACKUP_INTERVAL - elapsed)
+        
+        return True
     
-    async def restart_xray(self) -> bool:
-        """Перезапустить сервис Xray"""
+    async def _write_backup(self, data: bytes) -> None:
+        # Ошибка резервного копирования не отменяет уже сохраненную конфигурацию
+        self._backup_at = time.monotonic()
         try:
-            # Проверяем конфигурацию перед перезапуском
-            returncode, stdout, stderr = await self._run_command([
-                "xray", "-test", "-config", self.config_path
-            ])
-            
-            if returncode != 0:
-                logger.error(f"Конфигурация Xray невалидна: {stderr}")
+            await run_io(self.backups.add, data)
+        except Exception as e:
+            logger.error(f"Ошибка создания резервной копии конфигурации: {e}")
+    
+    def _schedule_backup(self, delay: float) -> None:
+        """Запланировать отложенную резервную копию последней версии"""
+        if self._backup_handle is not None:
+            return
+        
+        def flush():
+            self._backup_handle = None
+            asyncio.ensure_future(self.flush_backup())
+        
+        self._backup_handle = asyncio.get_running_loop().call_later(delay, flush)
+    
+    async def flush_backup(self) -> None:
+        """Сохранить отложенную резервную копию (по таймеру и при остановке)"""
+        if self._backup_handle is not None:
+            self._backup_handle.cancel()
+            self._backup_handle = None
+        if self._backup_pending is None:
+            return
+        async with self._config_lock, self._file_lock:
+            data, self._backup_pending = self._backup_pending, None
+            if data is not None:
+                await self._write_backup(data)
+    
+    def _write_config(self, config: Dict) -> Tuple[bytes, str]:
+        """Сериализовать и атомарно записать конфигурацию (блокирующая операция).
+        
+        Возвращает записанные данные и подпись структуры конфигурации.
+        """
+        started = time.perf_counter()
+        data = json_backend.dumps(config, compact=settings.XRAY_CONFIG_COMPACT)
+        _CONFIG_SERIALIZE_TIME.observe(time.perf_counter() - started)
+        
+        # Исходный файл, записанный не нами, сохраняем первым поколением
+        if self.backups.latest is None and Path(self.config_path).exists():
+            self.backups.add(Path(self.config_path).read_bytes())
+        
+        # Пишем во временный файл и атомарно подменяем config.json
+        synced = self.fsync_policy.should_sync()
+        started = time.perf_counter()
+        config_store.atomic_write(self.config_path, data, fsync=synced)
+        _CONFIG_WRITE_TIME.observe(time.perf_counter() - started)
+        _CONFIG_WRITE_BYTES.observe(len(data))
+        self.fsync_policy.record(self.config_path, synced)
+        return data, structure_signature(config)
+    
+    def _schedule_fsync(self) -> None:
+        """Запланировать отложенный fsync для политики batched"""
+        if self._fsync_handle is not None and not self._fsync_handle.cancelled():
+            return
+        
+        def flush():
+            self._fsync_handle = None
+            io_executor.submit(self.fsync_policy.flush_pending)
+        
+        self._fsync_handle = asyncio.get_running_loop().call_later(self.fsync_policy.interval, flush)
+    
+    def list_backups(self) -> List[Dict]:
+        """Список доступных поколений резервных копий"""
+        return self.backups.list()
+    
+    async def rollback_config(self, generation: int) -> bool:
+        """Откатить конфигурацию к указанному поколению и перезапустить Xray"""
+        async with self._config_lock, self._file_lock:
+            try:
+                data = await run_io(self.backups.read, generation)
+                if data is None:
+                    logger.error(f"Резервная копия поколения {generation} не найдена")
+                    return False
+                
+                config = await run_io(json_backend.loads, data)
+            except Exception as e:
+                logger.error(f"Ошибка чтения резервной копии поколения {generation}: {e}")
                 return False
             
-            # Перезапускаем сервис
-            returncode, stdout, stderr = await self._run_command([
-                "systemctl", "restart", self.service_name
-            ])
+            # Откат может менять что угодно - индексы строим заново, Xray перезапускаем
+            self._registry = None
+            if not await self.save_config(config):
+                return False
             
-            if returncode != 0:
-                logger.error(f"Ошибка перезапуска Xray: {stderr}")
+            logger.info(f"Конфигурация Xray откачена к поколению {generation}")
+            return await self.reload_xray(config)
+    
+    async def check_config(self, config: Optional[Dict] = None) -> bool:
+        """Проверить конфигурацию перед перезапуском Xray.
+        
+        Частые ошибки схемы находит проверка в процессе; xray -test
+        запускается, только если изменилось что-то кроме списков клиентов
+        с последней успешной проверки.
+        """
+        if config is None:
+            config = await self.get_config()
+            if config is None:
+                return False
+        
+        errors = await run_io(validate_config, config)
+        if errors:
+            _CHECK_REJECTED.inc()
+            logger.error(f"Конфигурация Xray невалидна: {'; '.join(errors)}")
+            return False
+        
+        structure = await run_io(structure_signature, config)
+        if structure == self._tested_structure:
+            _CHECK_SKIPPED.inc()
+            return True
+        
+        returncode, stdout, stderr = await process_runner.run([
+            "xray", "-test", "-config", self.config_path
+        ])
+        if returncode != 0:
+            _CHECK_FAILED.inc()
+            logger.error(f"Конфигурация Xray невалидна: {stderr or stdout}")
+            return False
+        
+        _CHECK_PASSED.inc()
+        self._tested_structure = structure
+        return True
+    
+    @staticmethod
+    def _parse_signal(name: str) -> Optional[signal.Signals]:
+        """Сигнал перечитывания конфигурации из XRAY_RELOAD_SIGNAL (HUP, SIGHUP, 1)"""
+        if not name:
+            return None
+        try:
+            if name.isdigit():
+                return signal.Signals(int(name))
+            name = name.upper()
+            return signal.Signals[name if name.startswith("SIG") else f"SIG{name}"]
+        except (KeyError, ValueError):
+            logger.warning(f"Неизвестный сигнал XRAY_RELOAD_SIGNAL={name}, перезагрузка сигналом отключена")
+            return None
+    
+    def _record_apply(self, tier: str, success: bool, started: float) -> None:
+        """Учесть время и результат одного способа применения изменений"""
+        duration = time.perf_counter() - started
+        histogram, succeeded, failed = _APPLY_METRICS[tier]
+        histogram.observe(duration)
+        (succeeded if success else failed).inc()
+        self.last_apply = {
+            "tier": tier,
+            "success": success,
+            "duration_ms": round(duration * 1000, 3),
+            "at": time.time(),
+        }
+        if tier != APPLY_HOT:
+            logger.info(
+                f"Xray: {tier} {'выполнен' if success else 'не удался'} за {duration * 1000:.0f} мс"
+            )
+    
+    def _ready_target(self, config: Optional[Dict]) -> Optional[Tuple[str, int]]:
+        """Адрес, подключение к которому означает готовность Xray.
+        
+        Порт API, если он включен, иначе порт основного VLESS inbound.
+        None - порт определить нельзя (unix сокет, диапазон портов),
+        готовность проверяется по состоянию сервиса.
+        """
+        if self.api is not None:
+            return settings.XRAY_API_HOST, settings.XRAY_API_PORT
+        inbounds = (config or {}).get("inbounds", [])
+        for inbound in sorted(inbounds, key=lambda item: item.get("tag") != self.inbound_tag):
+            port = inbound.get("port")
+            listen = inbound.get("listen") or ""
+            if inbound.get("protocol") != "vless" or not isinstance(port, int) or listen.startswith(("/", "@")):
+                continue
+            return ("127.0.0.1" if listen in ANY_ADDRESSES else listen), port
+        return None
+    
+    async def wait_ready(self, config: Optional[Dict] = None) -> bool:
+        """Дождаться готовности Xray: опрос с экспоненциально растущей паузой.
+        
+        Первая проверка выполняется сразу, пауза растет от
+        XRAY_READY_INITIAL_DELAY до XRAY_READY_MAX_DELAY, общее ожидание
+        ограничено XRAY_READY_TIMEOUT.
+        """
+        target = self._ready_target(config)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + settings.XRAY_READY_TIMEOUT
+        delay = settings.XRAY_READY_INITIAL_DELAY
+        while True:
+            remaining = deadline - loop.time()
+            if target is not None:
+                ready = await probe_tcp(*target, timeout=max(0.01, min(remaining, settings.XRAY_READY_MAX_DELAY)))
+            else:
+                ready = await self.is_running()
+            if ready:
+                return True
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                logger.error(f"Xray не готов через {settings.XRAY_READY_TIMEOUT} с")
+                return False
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * 2, settings.XRAY_READY_MAX_DELAY)
+    
+    async def _main_pid(self) -> Optional[int]:
+        if settings.XRAY_PID_FILE:
+            try:
+                return int((await run_io(Path(settings.XRAY_PID_FILE).read_text)).strip())
+            except (OSError, ValueError):
+                return None
+        return await self.service.main_pid(self.service_name)
+    
+    async def _signal_reload(self, config: Optional[Dict]) -> Optional[bool]:
+        """Перечитывание конфигурации по сигналу (None - способ не настроен)"""
+        if self.reload_signal is None:
+            return None
+        pid = await self._main_pid()
+        if pid is None:
+            logger.warning("PID процесса Xray неизвестен, сигнал перезагрузки не отправлен")
+            return False
+        try:
+            os.kill(pid, self.reload_signal)
+        except OSError as e:
+            logger.warning(f"Не удалось отправить {self.reload_signal.name} процессу Xray {pid}: {e}")
+            return False
+        
+        # Порт при перечитывании не закрывается: кроме готовности проверяем,
+        # что процесс не завершился, не приняв новую конфигурацию
+        if not await self.wait_ready(config):
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+    
+    async def _systemd_reload(self, config: Optional[Dict]) -> Optional[bool]:
+        """systemctl reload (None - юнит не поддерживает reload)"""
+        if not settings.XRAY_SYSTEMD_RELOAD or not await self.service.can_reload(self.service_name):
+            return None
+        reloaded, error = await self.service.reload(self.service_name)
+        if not reloaded:
+            logger.warning(f"Ошибка reload Xray: {error}")
+            return False
+        return await self.wait_ready(config)
+    
+    async def reload_xray(self, config: Optional[Dict] = None) -> bool:
+        """Применить сохраненную конфигурацию к работающему Xray.
+        
+        Способы перебираются от самого мягкого: сигнал процессу
+        (XRAY_RELOAD_SIGNAL), systemctl reload (если у юнита есть ExecReload),
+        полный перезапуск. Каждый способ считается выполненным только после
+        подтверждения готовности Xray; время каждого попадает в метрику
+        xray_apply_duration_seconds.
+        """
+        try:
+            if config is None:
+                config = await self.get_config()
+            if not await self.check_config(config):
+                xray_restarts.labels("invalid_config").inc()
                 return False
             
-            # Ждем немного и проверяем статус
-            await asyncio.sleep(2)
-            return await self.is_running()
+            for tier, method in ((APPLY_SIGNAL, self._signal_reload), (APPLY_RELOAD, self._systemd_reload)):
+                started = time.perf_counter()
+                result = await method(config)
+                if result is None:
+                    continue
+                self._record_apply(tier, result, started)
+                if result:
+                    return True
             
+            return await self._restart(config)
+        
         except Exception as e:
-            logger.error(f"Ошибка перезапуска Xray: {e}")
+            logger.error(f"Ошибка применения конфигурации Xray: {e}")
             return False
     
+    async def _restart(self, config: Optional[Dict]) -> bool:
+        """Перезапуск без проверки конфигурации; простой - от команды до готовности"""
+        started = time.perf_counter()
+        try:
+            restarted, error = await self.service.restart(self.service_name)
+            if not restarted:
+                logger.error(f"Ошибка перезапуска Xray: {error}")
+                running = False
+            else:
+                running = await self.wait_ready(config)
+        except Exception as e:
+            logger.error(f"Ошибка перезапуска Xray: {e}")
+            running = False
+        
+        xray_restarts.labels("success" if running else "failed").inc()
+        if running:
+            xray_restart_downtime.observe(time.perf_counter() - started)
+        self._record_apply(APPLY_RESTART, running, started)
+        return running
+    
     async def is_running(self) -> bool:
         """Проверить, запущен ли Xray"""
         try:
-            returncode, stdout, stderr = await self._run_command([
-                "systemctl", "is-active", self.service_name
-            ])
-            return returncode == 0 and "active" in stdout
+            return await self.service.is_active(self.service_name)
         except Exception as e:
             logger.error(f"Ошибка проверки статуса Xray: {e}")
             return False
@@ -105,134 +510,391 @@ class XrayManager:
     async def get_status(self) -> Dict[str, str]:
         """Получить статус Xray сервиса"""
         try:
-            returncode, stdout, stderr = await self._run_command([
-                "systemctl", "status", self.service_name, "--no-pager"
-            ])
-            
-            is_active = await self.is_running()
+            is_active, details = await self.service.status(self.service_name)
             
             return {
                 "status": "active" if is_active else "inactive",
-                "details": stdout if returncode == 0 else stderr
+                "details": details
             }
         except Exception as e:
             logger.error(f"Ошибка получения статуса Xray: {e}")
             return {"status": "error", "details": str(e)}
     
+    def link_template(self) -> LinkTemplate:
+        """Шаблон ссылок из памяти, без чтения файла в цикле событий.
+        
+        Шаблон пересобирается при сохранении конфигурации; внешние
+        изменения файла проверяет фоновая refresh_link_template, которую
+        обращение запускает не чаще раза в LINK_TEMPLATE_CHECK_INTERVAL
+        секунд, не дожидаясь ее завершения.
+        """
+        now = time.monotonic()
+        if self._link_refresh is None and now - self._link_checked_at >= LINK_TEMPLATE_CHECK_INTERVAL:
+            self._link_checked_at = now
+            self._link_refresh = asyncio.create_task(self.refresh_link_template())
+            self._link_refresh.add_done_callback(self._link_refresh_done)
+        if self._link_template is None:
+            # Конфигурация еще не прочитана - шаблон без параметров inbound
+            return LinkTemplate.from_config({}, self.inbound_tag)
+        return self._link_template
+    
+    def _link_refresh_done(self, task: asyncio.Task) -> None:
+        self._link_refresh = None
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Ошибка обновления шаблона ссылок: {task.exception()}")
+    
+    async def refresh_link_template(self) -> LinkTemplate:
+        """Пересобрать шаблон ссылок из текущей конфигурации (чтение в пуле потоков)"""
+        self._set_link_template(await self.get_config() or {})
+        return self._link_template
+    
+    def _set_link_template(self, config: Dict) -> None:
+        """Собрать шаблон из конфигурации; при изменении параметров сбросить кэш ссылок"""
+        template = LinkTemplate.from_config(config, self.inbound_tag)
+        if self._link_template is None or template.key != self._link_template.key:
+            if self._link_template is not None:
+                logger.info("Параметры подключения изменились, кэш ссылок и подписок сброшен")
+                response_cache.invalidate_kind(CACHE_USER)
+                response_cache.invalidate_kind(CACHE_SUB)
+            self._link_template = template
+    
     def generate_vless_link(self, user_uuid: str, server_ip: str = None) -> str:
         """Генерировать VLESS ссылку"""
-        if not server_ip:
-            server_ip = "YOUR_SERVER_IP"  # Заменить на реальный IP
-        
-        # Базовые параметры VLESS
-        params = {
-            "security": settings.DEFAULT_SECURITY,
-            "encryption": "none",
-            "flow": settings.DEFAULT_FLOW,
-            "type": "tcp",
-            "fp": settings.DEFAULT_FP,
-            "sni": settings.DEFAULT_SNI,
-            "pbk": "PUBLIC_KEY",  # Заменить на реальный публичный ключ
-            "sid": "SHORT_ID"     # Заменить на реальный короткий ID
-        }
+        return self.link_template().link(user_uuid, server_ip)
+    
+    def _file_signature(self) -> Optional[tuple]:
+        """Подпись файла конфигурации для обнаружения внешних изменений"""
+        try:
+            stat = os.stat(self.config_path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    
+    async def _get_registry(self) -> Optional[ClientRegistry]:
+        """Получить индексированную модель конфигурации.
         
-        # Формируем параметры строки
-        param_str = "&".join([f"{k}={v}" for k, v in params.items()])
+        Модель строится один раз и перечитывается только если файл
+        был изменен извне (изменились mtime, размер или inode).
+        """
+        signature = self._file_signature()
+        if self._registry is not None and signature is not None and self._registry.signature == signature:
+            return self._registry
         
-        # Формируем VLESS ссылку
-        vless_link = f"vless://{user_uuid}@{server_ip}:{settings.DEFAULT_PORT}?{param_str}#DeltaVPN"
+        config = await self.get_config()
+        if not config:
+            self._registry = None
+            return None
         
-        return vless_link
+        self._registry = ClientRegistry(config, signature)
+        return self._registry
     
-    async def add_user(self, user: User, server_ip: str = None) -> bool:
-        """Добавить пользователя в конфигурацию Xray"""
-        try:
-            config = await self.get_config()
-            if not config:
-                logger.error("Не удалось получить конфигурацию Xray")
-                return False
-            
-            # Ищем inbound с протоколом VLESS
-            vless_inbound = None
-            for inbound in config.get("inbounds", []):
-                if inbound.get("protocol") == "vless":
-                    vless_inbound = inbound
-                    break
+    def _client_email(self, user: User) -> str:
+        """Email клиента в Xray (идентификатор пользователя в API и статистике)"""
+        return user.email or f"user_{user.uuid[:8]}"
+    
+    def _ensure_api_config(self, config: Dict) -> bool:
+        """Добавить в конфигурацию API inbound, теги и счетчики для горячего обновления и статистики.
+        
+        Возвращает True, если конфигурация изменилась структурно и Xray
+        нужно перезапустить, чтобы изменения вступили в силу.
+        """
+        if not self.api:
+            return False
+        
+        changed = False
+        
+        # VLESS inbound должен иметь тег, по нему адресуется AlterInbound
+        for inbound in config.get("inbounds", []):
+            if inbound.get("protocol") == "vless" and not inbound.get("tag"):
+                inbound["tag"] = self.inbound_tag
+                changed = True
+        
+        # Секция api с сервисами управления клиентами и статистики
+        api_section = config.setdefault("api", {})
+        if api_section.get("tag") != "api":
+            api_section["tag"] = "api"
+            changed = True
+        services = api_section.setdefault("services", [])
+        for service in ("HandlerService", "StatsService"):
+            if service not in services:
+                services.append(service)
+                changed = True
+        
+        # Включаем счетчики трафика пользователей
+        if "stats" not in config:
+            config["stats"] = {}
+            changed = True
+        level = config.setdefault("policy", {}).setdefault("levels", {}).setdefault("0", {})
+        for option in ("statsUserUplink", "statsUserDownlink"):
+            if not level.get(option):
+                level[option] = True
+                changed = True
+        
+        # Локальный inbound, через который принимаются gRPC вызовы
+        inbounds = config.setdefault("inbounds", [])
+        if not any(inbound.get("tag") == "api" for inbound in inbounds):
+            inbounds.append({
+                "listen": settings.XRAY_API_HOST,
+                "port": settings.XRAY_API_PORT,
+                "protocol": "dokodemo-door",
+                "settings": {"address": settings.XRAY_API_HOST},
+                "tag": "api"
+            })
+            changed = True
+        
+        # Маршрут api inbound -> api outbound
+        rules = config.setdefault("routing", {}).setdefault("rules", [])
+        if not any(rule.get("outboundTag") == "api" for rule in rules):
+            rules.insert(0, {
+                "type": "field",
+                "inboundTag": ["api"],
+                "outboundTag": "api"
+            })
+            changed = True
+        
+        return changed
+    
+    def _apply_mutation(self, registry: ClientRegistry, mutation: "XrayMutation") -> Optional[List[tuple]]:
+        """Применить одну операцию к проиндексированной конфигурации.
+        
+        Возвращает список операций для горячего обновления через API
+        (пустой, если конфигурация не изменилась) или None при ошибке.
+        """
+        if mutation.kind == MUTATION_ADD:
+            user = mutation.user
             
+            # Новые клиенты добавляются в первый VLESS inbound
+            vless_inbound = registry.primary_inbound()
             if not vless_inbound:
                 logger.error("VLESS inbound не найден в конфигурации")
-                return False
+                return None
             
-            # Добавляем пользователя
-            clients = vless_inbound.get("settings", {}).get("clients", [])
+            # Проверяем, что пользователь еще не существует ни в одном inbound
+            if registry.get(user.uuid) is not None:
+                logger.warning(f"Пользователь {user.uuid} уже существует")
+                return []
             
-            # Проверяем, что пользователь еще не существует
-            for client in clients:
-                if client.get("id") == user.uuid:
-                    logger.warning(f"Пользователь {user.uuid} уже существует")
-                    return True
+            # Email - идентификатор клиента в Xray API и статистике, он не
+            # может принадлежать двум клиентам
+            email = self._client_email(user)
+            owner = registry.get_by_email(email)
+            if owner is not None:
+                logger.error(f"Email {email} уже занят клиентом {owner.get('id')}")
+                return None
             
             # Добавляем нового клиента
             new_client = {
                 "id": user.uuid,
                 "flow": settings.DEFAULT_FLOW,
-                "email": user.email or f"user_{user.uuid[:8]}"
+                "email": email
             }
+            registry.add(vless_inbound, new_client)
             
-            clients.append(new_client)
-            
-            # Сохраняем конфигурацию
-            if await self.save_config(config):
-                return await self.restart_xray()
-            
-            return False
-            
-        except Exception as e:
-            logger.error(f"Ошибка добавления пользователя: {e}")
-            return False
+            return [(MUTATION_ADD, vless_inbound.tag or self.inbound_tag, new_client)]
+        
+        # Удаление и приостановка в Xray выглядят одинаково - клиент убирается из всех inbound
+        removed = registry.remove(mutation.user_uuid)
+        if not removed:
+            logger.warning(f"Пользователь {mutation.user_uuid} не найден в конфигурации")
+        
+        return [(MUTATION_REMOVE, tag or self.inbound_tag, client) for tag, client in removed]
     
-    async def remove_user(self, user_uuid: str) -> bool:
-        """Удалить пользователя из конфигурации Xray"""
-        try:
-            config = await self.get_config()
-            if not config:
+    async def _hot_update(self, operations: List[tuple]) -> bool:
+        """Применить изменения клиентов к работающему Xray через API"""
+        for kind, tag, client in operations:
+            if kind == MUTATION_ADD:
+                ok = await self.api.add_user(tag, client["id"], client["email"], client.get("flow", ""))
+            else:
+                ok = await self.api.remove_user(tag, client.get("email", ""))
+            if not ok:
                 return False
+        return True
+    
+    async def _apply_batch(self, mutations: List["XrayMutation"]) -> List[bool]:
+        """Применить пачку операций: одна запись конфигурации и одна перезагрузка"""
+        registry = await self._get_registry()
+        if not registry:
+            logger.error("Не удалось получить конфигурацию Xray")
+            return [False] * len(mutations)
+        config = registry.config
+        
+        results: List[bool] = []
+        changed: List[int] = []  # индексы операций, изменивших конфигурацию
+        operations: List[tuple] = []
+        
+        for index, mutation in enumerate(mutations):
+            try:
+                mutation_ops = self._apply_mutation(registry, mutation)
+            except Exception as e:
+                logger.error(f"Ошибка применения операции {mutation.kind}: {e}")
+                mutation_ops = None
             
-            # Ищем и удаляем пользователя из всех inbound
-            user_found = False
-            for inbound in config.get("inbounds", []):
-                if inbound.get("protocol") == "vless":
-                    clients = inbound.get("settings", {}).get("clients", [])
-                    original_count = len(clients)
-                    
-                    # Фильтруем клиентов, исключая удаляемого
-                    inbound["settings"]["clients"] = [
-                        client for client in clients 
-                        if client.get("id") != user_uuid
-                    ]
-                    
-                    if len(inbound["settings"]["clients"]) < original_count:
-                        user_found = True
-            
-            if not user_found:
-                logger.warning(f"Пользователь {user_uuid} не найден в конфигурации")
-                return True  # Считаем успешным, если пользователя уже нет
+            results.append(mutation_ops is not None)
+            if mutation_ops:
+                changed.append(index)
+                operations.extend(mutation_ops)
+        
+        if not operations:
+            return results
+        
+        structural = self._ensure_api_config(config)
+        if structural:
+            # Появились новые inbound/теги - перестраиваем индексы
+            registry = ClientRegistry(config)
+            self._registry = registry
+        
+        # Файл сохраняем всегда, чтобы изменения пережили перезапуск Xray
+        applied = await self.save_config(config)
+        if applied:
+            # Собственная запись не должна сбрасывать индексы
+            registry.signature = self._file_signature()
+        else:
+            # Индексы разошлись с файлом - перечитаем при следующей операции
+            self._registry = None
+            self._config_cache = None
+        
+        if applied:
+            hot = self.api is not None and not structural
+            if hot:
+                started = time.perf_counter()
+                hot = await self._hot_update(operations)
+                self._record_apply(APPLY_HOT, hot, started)
+                if not hot:
+                    logger.warning("Горячее обновление через Xray API не удалось, применяем конфигурацию перезагрузкой Xray")
+            if not hot:
+                applied = await self.reload_xray(config)
+        
+        if not applied:
+            for index in changed:
+                results[index] = False
+        
+        logger.info(f"Применено {len(mutations)} операций с пользователями Xray за одну запись конфигурации")
+        return results
+    
+    async def _mutation_worker(self) -> None:
+        """Единственный писатель конфигурации: собирает операции в окно и применяет пачкой"""
+        while self._pending:
+            # Даем накопиться операциям, пришедшим почти одновременно
+            await asyncio.sleep(settings.XRAY_BATCH_WINDOW_MS / 1000)
             
-            # Сохраняем конфигурацию и перезапускаем
-            if await self.save_config(config):
-                return await self.restart_xray()
+            batch = self._pending[:settings.XRAY_BATCH_MAX_SIZE]
+            del self._pending[:len(batch)]
             
-            return False
+            try:
+                async with self._config_lock, self._file_lock:
+                    results = await self._apply_batch(batch)
+            except Exception as e:
+                logger.error(f"Ошибка применения пачки операций Xray: {e}")
+                results = [False] * len(batch)
             
-        except Exception as e:
-            logger.error(f"Ошибка удаления пользователя: {e}")
-            return False
+            for mutation, result in zip(batch, results):
+                if not mutation.future.done():
+                    mutation.future.set_result(result)
+    
+    async def _submit(self, mutations: List["XrayMutation"]) -> List[bool]:
+        """Поставить операции в очередь и дождаться их результатов"""
+        if not mutations:
+            return []
+        loop = asyncio.get_running_loop()
+        for mutation in mutations:
+            mutation.future = loop.create_future()
+        self._pending.extend(mutations)
+        
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._mutation_worker())
+        
+        return list(await asyncio.gather(*(mutation.future for mutation in mutations)))
+    
+    async def add_user(self, user: User, server_ip: str = None) -> bool:
+        """Добавить пользователя в конфигурацию Xray"""
+        return (await self._submit([XrayMutation(MUTATION_ADD, user=user)]))[0]
     
-    async def get_traffic_stats(self) -> Dict[str, Dict[str, int]]:
-        """Получить статистику трафика (заглушка)"""
-        # В реальной реализации здесь должен быть запрос к Xray API
-        # Для демонстрации возвращаем пустую статистику
-        return {}
+    async def remove_user(self, user_uuid: str) -> bool:
+        """Удалить пользователя из конфигурации Xray"""
+        return (await self._submit([XrayMutation(MUTATION_REMOVE, user_uuid=user_uuid)]))[0]
+    
+    async def suspend_user(self, user_uuid: str) -> bool:
+        """Приостановить пользователя (убрать клиента из Xray, оставив его в базе)"""
+        return (await self._submit([XrayMutation(MUTATION_SUSPEND, user_uuid=user_uuid)]))[0]
+    
+    async def add_users(self, users: List[User]) -> List[bool]:
+        """Добавить пачку пользователей (результат для каждого пользователя)"""
+        return await self._submit([XrayMutation(MUTATION_ADD, user=user) for user in users])
+    
+    async def remove_users(self, user_uuids: List[str]) -> List[bool]:
+        """Удалить пачку пользователей (результат для каждого пользователя)"""
+        return await self._submit([XrayMutation(MUTATION_REMOVE, user_uuid=u) for u in user_uuids])
+    
+    async def suspend_users(self, user_uuids: List[str]) -> List[bool]:
+        """Приостановить пачку пользователей (результат для каждого пользователя)"""
+        return await self._submit([XrayMutation(MUTATION_SUSPEND, user_uuid=u) for u in user_uuids])
+    
+    async def list_client_ids(self) -> Optional[Set[str]]:
+        """UUID клиентов во всех VLESS inbound текущей конфигурации"""
+        async with self._config_lock:
+            registry = await self._get_registry()
+            if registry is None:
+                return None
+            return set(registry.clients_by_id)
+    
+    async def client_state(self) -> Optional[Tuple[Optional[tuple], Set[str]]]:
+        """Подпись файла конфигурации и UUID клиентов всех VLESS inbound"""
+        async with self._config_lock:
+            registry = await self._get_registry()
+            if registry is None:
+                return None
+            return registry.signature, set(registry.clients_by_id)
+    
+    async def sync_clients(self, add: List[User], remove: List[str]) -> List[bool]:
+        """Добавить и удалить клиентов одной записью конфигурации.
+        
+        В отличие от очереди, пачка не делится по XRAY_BATCH_MAX_SIZE:
+        большая сверка не должна превращаться в десятки перезапусков Xray.
+        Результаты идут в порядке: сначала add, затем remove.
+        """
+        mutations = (
+            [XrayMutation(MUTATION_ADD, user=user) for user in add] +
+            [XrayMutation(MUTATION_REMOVE, user_uuid=u) for u in remove]
+        )
+        if not mutations:
+            return []
+        async with self._config_lock, self._file_lock:
+            return await self._apply_batch(mutations)
+    
+    async def get_traffic_stats(self, reset: bool = False) -> Optional[Tuple[Dict[str, Dict[str, int]], Dict[str, Dict[str, int]]]]:
+        """Получить статистику трафика пользователей из Xray StatsService.
+        
+        Все счетчики user>>>email>>>traffic>>>uplink/downlink запрашиваются
+        одним вызовом. При reset=True Xray обнуляет счетчики, и результат
+        содержит трафик с прошлого запроса. Возвращает пару
+        ({uuid: {"uplink", "downlink"}}, {email: {"uplink", "downlink"}}):
+        во втором словаре клиенты, которых уже нет в конфигурации (удалены
+        или приостановлены после прошлого сбора). None - статистика недоступна.
+        """
+        if not self.api:
+            return None
+        
+        counters = await self.api.query_stats("user>>>", reset=reset)
+        if counters is None:
+            return None
+        
+        registry = await self._get_registry()
+        result: Dict[str, Dict[str, int]] = {}
+        unknown: Dict[str, Dict[str, int]] = {}
+        for name, value in counters.items():
+            parts = name.split(">>>")
+            if len(parts) != 4 or parts[0] != "user" or parts[2] != "traffic" or not value:
+                continue
+            
+            client = registry.get_by_email(parts[1]) if registry else None
+            if client:
+                traffic = result.setdefault(client["id"], {"uplink": 0, "downlink": 0})
+            else:
+                traffic = unknown.setdefault(parts[1], {"uplink": 0, "downlink": 0})
+            if parts[3] in traffic:
+                traffic[parts[3]] += value
+        
+        return result, unknown
     
     async def create_default_config(self) -> bool:
         """Создать базовую конфигурацию Xray"""
@@ -245,6 +907,7 @@ class XrayManager:
                     {
                         "port": settings.DEFAULT_PORT,
                         "protocol": "vless",
+                        "tag": settings.XRAY_INBOUND_TAG,
                         "settings": {
                             "clients": [],
                             "decryption": "none"
@@ -271,8 +934,11 @@ class XrayManager:
                 ]
             }
             
-            return await self.save_config(default_config)
+            # Секции API для горячего обновления пользователей и статистики
+            self._ensure_api_config(default_config)
             
+            return await self.save_config(default_config)
+        
         except Exception as e:
             logger.error(f"Ошибка создания конфигурации по умолчанию: {e}")
             return False
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+# Состояния Xray
+XRAY_ACTIVE = "active"
+XRAY_INACTIVE = "inactive"
+XRAY_UNKNOWN = "unknown"
+
+
+async def probe_tcp(host: str, port: int, timeout: float) -> bool:
+    """Принимает ли порт TCP подключения"""
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout=timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return True
+
+
+class XrayStateWatcher:
+    """Кэшированное состояние процесса Xray.
+    
+    Фоновая задача периодически вызывает refresh(), а проверки готовности
+    читают уже известное состояние без запуска дочерних процессов.
+    Способ проверки выбирается по настройкам:
+    - Xray API включен - TCP подключение к порту API;
+    - задан XRAY_PID_FILE - наличие процесса с pid из файла;
+    - иначе - поиск процесса xray в /proc.
+    """
+    
+    def __init__(self, interval: float = None):
+        self.interval = interval or settings.XRAY_WATCH_INTERVAL
+        self.state = XRAY_UNKNOWN
+        self.checked_at: Optional[float] = None
+        self.changed_at: Optional[float] = None
+    
+    @property
+    def method(self) -> str:
+        """Способ проверки состояния"""
+        if settings.XRAY_API_ENABLED:
+            return "api_port"
+        if settings.XRAY_PID_FILE:
+            return "pidfile"
+        return "proc"
+    
+    @property
+    def is_fresh(self) -> bool:
+        """Состояние проверялось недавно (не более трех интервалов назад)"""
+        return self.checked_at is not None and time.monotonic() - self.checked_at <= self.interval * 3
+    
+    @property
+    def is_active(self) -> bool:
+        return self.state == XRAY_ACTIVE and self.is_fresh
+    
+    async def _probe_api_port(self) -> bool:
+        """Принимает ли Xray подключения на порту API"""
+        return await probe_tcp(
+            settings.XRAY_API_HOST, settings.XRAY_API_PORT, min(settings.XRAY_API_TIMEOUT, self.interval)
+        )
+    
+    @staticmethod
+    def _probe_pidfile() -> bool:
+        """Существует ли процесс с pid из XRAY_PID_FILE"""
+        try:
+            pid = int(Path(settings.XRAY_PID_FILE).read_text().strip())
+            os.kill(pid, 0)
+            return True
+        except PermissionError:
+            # Процесс есть, но принадлежит другому пользователю
+            return True
+        except (OSError, ValueError):
+            return False
+    
+    @staticmethod
+    def _probe_proc() -> bool:
+        """Есть ли в /proc процесс с именем xray"""
+        try:
+            for entry in os.scandir("/proc"):
+                if not entry.name.isdigit():
+                    continue
+                try:
+                    with open(f"/proc/{entry.name}/comm") as f:
+                        if f.read().strip() == "xray":
+                            return True
+                except OSError:
+                    continue
+        except OSError:
+            pass
+        return False
+    
+    async def refresh(self) -> str:
+        """Проверить состояние Xray и обновить кэш"""
+        method = self.method
+        if method == "api_port":
+            alive = await self._probe_api_port()
+        elif method == "pidfile":
+            alive = self._probe_pidfile()
+        else:
+            alive = self._probe_proc()
+        
+        state = XRAY_ACTIVE if alive else XRAY_INACTIVE
+        now = time.monotonic()
+        if state != self.state:
+            if state == XRAY_INACTIVE:
+                logger.warning(f"Xray не отвечает (проверка: {method})")
+            elif self.state != XRAY_UNKNOWN:
+                logger.info("Xray снова работает")
+            self.state = state
+            self.changed_at = now
+        self.checked_at = now
+        return state
+    
+    def snapshot(self) -> Dict:
+        """Текущее кэшированное состояние для ответов API"""
+        now = time.monotonic()
+        return {
+            "state": self.state if self.is_fresh else XRAY_UNKNOWN,
+            "method": self.method,
+            "checked_ago": round(now - self.checked_at, 3) if self.checked_at is not None else None,
+            "state_for": round(now - self.changed_at, 3) if self.changed_at is not None else None,
+        }
+
+
+# Глобальный экземпляр наблюдателя
+xray_watcher = XrayStateWatcher()
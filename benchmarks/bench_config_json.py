@@ -0,0 +1,87 @@
+"""Бенчмарк разбора и записи config.json Xray.
+
+Сравнивает стандартный json и orjson (если установлен), запись с отступами
+и компактную запись на конфигурациях с 1k, 10k и 100k клиентов.
+
+Запуск:
+    python -m benchmarks.bench_config_json [--sizes 1000,10000,100000] [--repeat 5]
+"""
+import argparse
+import json
+import time
+import uuid
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def make_config(clients: int) -> dict:
+    """Сгенерировать конфигурацию с указанным количеством клиентов"""
+    return {
+        "log": {"loglevel": "warning"},
+        "inbounds": [{
+            "port": 443,
+            "protocol": "vless",
+            "tag": "vless-in",
+            "settings": {
+                "clients": [
+                    {"id": str(uuid.uuid4()), "flow": "xtls-rprx-vision", "email": f"user_{i}@example.com"}
+                    for i in range(clients)
+                ],
+                "decryption": "none"
+            },
+            "streamSettings": {"network": "tcp", "security": "reality"}
+        }],
+        "outbounds": [{"protocol": "freedom", "settings": {}}]
+    }
+
+
+def best_of(func, repeat: int) -> float:
+    """Лучшее время выполнения в миллисекундах"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def backends():
+    """Варианты сериализации: (имя, dumps, loads)"""
+    variants = [
+        ("json indent=2",
+         lambda obj: json.dumps(obj, indent=2, ensure_ascii=False).encode("utf-8"), json.loads),
+        ("json compact",
+         lambda obj: json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), json.loads),
+    ]
+    if orjson is not None:
+        variants += [
+            ("orjson indent=2", lambda obj: orjson.dumps(obj, option=orjson.OPT_INDENT_2), orjson.loads),
+            ("orjson compact", orjson.dumps, orjson.loads),
+        ]
+    return variants
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if orjson is None:
+        print("orjson не установлен - сравнивается только стандартный json\n")
+
+    print(f"{'clients':>8} {'backend':<16} {'size, KB':>10} {'dump, ms':>10} {'parse, ms':>10}")
+    for size in (int(s) for s in args.sizes.split(",")):
+        config = make_config(size)
+        for name, dumps, loads in backends():
+            data = dumps(config)
+            dump_ms = best_of(lambda: dumps(config), args.repeat)
+            parse_ms = best_of(lambda: loads(data), args.repeat)
+            print(f"{size:>8} {name:<16} {len(data) / 1024:>10.0f} {dump_ms:>10.2f} {parse_ms:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""Планы и время выполнения запросов API к базе пользователей.
+
+Создает временную базу со всеми миграциями, заполняет ее пользователями
+и для каждого запроса, который выполняет API, печатает EXPLAIN QUERY PLAN
+и время выполнения. Запрос без индекса (SCAN по таблице) отмечается как FAIL.
+
+Запуск:
+    python -m benchmarks.bench_query_plans [--users 50000] [--repeat 20]
+"""
+import argparse
+import asyncio
+import os
+import secrets
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+# Таблицы, полный просмотр которых в запросах API недопустим
+INDEXED_TABLES = ("users", "traffic", "traffic_rollup", "traffic_samples")
+
+
+def create_schema(db_path: str) -> None:
+    """Создать схему теми же init_db и миграциями, что и приложение"""
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from app.database import Database
+
+    async def run():
+        database = Database(db_path, pool_size=1)
+        await database.init_db()
+        await database.close()
+
+    asyncio.run(run())
+
+
+def populate(conn: sqlite3.Connection, users: int) -> list:
+    """Заполнить базу пользователями, вернуть их uuid"""
+    base = datetime(2024, 1, 1)
+    statuses = ("active", "active", "active", "suspended")
+    rows = []
+    for i in range(users):
+        created_at = (base + timedelta(seconds=i)).isoformat()
+        rows.append((str(uuid.uuid4()), f"user {i}", f"user_{i}@example.com",
+                     statuses[i % len(statuses)], created_at, created_at, secrets.token_urlsafe(16)))
+    conn.executemany("""
+        INSERT INTO users (uuid, name, email, status, created_at, updated_at, sub_token)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    conn.executemany("INSERT INTO traffic (uuid, upload, download, last_updated) VALUES (?, 0, 0, ?)",
+                     [(row[0], row[4]) for row in rows])
+    conn.commit()
+    conn.execute("ANALYZE")
+    return [row[0] for row in rows]
+
+
+def queries(uuids: list) -> list:
+    """Запросы API: (описание, SQL, параметры)"""
+    middle = uuids[len(uuids) // 2]
+    return [
+        ("get_user", "SELECT * FROM users WHERE uuid = ?", (middle,)),
+        ("get_user_by_sub_token", "SELECT * FROM users WHERE sub_token = ?", ("token",)),
+        ("get_users (IN)", f"SELECT * FROM users WHERE uuid IN ({','.join('?' * 100)})", tuple(uuids[:100])),
+        ("find_emails (IN)", "SELECT email FROM users WHERE email IN (?, ?)",
+         ("user_1@example.com", "user_2@example.com")),
+        ("list page", "SELECT * FROM users ORDER BY created_at DESC, uuid DESC LIMIT 101", ()),
+        ("list page after cursor",
+         "SELECT * FROM users WHERE (created_at, uuid) < (?, ?) ORDER BY created_at DESC, uuid DESC LIMIT 101",
+         ("2024-01-01T05:00:00", middle)),
+        ("list by status",
+         "SELECT * FROM users WHERE status = ? ORDER BY created_at DESC, uuid DESC LIMIT 101", ("suspended",)),
+        ("list by email", "SELECT * FROM users WHERE email = ? ORDER BY created_at DESC, uuid DESC",
+         ("user_10@example.com",)),
+        ("list by name prefix",
+         "SELECT * FROM users WHERE name >= ? AND name < ? ORDER BY created_at DESC, uuid DESC",
+         ("user 123", "user 123\U0010ffff")),
+        ("count all", "SELECT COUNT(*) FROM users", ()),
+        ("count by status", "SELECT COUNT(*) FROM users WHERE status = ?", ("active",)),
+        ("get_traffic", "SELECT * FROM traffic WHERE uuid = ?", (middle,)),
+        ("traffic history",
+         "SELECT (bucket / ?) * ? AS ts, SUM(upload), SUM(download) FROM traffic_rollup "
+         "WHERE uuid = ? AND resolution = ? AND bucket >= ? AND bucket < ? GROUP BY ts ORDER BY ts",
+         (3600, 3600, middle, 60, 0, 2 ** 40)),
+        ("rollup retention", "SELECT COUNT(*) FROM traffic_rollup WHERE resolution = ? AND bucket < ?", (60, 0)),
+        ("samples retention", "SELECT COUNT(*) FROM traffic_samples WHERE ts < ?", (0,)),
+    ]
+
+
+def uses_full_scan(plan: list) -> bool:
+    """Есть ли в плане полный просмотр таблицы без индекса"""
+    for detail in plan:
+        for table in INDEXED_TABLES:
+            if detail == f"SCAN {table}":
+                return True
+    return False
+
+
+def best_of(conn: sqlite3.Connection, sql: str, params: tuple, repeat: int) -> float:
+    """Лучшее время выполнения в миллисекундах"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        create_schema(db_path)
+        conn = sqlite3.connect(db_path)
+        uuids = populate(conn, args.users)
+
+        failed = 0
+        print(f"{'query':<24} {'ms':>8}  plan")
+        for name, sql, params in queries(uuids):
+            plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+            full_scan = uses_full_scan(plan)
+            failed += full_scan
+            ms = best_of(conn, sql, params, args.repeat)
+            mark = "FAIL" if full_scan else "ok"
+            print(f"{name:<24} {ms:>8.3f}  [{mark}] {'; '.join(plan)}")
+        conn.close()
+
+    if failed:
+        print(f"\nЗапросов без индекса: {failed}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
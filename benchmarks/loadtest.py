@@ -0,0 +1,579 @@
+"""Нагрузочный тест API с имитацией Xray.
+
+Запускает приложение в этом процессе (httpx.ASGITransport) или под uvicorn
+на временной базе SQLite и временном config.json. Вместо xray и systemctl
+в PATH подкладываются скрипты-заглушки, порт VLESS inbound слушает сам
+тест (по нему сервис проверяет готовность Xray); в режиме inprocess вместо gRPC
+клиента Xray API подставляется FakeXrayAPI: клиенты добавляются без
+перезапуска Xray, счетчики трафика генерируются для всех клиентов.
+
+Сценарии:
+    create-burst    одновременное создание пользователей (POST /users)
+    list-50k        постраничный обход и полная выгрузка GET /users на --users пользователях
+    poll-user       опрос GET /users/{uuid} и GET /traffic/{uuid}
+    traffic-ingest  сбор трафика всех пользователей (только inprocess)
+    auth-heavy      запросы с --keys разными API ключами, каждый 10-й ключ неверный
+
+Для каждого сценария в JSON файл записываются p50/p99 задержки, запросы
+в секунду и RSS процесса сервера. Файлы разных коммитов сравниваются
+параметром --compare.
+
+Запуск:
+    python -m benchmarks.loadtest [--mode inprocess|uvicorn] [--workers 1]
+        [--scenarios create-burst,list-50k,poll-user,traffic-ingest,auth-heavy]
+        [--users 50000] [--requests 5000] [--concurrency 50]
+        [--output loadtest.json] [--compare old.json]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = ("create-burst", "list-50k", "poll-user", "traffic-ingest", "auth-heavy")
+
+# Заглушки команд: xray -test всегда успешен, systemctl сообщает, что сервис активен
+FAKE_BINARIES = {
+    "xray": '#!/bin/sh\nif [ "$1" = "version" ]; then echo "Xray 0.0.0 (loadtest)"; fi\nexit 0\n',
+    "systemctl": '#!/bin/sh\nif [ "$1" = "is-active" ]; then echo active; fi\nexit 0\n',
+}
+
+# Размер пачки при заполнении базы пользователями
+SEED_BATCH = 5000
+
+# Размер страницы в сценарии list-50k
+LIST_PAGE = 500
+
+# Доля запросов с неверным ключом в сценарии auth-heavy
+INVALID_KEY_EVERY = 10
+
+
+class FakeXrayAPI:
+    """Замена XrayAPIClient: клиенты хранятся в памяти, трафик генерируется"""
+
+    def __init__(self, seed: int = 0):
+        self.emails = set()
+        self.rng = random.Random(seed)
+
+    async def add_user(self, tag: str, user_uuid: str, email: str, flow: str = "", level: int = 0) -> bool:
+        self.emails.add(email)
+        return True
+
+    async def remove_user(self, tag: str, email: str) -> bool:
+        self.emails.discard(email)
+        return True
+
+    async def query_stats(self, pattern: str = "", reset: bool = False) -> Dict[str, int]:
+        counters = {}
+        for email in self.emails:
+            counters[f"user>>>{email}>>>traffic>>>uplink"] = self.rng.randint(1, 1 << 20)
+            counters[f"user>>>{email}>>>traffic>>>downlink"] = self.rng.randint(1, 1 << 24)
+        return counters
+
+    async def close(self) -> None:
+        pass
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def serve_inbound(port: int) -> asyncio.AbstractServer:
+    """Порт inbound имитации Xray: принимает подключения и сразу закрывает их"""
+    async def handle(reader, writer):
+        writer.close()
+    return await asyncio.start_server(handle, "127.0.0.1", port)
+
+
+def prepare_environment(directory: str, workers: int) -> None:
+    """Временные пути приложения и заглушки xray/systemctl в PATH.
+
+    Вызывается до импорта app: настройки читаются из окружения при импорте.
+    Остальные переменные окружения (XRAY_FSYNC_POLICY и т.п.) передаются
+    приложению как есть.
+    """
+    bin_dir = os.path.join(directory, "bin")
+    os.makedirs(bin_dir)
+    for name, script in FAKE_BINARIES.items():
+        path = os.path.join(bin_dir, name)
+        with open(path, "w") as f:
+            f.write(script)
+        os.chmod(path, 0o755)
+
+    for name in ("data", "logs"):
+        os.makedirs(os.path.join(directory, name))
+    os.environ.update(
+        PATH=bin_dir + os.pathsep + os.environ.get("PATH", ""),
+        DATA_DIR=os.path.join(directory, "data"),
+        LOGS_DIR=os.path.join(directory, "logs"),
+        XRAY_CONFIG_PATH=os.path.join(directory, "config.json"),
+        API_KEYS_FILE=os.path.join(directory, "data", "api_keys.json"),
+        API_KEY_FILE=os.path.join(directory, "data", "api_key.txt"),
+        XRAY_API_ENABLED="false",
+        DEFAULT_PORT=str(free_port()),
+        PUBLIC_HOST="127.0.0.1",
+        WORKERS=str(workers),
+    )
+    sys.path.insert(0, ROOT)
+
+
+async def prepare_state(keys: int, fake_api: Optional[FakeXrayAPI]) -> List[str]:
+    """Создать схему базы, config.json и API ключи, вернуть ключи"""
+    from app import auth
+    from app.database import database
+    from app.xray_manager import xray_manager
+
+    # API подставляется до создания конфигурации, чтобы в ней сразу были
+    # секции API и первая пачка не требовала перезапуска Xray
+    if fake_api is not None:
+        xray_manager.api = fake_api
+    await database.init_db()
+    await xray_manager.create_default_config()
+    await auth.api_key_manager.load()
+    return [await auth.create_api_key(f"loadtest-{i}") for i in range(keys)]
+
+
+def process_rss(pid: int) -> Dict[str, float]:
+    """Текущий и пиковый RSS процесса и его потомков (МБ)"""
+    rss = {"rss_mb": 0.0, "rss_peak_mb": 0.0}
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss["rss_mb"] += int(line.split()[1]) / 1024
+                    elif line.startswith("VmHWM:"):
+                        rss["rss_peak_mb"] += int(line.split()[1]) / 1024
+            with open(f"/proc/{current}/task/{current}/children") as f:
+                pending.extend(int(child) for child in f.read().split())
+        except OSError:
+            continue
+    if not rss["rss_mb"] and pid == os.getpid():
+        # Не Linux: доступен только пиковый RSS своего процесса
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        rss["rss_peak_mb"] = peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return {name: round(value, 1) for name, value in rss.items()}
+
+
+class InProcessServer:
+    """Приложение в этом процессе, запросы через ASGITransport.
+
+    Клиент и сервер делят один цикл событий, поэтому задержки включают
+    работу клиента httpx; для сравнения коммитов между собой это не мешает.
+    """
+
+    mode = "inprocess"
+
+    def __init__(self, fake_api: bool):
+        self.fake_api = FakeXrayAPI() if fake_api else None
+        self.client: Optional[httpx.AsyncClient] = None
+        self.main = None
+
+    async def start(self, keys: int) -> List[str]:
+        from app import main
+        self.main = main
+        logging.getLogger().setLevel(logging.WARNING)
+
+        api_keys = await prepare_state(keys, self.fake_api)
+        await main.startup_event()
+        self.client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=main.app), base_url="http://loadtest", timeout=None
+        )
+        return api_keys
+
+    def rss(self) -> Dict[str, float]:
+        return process_rss(os.getpid())
+
+    async def stop(self) -> None:
+        if self.client is not None:
+            await self.client.aclose()
+        if self.main is not None:
+            await self.main.shutdown_event()
+
+
+class UvicornServer:
+    """Приложение под uvicorn в отдельном процессе, запросы по HTTP"""
+
+    mode = "uvicorn"
+
+    def __init__(self, workers: int, concurrency: int, log_path: str):
+        self.workers = workers
+        self.concurrency = concurrency
+        self.log_path = log_path
+        self.process: Optional[subprocess.Popen] = None
+        self.client: Optional[httpx.AsyncClient] = None
+
+    async def start(self, keys: int) -> List[str]:
+        from app.database import database
+
+        api_keys = await prepare_state(keys, None)
+        await database.close()
+
+        port = free_port()
+        with open(self.log_path, "w") as log:
+            self.process = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1",
+                 "--port", str(port), "--workers", str(self.workers), "--log-level", "warning"],
+                cwd=ROOT, stdout=log, stderr=subprocess.STDOUT
+            )
+        self.client = httpx.AsyncClient(
+            base_url=f"http://127.0.0.1:{port}", timeout=None,
+            limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        )
+
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                break
+            try:
+                if (await self.client.get("/healthz")).status_code == 200:
+                    return api_keys
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+        raise RuntimeError(f"uvicorn не запустился, журнал: {self.log_path}")
+
+    def rss(self) -> Dict[str, float]:
+        return process_rss(self.process.pid)
+
+    async def stop(self) -> None:
+        if self.client is not None:
+            await self.client.aclose()
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Перцентиль по ближайшему рангу"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))]
+
+
+def summarize(latencies: List[float], errors: int, seconds: float) -> Dict:
+    """Сводка замеров сценария (задержки в миллисекундах)"""
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(seconds, 3),
+        "rps": round(len(latencies) / seconds, 1) if seconds else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "max_ms": round(max(latencies, default=0.0) * 1000, 3),
+    }
+
+
+async def drive(requests: Iterable[Callable[[], Awaitable[bool]]], concurrency: int) -> Dict:
+    """Выполнить запросы не более чем concurrency одновременно.
+
+    Каждый элемент - фабрика корутины, возвращающей True при ожидаемом ответе.
+    """
+    latencies: List[float] = []
+    errors = 0
+    iterator = iter(requests)
+
+    async def worker():
+        nonlocal errors
+        for make_request in iterator:
+            started = time.perf_counter()
+            try:
+                ok = await make_request()
+            except httpx.HTTPError:
+                ok = False
+            latencies.append(time.perf_counter() - started)
+            if not ok:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+class LoadTest:
+    """Состояние прогона: сервер, ключи и созданные пользователи"""
+
+    def __init__(self, server, args):
+        self.server = server
+        self.args = args
+        self.client: Optional[httpx.AsyncClient] = None
+        self.keys: List[str] = []
+        self.headers: Dict[str, str] = {}
+        self.uuids: List[str] = []
+        self.rng = random.Random(args.seed)
+        self.seed_report = {"users": 0, "seconds": 0.0}
+
+    async def start(self) -> None:
+        self.keys = await self.server.start(max(1, self.args.keys))
+        self.client = self.server.client
+        self.headers = {"Authorization": f"Bearer {self.keys[0]}"}
+
+    def expect(self, method: str, url: str, expected: int = 200, **kwargs) -> Callable[[], Awaitable[bool]]:
+        """Фабрика запроса, успешного при статусе expected"""
+        kwargs.setdefault("headers", self.headers)
+
+        async def make_request() -> bool:
+            response = await self.client.request(method, url, **kwargs)
+            return response.status_code == expected
+        return make_request
+
+    async def ensure_users(self, count: int) -> None:
+        """Дополнить базу пользователями до count пачками POST /users/batch"""
+        started = time.perf_counter()
+        created = 0
+        while len(self.uuids) < count:
+            size = min(SEED_BATCH, count - len(self.uuids))
+            offset = len(self.uuids)
+            users = [{"name": f"seed {offset + i}", "email": f"seed_{offset + i}@loadtest"} for i in range(size)]
+            response = await self.client.post("/users/batch", json={"users": users}, headers=self.headers)
+            response.raise_for_status()
+            uuids = [item["uuid"] for item in response.json()["results"] if item["success"]]
+            if not uuids:
+                raise RuntimeError("не удалось создать пользователей для сценария")
+            self.uuids.extend(uuids)
+            created += len(uuids)
+        if created:
+            self.seed_report["users"] += created
+            self.seed_report["seconds"] = round(self.seed_report["seconds"] + time.perf_counter() - started, 3)
+
+    async def create_burst(self) -> Dict:
+        """Одновременное создание --burst пользователей по одному"""
+        run = uuid.uuid4().hex[:8]
+        created: List[str] = []
+
+        def create(i: int):
+            async def make_request() -> bool:
+                response = await self.client.post(
+                    "/users", json={"name": f"burst {i}", "email": f"burst_{run}_{i}@loadtest"},
+                    headers=self.headers
+                )
+                if response.status_code == 200:
+                    created.append(response.json()["uuid"])
+                return response.status_code == 200
+            return make_request
+
+        result = await drive((create(i) for i in range(self.args.burst)), self.args.concurrency)
+        self.uuids.extend(created)
+        return result
+
+    async def list_users(self) -> Dict:
+        """Обход всех страниц по курсору и одна полная потоковая выгрузка"""
+        await self.ensure_users(self.args.users)
+        latencies: List[float] = []
+        errors = 0
+        cursor = None
+        started = time.perf_counter()
+        while True:
+            params = {"limit": LIST_PAGE}
+            if cursor:
+                params["cursor"] = cursor
+            request_started = time.perf_counter()
+            response = await self.client.get("/users", params=params, headers=self.headers)
+            latencies.append(time.perf_counter() - request_started)
+            if response.status_code != 200:
+                errors += 1
+                break
+            cursor = response.headers.get("X-Next-Cursor")
+            if not cursor:
+                break
+        result = summarize(latencies, errors, time.perf_counter() - started)
+
+        full_started = time.perf_counter()
+        size = 0
+        async with self.client.stream("GET", "/users", headers=self.headers) as response:
+            async for chunk in response.aiter_bytes():
+                size += len(chunk)
+        result["full_list_seconds"] = round(time.perf_counter() - full_started, 3)
+        result["full_list_bytes"] = size
+        result["users"] = len(self.uuids)
+        return result
+
+    async def poll_user(self) -> Dict:
+        """Опрос карточки и трафика случайных пользователей"""
+        await self.ensure_users(self.args.users)
+        requests = (
+            self.expect("GET", f"/{'users' if i % 2 == 0 else 'traffic'}/{self.rng.choice(self.uuids)}")
+            for i in range(self.args.requests)
+        )
+        return await drive(requests, self.args.concurrency)
+
+    async def traffic_ingest(self) -> Dict:
+        """Сбор трафика: приращения по всем пользователям и проверка квот"""
+        if self.server.mode != "inprocess" or self.server.fake_api is None:
+            return {"skipped": "нужен режим inprocess с имитацией Xray API"}
+        from app.stats_collector import collect_traffic
+
+        await self.ensure_users(self.args.users)
+        rows = 0
+
+        async def collect() -> bool:
+            nonlocal rows
+            updated = await collect_traffic()
+            rows += updated
+            return updated > 0
+
+        result = await drive((collect for _ in range(self.args.rounds)), 1)
+        result["users"] = len(self.server.fake_api.emails)
+        result["rows_per_second"] = round(rows / result["seconds"], 1) if result["seconds"] else 0.0
+        return result
+
+    async def auth_heavy(self) -> Dict:
+        """Запросы с разными ключами; неверные ключи должны получать 401"""
+        def request(i: int):
+            if i % INVALID_KEY_EVERY == INVALID_KEY_EVERY - 1:
+                key, expected = f"invalid-{i}", 401
+            else:
+                key, expected = self.rng.choice(self.keys), 200
+            return self.expect("GET", "/cache/stats", expected, headers={"Authorization": f"Bearer {key}"})
+
+        return await drive((request(i) for i in range(self.args.requests)), self.args.concurrency)
+
+    async def run(self, scenario: str) -> Dict:
+        handlers = {
+            "create-burst": self.create_burst,
+            "list-50k": self.list_users,
+            "poll-user": self.poll_user,
+            "traffic-ingest": self.traffic_ingest,
+            "auth-heavy": self.auth_heavy,
+        }
+        result = await handlers[scenario]()
+        if "skipped" not in result:
+            result.update(self.server.rss())
+        return result
+
+
+def git_commit() -> Optional[str]:
+    """Текущий коммит (с пометкой -dirty при незафиксированных изменениях)"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "diff", "--quiet", "HEAD"], cwd=ROOT).returncode != 0
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{commit}-dirty" if dirty else commit
+
+
+def print_results(results: Dict) -> None:
+    print(f"{'scenario':<16} {'requests':>9} {'errors':>7} {'rps':>10} {'p50 ms':>9} {'p99 ms':>9} {'rss MB':>8}")
+    for name, result in results["scenarios"].items():
+        if "skipped" in result:
+            print(f"{name:<16} пропущен: {result['skipped']}")
+            continue
+        print(f"{name:<16} {result['requests']:>9} {result['errors']:>7} {result['rps']:>10.1f} "
+              f"{result['p50_ms']:>9.3f} {result['p99_ms']:>9.3f} {result['rss_mb']:>8.1f}")
+
+
+def print_comparison(old: Dict, new: Dict) -> None:
+    """Изменение p50/p99/rps относительно прошлого результата (в процентах)"""
+    print(f"\nСравнение с {old.get('commit')} ({old.get('mode')}):")
+    print(f"{'scenario':<16} {'p50':>9} {'p99':>9} {'rps':>9} {'rss':>9}")
+    for name, result in new["scenarios"].items():
+        before = old.get("scenarios", {}).get(name)
+        if not before or "skipped" in result or "skipped" in before:
+            continue
+        changes = []
+        for metric in ("p50_ms", "p99_ms", "rps", "rss_mb"):
+            if before.get(metric):
+                changes.append(f"{(result[metric] - before[metric]) / before[metric] * 100:+8.1f}%")
+            else:
+                changes.append(f"{'-':>9}")
+        print(f"{name:<16} {' '.join(changes)}")
+
+
+async def run_scenarios(args, directory: str) -> Dict:
+    if args.mode == "uvicorn":
+        server = UvicornServer(args.workers, args.concurrency, os.path.join(directory, "uvicorn.log"))
+    else:
+        server = InProcessServer(fake_api=not args.restart_path)
+
+    loadtest = LoadTest(server, args)
+    results = {
+        "commit": git_commit(),
+        "created_at": datetime.utcnow().isoformat(),
+        "mode": server.mode,
+        "workers": args.workers,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {
+            "users": args.users, "requests": args.requests, "concurrency": args.concurrency,
+            "burst": args.burst, "keys": args.keys, "rounds": args.rounds,
+            "restart_path": args.restart_path, "seed": args.seed,
+        },
+        "scenarios": {},
+    }
+    inbound = await serve_inbound(int(os.environ["DEFAULT_PORT"]))
+    try:
+        await loadtest.start()
+        for scenario in args.scenarios:
+            print(f"{scenario}...", file=sys.stderr)
+            results["scenarios"][scenario] = await loadtest.run(scenario)
+    finally:
+        await server.stop()
+        inbound.close()
+    results["seed_users"] = loadtest.seed_report
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=("inprocess", "uvicorn"), default="inprocess")
+    parser.add_argument("--workers", type=int, default=1, help="процессы uvicorn (режим uvicorn)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--users", type=int, default=50000, help="пользователей в базе для list/poll/ingest")
+    parser.add_argument("--requests", type=int, default=5000, help="запросов в poll-user и auth-heavy")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--burst", type=int, default=1000, help="пользователей в create-burst")
+    parser.add_argument("--keys", type=int, default=1000, help="API ключей в auth-heavy")
+    parser.add_argument("--rounds", type=int, default=10, help="сборов трафика в traffic-ingest")
+    parser.add_argument("--restart-path", action="store_true",
+                        help="без имитации Xray API: изменения применяются перезапуском (inprocess)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="файл результата (по умолчанию loadtest-<коммит>.json)")
+    parser.add_argument("--compare", help="прошлый файл результата для сравнения")
+    args = parser.parse_args()
+
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+
+    with tempfile.TemporaryDirectory(prefix="xray-loadtest-") as directory:
+        prepare_environment(directory, args.workers)
+        results = asyncio.run(run_scenarios(args, directory))
+
+    output = args.output or f"loadtest-{results['commit'] or 'unknown'}.json"
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+
+    print_results(results)
+    print(f"\nРезультат: {output}")
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -270,6 +270,8 @@ EOF
 HOST=0.0.0.0
 PORT=8000
 DEBUG=false
+# Количество процессов API (ключи, узлы и кэш согласуются между процессами)
+WORKERS=1
 
 # База данных
 DATABASE_URL=sqlite:///var/lib/xray-manager-api/data/xray_manager.db
@@ -313,7 +315,7 @@ Group=xrayapi
 WorkingDirectory=/opt/xray-manager-api
 Environment=PATH=/opt/xray-manager-api/venv/bin
 EnvironmentFile=/etc/xray-manager-api/config.env
-ExecStart=/opt/xray-manager-api/venv/bin/python -m uvicorn app.main:app --host 0.0.0.0 --port 8000
+ExecStart=/opt/xray-manager-api/venv/bin/python -m uvicorn app.main:app --host 0.0.0.0 --port 8000 --workers \${WORKERS}
 Restart=always
 RestartSec=3
 StandardOutput=journal
@@ -397,10 +399,20 @@ generate_api_key() {
     source venv/bin/activate
     
     API_KEY=$(python3 -c "
+import asyncio
 import sys
 sys.path.append('/opt/xray-manager-api')
-from app.auth import generate_initial_key
-key = generate_initial_key()
+from app.auth import api_key_manager, generate_initial_key
+from app.database import database
+
+async def main():
+    await database.init_db()
+    await api_key_manager.load()
+    key = await generate_initial_key()
+    await database.close()
+    return key
+
+key = asyncio.run(main())
 if key:
     print(key)
 ")